@@ -8,6 +8,8 @@ import NodeCache from 'node-cache';
 import dotenv from 'dotenv';
 import Memcached from 'memcached';
 import HashRing from 'hashring';
+import { AsyncLocalStorage } from 'async_hooks';
+import crypto from 'crypto';
 
 dotenv.config();
 const PORT = process.env.GATEWAY_PORT;
@@ -92,6 +94,30 @@ function deleteFromCacheWithConsistentHashing(key) {
 const app = express();
 app.use(bodyParser.json());
 
+// W3C trace context for the services' tracing: a request carrying a valid
+// traceparent continues that trace, others start one, kept with probability
+// TRACING_SAMPLE_RATE. The gateway records no spans itself, it passes the
+// traceparent on with every gRPC call of the request and returns it as
+// traceresponse, so a slow response can be looked up by its trace id.
+const TRACING_SAMPLE_RATE = parseFloat(process.env.TRACING_SAMPLE_RATE || '0.01');
+const TRACEPARENT = /^00-(?!0{32})[0-9a-f]{32}-(?!0{16})[0-9a-f]{16}-[0-9a-f]{2}$/;
+const traceContext = new AsyncLocalStorage();
+
+function traceparentOf(req) {
+  const incoming = req.get('traceparent');
+  if (incoming && TRACEPARENT.test(incoming.trim().toLowerCase())) {
+    return incoming.trim().toLowerCase();
+  }
+  const sampled = Math.random() < TRACING_SAMPLE_RATE ? '01' : '00';
+  return `00-${crypto.randomBytes(16).toString('hex')}-${crypto.randomBytes(8).toString('hex')}-${sampled}`;
+}
+
+app.use((req, res, next) => {
+  const traceparent = traceparentOf(req);
+  res.set('traceresponse', traceparent);
+  traceContext.run(traceparent, next);
+});
+
 const __filename = new URL(import.meta.url).pathname;
 const protoDir = path.dirname(__filename);
 
@@ -128,25 +154,93 @@ function listRegisteredServices() {
         reject(error);
       } else {
         registeredServices = response.services;
+        response.services.forEach(watchChanges);
         resolve(response.services);
       }
     });
   });
 }
 
-function selectService(services, serviceType) {
+// Follow the change log of every service instance and drop the cache entries
+// each change makes stale, whichever instance or client made the change.
+const WATCH_RETRY_MILLISECONDS = 1000;
+const changeWatches = {};
+
+function invalidateForChange(isRecords, change) {
+  if (isRecords) {
+    deleteFromCacheWithConsistentHashing(`getRecordInfo:${change.record_id}`);
+    deleteFromCacheWithConsistentHashing('listRecords');
+  } else {
+    deleteFromCacheWithConsistentHashing(`getPrescription:${change.prescription_id}`);
+  }
+}
+
+function watchChanges(service) {
+  if (changeWatches[service.name]) {
+    return;
+  }
+  const isRecords = service.name.startsWith('records');
+  const client = createGRPCClient(isRecords ? RecordService : PrescriptionService,
+    `${service.host}:${service.port}`, grpc.credentials.createInsecure());
+  // Offset of the last change seen, null until the first one arrives
+  const watch = { offset: null };
+  changeWatches[service.name] = watch;
+
+  const start = () => {
+    const request = watch.offset === null ? { from_now: true } : { after_offset: watch.offset };
+    const call = client.WatchChanges(request);
+    call.on('data', (change) => {
+      watch.offset = change.offset;
+      invalidateForChange(isRecords, change);
+    });
+    call.on('error', (error) => {
+      if (error.code === grpc.status.OUT_OF_RANGE) {
+        // Changes were missed, the affected entries expire with their TTL
+        watch.offset = null;
+      }
+    });
+    call.on('status', () => {
+      if (!registeredServices.some((s) => s.name === service.name)) {
+        delete changeWatches[service.name];
+        client.close();
+        return;
+      }
+      setTimeout(start, WATCH_RETRY_MILLISECONDS);
+    });
+  };
+  start();
+}
+
+// Expected wait for one more request on an instance: the calls ahead of it
+// times how long a call takes there, inflated when its CPU is busy. Instances
+// that report only `load` fall back to it with a 1ms latency.
+function serviceScore(service) {
+  const pending = (service.in_flight || 0) + (service.queue_depth || 0) || service.load || 0;
+  const latency = Math.max(service.latency_ms || 0, 1);
+  return (pending + 1) * latency * (1 + (service.cpu_percent || 0) / 100);
+}
+
+// Read replicas (read_only instances) only get reads, and only while their
+// data is at most this far behind the primary
+const MAX_REPLICA_STALENESS_MS = parseInt(process.env.MAX_REPLICA_STALENESS_MS || '5000');
+
+function selectService(services, serviceType, forWrite = false) {
   let selectedService = null;
-  let minLoad = Infinity;
+  let minScore = Infinity;
 
   for (const service of services) {
     
     if (errorCounts[service.name] >= MAX_ERROR_NUMBER) {
       continue; 
     }
+    if (service.read_only && (forWrite || !(service.staleness_ms <= MAX_REPLICA_STALENESS_MS))) {
+      continue;
+    }
 
-    if (service.name.startsWith(serviceType) && service.load < minLoad) {
+    const score = serviceScore(service);
+    if (service.name.startsWith(serviceType) && score < minScore) {
       selectedService = service;
-      minLoad = service.load;
+      minScore = score;
     }
   }
 
@@ -156,11 +250,16 @@ function selectService(services, serviceType) {
 function grpcRequestWithTimeout(client, method, request, timeoutMilliseconds) {
   return new Promise((resolve, reject) => {
     const deadline = new Date(Date.now() + timeoutMilliseconds);
+    const metadata = new grpc.Metadata();
+    const traceparent = traceContext.getStore();
+    if (traceparent) {
+      metadata.set('traceparent', traceparent);
+    }
 
-    client[method](request, { deadline }, (error, response) => {
+    client[method](request, metadata, { deadline }, (error, response) => {
       if (error) {
         console.error(error.details);
-        reject(error.details);
+        reject(error);
       } else {
         console.log(`Received gRPC response for ${method}: ${JSON.stringify(response)}`);
         resolve(response);
@@ -201,6 +300,11 @@ function getFromCacheOrFetchWithConsistentHashing(cacheKey, fetchFunction) {
 
 function handleRequestError(res, error, service, taskTimeoutLimit) {
   console.error(`Request failed for service ${service.name}: ${error}`);
+  if (service.read_only && error && error.code === grpc.status.UNAVAILABLE) {
+    // A replica that fell behind since its last report, which will keep it out of routing
+    res.status(503).set('Retry-After', '1').json({ error: 'Service Unavailable' });
+    return;
+  }
   res.status(500).json({ error: 'Internal Server Error' });
 
   // Increment the error count for the service
@@ -219,6 +323,101 @@ function handleRequestError(res, error, service, taskTimeoutLimit) {
   }, 3.5 * taskTimeoutLimit);
 }
 
+// Record and prescription versions are their ETags: GETs answer a matching
+// If-None-Match with 304, PUTs with an If-Match only apply to that version.
+function etagOf(response) {
+  return `"${response.version}"`;
+}
+
+function expectedVersion(req) {
+  const match = /^"?(\d+)"?$/.exec(req.get('If-Match') || '');
+  return match ? match[1] : '0';
+}
+
+// If-None-Match as the service's if_none_match, '0' when there is none
+function knownVersion(req) {
+  const match = /^(?:W\/)?"?(\d+)"?$/.exec(req.get('If-None-Match') || '');
+  return match ? match[1] : '0';
+}
+
+function sendWithETag(req, res, response) {
+  if (response.version) {
+    const etag = etagOf(response);
+    res.set('ETag', etag);
+    // not_modified: the service matched if_none_match and sent the version alone
+    if (response.not_modified || req.get('If-None-Match') === etag) {
+      res.status(304).end();
+      return;
+    }
+  }
+  res.json(response);
+}
+
+// ?fields=id,name becomes a read_mask, the service then only reads those columns
+function readMask(req) {
+  const { fields } = req.query;
+  return fields ? { paths: fields.split(',').filter(Boolean) } : null;
+}
+
+function handleUpdateError(res, error, service, taskTimeoutLimit) {
+  // A version mismatch is the client's stale copy, not a service failure
+  if (error && error.code === grpc.status.ABORTED) {
+    res.status(412).json({ error: error.details });
+  } else {
+    handleQueryError(res, error, service, taskTimeoutLimit);
+  }
+}
+
+// Full-text search over names and medical histories, best match first
+app.get('/records/search', (req, res) => {
+  listRegisteredServices()
+    .then((services) => {
+      const requestPath = req.path.split('/')[1];
+      const selectedService = selectService(services, requestPath);
+      if (selectedService) {
+        const { host, port } = selectedService;
+        const client = createGRPCClient(RecordService, `${host}:${port}`, grpc.credentials.createInsecure());
+        const timeoutMilliseconds = 5000; // 5 seconds
+
+        const { q, page_size, page_token } = req.query;
+        const request = { query: q || '', page_size: parseInt(page_size) || 0, page_token: page_token || '', read_mask: readMask(req) };
+
+        limit(() => grpcRequestWithTimeout(client, 'SearchRecords', request, timeoutMilliseconds))
+          .then((response) => res.json(response))
+          .catch((error) => handleQueryError(res, error, selectedService, timeoutMilliseconds));
+      } else {
+        res.status(500).json({ error: 'No available service for the request' });
+      }
+    })
+    .catch((error) => {
+      console.error('Failed to retrieve registered services:', error);
+      res.status(500).json({ error: 'Failed to retrieve registered services' });
+    });
+});
+
+function handleQueryError(res, error, service, taskTimeoutLimit) {
+  // A query, filter, page token or record id the service cannot use is the client's mistake
+  if (error && error.code === grpc.status.INVALID_ARGUMENT) {
+    res.status(400).json({ error: error.details });
+  } else {
+    handleRequestError(res, error, service, taskTimeoutLimit);
+  }
+}
+
+// ?updated_since= as an ISO 8601 date or milliseconds since the epoch, a
+// google.protobuf.Timestamp; undefined when absent, null when invalid
+function updatedSince(req) {
+  const { updated_since } = req.query;
+  if (!updated_since) {
+    return undefined;
+  }
+  const milliseconds = /^\d+$/.test(updated_since) ? Number(updated_since) : Date.parse(updated_since);
+  if (Number.isNaN(milliseconds)) {
+    return null;
+  }
+  return { seconds: Math.floor(milliseconds / 1000), nanos: (milliseconds % 1000) * 1000000 };
+}
+
 app.get('/records/:record_id', (req, res) => {
   listRegisteredServices()
     .then((services) => {
@@ -230,16 +429,20 @@ app.get('/records/:record_id', (req, res) => {
         const client = createGRPCClient(RecordService, `${host}:${port}`, grpc.credentials.createInsecure());
         const timeoutMilliseconds = 5000;
         const cacheKey = `getRecordInfo:${record_id}`;
-
-        limit(() => getFromCacheOrFetchWithConsistentHashing(cacheKey, () =>
-          grpcRequestWithTimeout(client, 'GetRecordInfo', { record_id }, timeoutMilliseconds)
-        ))
+        const read_mask = readMask(req);
+        const if_none_match = knownVersion(req);
+        const fetchRecord = () => grpcRequestWithTimeout(client, 'GetRecordInfo', { record_id, read_mask, if_none_match }, timeoutMilliseconds);
+
+        // Only complete records are cached, those are what writes invalidate.
+        // Conditional GETs go to the service, which answers a match without the record.
+        const cacheable = !read_mask && if_none_match === '0';
+        limit(() => cacheable ? getFromCacheOrFetchWithConsistentHashing(cacheKey, fetchRecord) : fetchRecord())
           .then((response) => {
             console.log(`Active tasks: ${limit.activeCount}`);
             console.log(`Pending tasks: ${limit.pendingCount}`);
-            res.json(response);
+            sendWithETag(req, res, response);
           })
-          .catch((error) => handleRequestError(res, error, selectedService, timeoutMilliseconds));
+          .catch((error) => handleQueryError(res, error, selectedService, timeoutMilliseconds));
       } else {
         res.status(500).json({ error: 'No available service for the request' });
       }
@@ -264,11 +467,27 @@ app.get('/records', (req, res) => {
         console.log(`Active tasks: ${limit.activeCount}`);
         console.log(`Pending tasks: ${limit.pendingCount}`);
 
-        limit(() => getFromCacheOrFetchWithConsistentHashing('listRecords', () =>
-          grpcRequestWithTimeout(client, 'ListRecords', {}, timeoutMilliseconds)
-        ))
+        const { page_size, page_token, name_prefix, min_id, max_id } = req.query;
+        const read_mask = readMask(req);
+        const updated_since = updatedSince(req);
+        if (updated_since === null) {
+          res.status(400).json({ error: 'updated_since must be an ISO 8601 date or milliseconds since the epoch' });
+          return;
+        }
+        const filtered = name_prefix || min_id || max_id || updated_since;
+        const request = {
+          page_size: parseInt(page_size) || 0, page_token: page_token || '', read_mask,
+          name_prefix: name_prefix || '', min_id: min_id || '', max_id: max_id || '', updated_since,
+        };
+        const fetchPage = () => grpcRequestWithTimeout(client, 'ListRecords', request, timeoutMilliseconds);
+
+        // Only the default first page is cached, it is the one invalidated on create
+        limit(() => (page_size || page_token || read_mask || filtered)
+          ? fetchPage()
+          : getFromCacheOrFetchWithConsistentHashing('listRecords', fetchPage)
+        )
           .then((response) => res.json(response))
-          .catch((error) => handleRequestError(res, error, selectedService, timeoutMilliseconds));
+          .catch((error) => handleQueryError(res, error, selectedService, timeoutMilliseconds));
       } else {
         res.status(500).json({ error: 'No available service for the request' });
       }
@@ -285,7 +504,7 @@ app.post('/records', (req, res) => {
     .then((services) => {
       const { name, medical_history } = req.body;
       const requestPath = req.path.split('/')[1];
-      const selectedService = selectService(services, requestPath);
+      const selectedService = selectService(services, requestPath, true);
       if (selectedService) {
         const { host, port } = selectedService;
         const client = createGRPCClient(RecordService, `${host}:${port}`, grpc.credentials.createInsecure());
@@ -317,9 +536,9 @@ app.put('/records/:record_id', (req, res) => {
     .then((services) => {
       const { record_id } = req.params;
       const { updated_medical_history } = req.body;
-      const request = { record_id, updated_medical_history };
+      const request = { record_id, updated_medical_history, expected_version: expectedVersion(req) };
       const requestPath = req.path.split('/')[1];
-      const selectedService = selectService(services, requestPath);
+      const selectedService = selectService(services, requestPath, true);
       if (selectedService) {
         const { host, port } = selectedService;
         const client = createGRPCClient(RecordService, `${host}:${port}`, grpc.credentials.createInsecure());
@@ -332,9 +551,42 @@ app.put('/records/:record_id', (req, res) => {
         limit(() => grpcRequestWithTimeout(client, 'UpdateRecordInfo', request, timeoutMilliseconds))
         .then((response) => {
           deleteFromCacheWithConsistentHashing(`getRecordInfo:${record_id}`);
+          res.set('ETag', etagOf(response));
           res.json(response);
         })
-          .catch((error) => handleRequestError(res, error, selectedService, timeoutMilliseconds));
+          .catch((error) => handleUpdateError(res, error, selectedService, timeoutMilliseconds));
+      } else {
+        res.status(500).json({ error: 'No available service for the request' });
+      }
+    })
+    .catch((error) => {
+      console.error('Failed to retrieve registered services:', error);
+      res.status(500).json({ error: 'Failed to retrieve registered services' });
+    });
+});
+
+// Append an entry to a record's medical history
+app.post('/records/:record_id/history', (req, res) => {
+  listRegisteredServices()
+    .then((services) => {
+      const { record_id } = req.params;
+      const { entry } = req.body;
+      const request = { record_id, entry, expected_version: expectedVersion(req) };
+      const requestPath = req.path.split('/')[1];
+      const selectedService = selectService(services, requestPath, true);
+      if (selectedService) {
+        const { host, port } = selectedService;
+        const client = createGRPCClient(RecordService, `${host}:${port}`, grpc.credentials.createInsecure());
+        const timeoutMilliseconds = 5000; // 5 seconds
+
+        limit(() => grpcRequestWithTimeout(client, 'AppendMedicalHistory', request, timeoutMilliseconds))
+        .then((response) => {
+          deleteFromCacheWithConsistentHashing(`getRecordInfo:${record_id}`);
+          deleteFromCacheWithConsistentHashing('listRecords');
+          res.set('ETag', etagOf(response));
+          res.json(response);
+        })
+          .catch((error) => handleUpdateError(res, error, selectedService, timeoutMilliseconds));
       } else {
         res.status(500).json({ error: 'No available service for the request' });
       }
@@ -352,7 +604,7 @@ app.delete('/records/:record_id', (req, res) => {
       const { record_id } = req.params;
       const request = { record_id };
       const requestPath = req.path.split('/')[1];
-      const selectedService = selectService(services, requestPath);
+      const selectedService = selectService(services, requestPath, true);
       if (selectedService) {
         const { host, port } = selectedService;
         const client = createGRPCClient(RecordService, `${host}:${port}`, grpc.credentials.createInsecure());
@@ -368,7 +620,7 @@ app.delete('/records/:record_id', (req, res) => {
             deleteFromCacheWithConsistentHashing(`getRecordInfo:${record_id}`);
             res.json(`Successfully deleted record with ID: ${record_id}`);
           })
-          .catch((error) => handleRequestError(res, error, selectedService, timeoutMilliseconds));
+          .catch((error) => handleQueryError(res, error, selectedService, timeoutMilliseconds));
       } else {
         res.status(500).json({ error: 'No available service for the request' });
       }
@@ -385,7 +637,7 @@ app.post('/prescriptions', (req, res) => {
       const { medication } = req.body;
       const request = { medication };
       const requestPath = req.path.split('/')[1];
-      const selectedService = selectService(services, requestPath);
+      const selectedService = selectService(services, requestPath, true);
       if (selectedService) {
         const { host, port } = selectedService;
         const client = createGRPCClient(PrescriptionService, `${host}:${port}`, grpc.credentials.createInsecure());
@@ -407,11 +659,42 @@ app.post('/prescriptions', (req, res) => {
     });
 });
 
+// Prescriptions by id, or filtered by ?medication= or ?medication_prefix=
+app.get('/prescriptions', (req, res) => {
+  listRegisteredServices()
+    .then((services) => {
+      const requestPath = req.path.split('/')[1];
+      const selectedService = selectService(services, requestPath);
+      if (selectedService) {
+        const { host, port } = selectedService;
+        const client = createGRPCClient(PrescriptionService, `${host}:${port}`, grpc.credentials.createInsecure());
+        const timeoutMilliseconds = 5000; // 5 seconds
+
+        const { page_size, page_token, medication, medication_prefix } = req.query;
+        const request = {
+          page_size: parseInt(page_size) || 0, page_token: page_token || '',
+          medication: medication || '', medication_prefix: medication_prefix || '',
+        };
+
+        limit(() => grpcRequestWithTimeout(client, 'ListPrescriptions', request, timeoutMilliseconds))
+          .then((response) => res.json(response))
+          .catch((error) => handleQueryError(res, error, selectedService, timeoutMilliseconds));
+      } else {
+        res.status(500).json({ error: 'No available service for the request' });
+      }
+    })
+    .catch((error) => {
+      console.error('Failed to retrieve registered services:', error);
+      res.status(500).json({ error: 'Failed to retrieve registered services' });
+    });
+});
+
 app.get('/prescriptions/:prescription_id', (req, res) => {
   listRegisteredServices()
     .then((services) => {
       const { prescription_id } = req.params;
-      const request = { prescription_id };
+      const if_none_match = knownVersion(req);
+      const request = { prescription_id, if_none_match };
       const requestPath = req.path.split('/')[1];
       const selectedService = selectService(services, requestPath);
       if (selectedService) {
@@ -423,11 +706,12 @@ app.get('/prescriptions/:prescription_id', (req, res) => {
         console.log(`Active tasks: ${limit.activeCount}`);
         console.log(`Pending tasks: ${limit.pendingCount}`);
 
-        limit(() => getFromCacheOrFetchWithConsistentHashing(cacheKey, () =>
-          grpcRequestWithTimeout(client, 'GetPrescription', request, timeoutMilliseconds)
-        ))
-          .then((response) => res.json(response))
-          .catch((error) => handleRequestError(res, error, selectedService, timeoutMilliseconds));
+        const fetchPrescription = () => grpcRequestWithTimeout(client, 'GetPrescription', request, timeoutMilliseconds);
+
+        // Conditional GETs go to the service, which answers a match without the prescription
+        limit(() => if_none_match === '0' ? getFromCacheOrFetchWithConsistentHashing(cacheKey, fetchPrescription) : fetchPrescription())
+          .then((response) => sendWithETag(req, res, response))
+          .catch((error) => handleQueryError(res, error, selectedService, timeoutMilliseconds));
       } else {
         res.status(500).json({ error: 'No available service for the request' });
       }
@@ -443,9 +727,9 @@ app.put('/prescriptions/:prescription_id', (req, res) => {
     .then((services) => {
       const { prescription_id } = req.params;
       const { updated_medication } = req.body;
-      const request = { prescription_id, updated_medication };
+      const request = { prescription_id, updated_medication, expected_version: expectedVersion(req) };
       const requestPath = req.path.split('/')[1];
-      const selectedService = selectService(services, requestPath);
+      const selectedService = selectService(services, requestPath, true);
       if (selectedService) {
         const { host, port } = selectedService;
         const client = createGRPCClient(PrescriptionService, `${host}:${port}`, grpc.credentials.createInsecure());
@@ -457,9 +741,10 @@ app.put('/prescriptions/:prescription_id', (req, res) => {
         limit(() => grpcRequestWithTimeout(client, 'UpdatePrescription', request, timeoutMilliseconds))
         .then((response) => {
           deleteFromCacheWithConsistentHashing(`getPrescription:${prescription_id}`);
+          res.set('ETag', etagOf(response));
           res.json(response);
         })
-          .catch((error) => handleRequestError(res, error, selectedService, timeoutMilliseconds));
+          .catch((error) => handleUpdateError(res, error, selectedService, timeoutMilliseconds));
       } else {
         res.status(500).json({ error: 'No available service for the request' });
       }
@@ -476,7 +761,7 @@ app.delete('/prescriptions/:prescription_id', (req, res) => {
       const { prescription_id } = req.params;
       const request = { prescription_id };
       const requestPath = req.path.split('/')[1];
-      const selectedService = selectService(services, requestPath);
+      const selectedService = selectService(services, requestPath, true);
       if (selectedService) {
         const { host, port } = selectedService;
         const client = createGRPCClient(PrescriptionService, `${host}:${port}`, grpc.credentials.createInsecure());
@@ -491,7 +776,7 @@ app.delete('/prescriptions/:prescription_id', (req, res) => {
             deleteFromCacheWithConsistentHashing(`getPrescription:${prescription_id}`);
             res.json(`Successfully deleted prescription with ID: ${prescription_id}`);
           })
-          .catch((error) => handleRequestError(res, error, selectedService, timeoutMilliseconds));
+          .catch((error) => handleQueryError(res, error, selectedService, timeoutMilliseconds));
       } else {
         res.status(500).json({ error: 'No available service for the request' });
       }
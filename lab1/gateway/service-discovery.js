@@ -23,12 +23,14 @@ const serviceHeartbeats = {};
 const HEARTBEAT_TIMEOUT = 6000;
 
 const serviceLoad = {};
+// Latest in_flight, queue_depth, latency_ms, cpu_percent and, read replicas, staleness_ms of each instance
+const serviceStatus = {};
 const CRITICAL_LOAD_THRESHOLD = 60;
 
 // Implement the service registration function
-function register(name, host, port) {
+function register(name, host, port, read_only) {
   if(!deletedServices[`${name}:${port}`]){
-    registeredServices[`${name}:${port}`] = { host, port };
+    registeredServices[`${name}:${port}`] = { host, port, read_only };
     console.log(`Service ${name}:${port} registered in the gateway`);
   } else {
     reRegister(name, port);
@@ -130,7 +132,7 @@ function checkServiceStatus() {
 // Service function for registration
 function RegisterService(call, callback) {
   const registrationInfo = call.request;
-  register(registrationInfo.name, registrationInfo.host, registrationInfo.port);
+  register(registrationInfo.name, registrationInfo.host, registrationInfo.port, registrationInfo.read_only);
   console.log(`Received registration: Name: ${registrationInfo.name}, Host: ${registrationInfo.host}, Port: ${registrationInfo.port}`);
   console.log(registeredServices);
   callback(null, {});
@@ -139,8 +141,8 @@ function RegisterService(call, callback) {
 // Service function for de-registration
 function DeregisterService(call, callback) {
   const deregistrationInfo = call.request;
-  deregister(deregistrationInfo.service_name);
-  console.log(`Received de-registration: Name: ${deregistrationInfo.service_name}, Host: ${deregistrationInfo.host}, Port: ${deregistrationInfo.port}`);
+  deregister(`${deregistrationInfo.name}:${deregistrationInfo.port}`);
+  console.log(`Received de-registration: Name: ${deregistrationInfo.name}, Host: ${deregistrationInfo.host}, Port: ${deregistrationInfo.port}`);
   callback(null, {});
 }
 
@@ -150,7 +152,17 @@ function UpdateServiceStatus(call, callback) {
   // const serviceName = request.service_name;
   // console.log(request.load);
   updateLoad(request.service_name, request.port, request.load);
+  serviceStatus[`${request.service_name}:${request.port}`] = {
+    in_flight: request.in_flight,
+    queue_depth: request.queue_depth,
+    latency_ms: request.latency_ms,
+    cpu_percent: request.cpu_percent,
+    staleness_ms: request.staleness_ms,
+  };
   checkCriticalLoad(request.service_name, request.port);
+  // A status update is also a heartbeat, services send only this one
+  updateHeartbeat(request.service_name, request.port);
+  reRegister(request.service_name, request.port);
   callback(null, {});
 }
 
@@ -169,7 +181,9 @@ function ListRegisteredServices(call, callback) {
     name,
     host: registeredServices[name].host,
     port: registeredServices[name].port,
+    read_only: registeredServices[name].read_only || false,
     load: serviceLoad[name] || 0,
+    ...serviceStatus[name],
   }));
   
   const response = {
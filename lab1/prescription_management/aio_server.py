@@ -0,0 +1,288 @@
+import asyncio
+import threading
+
+import grpc
+from prometheus_client import REGISTRY
+from py_grpc_prometheus import grpc_utils, server_metrics
+
+# Shared by the records and prescription services, keep both copies in sync.
+#
+# Serves an existing (blocking) servicer from a grpc.aio server. Every RPC
+# becomes a coroutine on the event loop and the servicer method itself runs on
+# a bounded executor, so SQLite calls never block the loop. Calls waiting for
+# the executor cost a coroutine rather than a thread, but the database work
+# is as capped by the worker count as in threads mode.
+#
+# This is an interim step: the whole handler runs on the executor, not just
+# its SQLite work, and every call (every message of a stream) takes two
+# thread hops on top of what threads mode does, so SERVER_MODE=aio serves
+# fewer calls a second than threads mode for now (benchmark_server_modes.py).
+# Servicers with native async def methods, handing only their queries to the
+# executor, are what would make it pay off.
+
+# grpc.aio contexts give the status code as its number
+STATUS_CODES = {code.value[0]: code for code in grpc.StatusCode}
+
+_DONE = object()
+
+
+class _Abort(Exception):
+    def __init__(self, code, details):
+        super().__init__(details)
+        self.code = code
+        self.details = details
+
+
+class SyncContext:
+    """The grpc.ServicerContext surface the blocking servicers and interceptors use.
+
+    Made on the event loop, used from worker threads. The aio context is not
+    thread-safe: status is recorded here and copied to it on the loop once
+    the handler returns, the call's metadata is read up front, and the rest
+    (compression) is handed to the loop with call_soon_threadsafe, which runs
+    it before the loop sends the response the worker produces next. abort()
+    raises so the handler unwinds in its worker thread.
+    """
+
+    def __init__(self, context, loop):
+        self._context = context
+        self._loop = loop
+        self._code = None
+        self._details = None
+        self._metadata = context.invocation_metadata()
+        self._done = threading.Event()
+        context.add_done_callback(lambda _: self._done.set())
+
+    def set_code(self, code):
+        self._code = code
+
+    def set_details(self, details):
+        self._details = details
+
+    def code(self):
+        return self._code
+
+    def abort(self, code, details):
+        raise _Abort(code, details)
+
+    def is_active(self):
+        return not self._done.is_set()
+
+    def finish(self):
+        # On the loop when the handler ends or is cancelled: a stream the
+        # caller cancelled otherwise keeps its worker until it sees is_active()
+        self._done.set()
+
+    def invocation_metadata(self):
+        return self._metadata
+
+    def set_compression(self, compression):
+        self._loop.call_soon_threadsafe(self._context.set_compression, compression)
+
+    def disable_next_message_compression(self):
+        self._loop.call_soon_threadsafe(self._context.disable_next_message_compression)
+
+    def apply(self):
+        if self._code is not None:
+            self._context.set_code(self._code)
+        if self._details is not None:
+            self._context.set_details(self._details)
+
+
+def _sync_iterator(request_iterator, loop):
+    # Pulls messages of an aio request stream from a worker thread
+    async_iterator = request_iterator.__aiter__()
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(async_iterator.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
+class _Capture:
+    def __init__(self):
+        self.handlers = []
+
+    def add_generic_rpc_handlers(self, handlers):
+        self.handlers.extend(handlers)
+
+
+class AsyncServicerAdapter(grpc.GenericRpcHandler):
+    """Generic handler exposing a blocking servicer to a grpc.aio server.
+
+        server.add_generic_rpc_handlers((AsyncServicerAdapter(
+            records_pb2_grpc.add_RecordServiceServicer_to_server, RecordService(), executor),))
+
+    `interceptors` are regular grpc.ServerInterceptors, applied around the
+    blocking handlers per call just as grpc.server would.
+    """
+
+    def __init__(self, add_servicer_to_server, servicer, executor, interceptors=()):
+        capture = _Capture()
+        add_servicer_to_server(servicer, capture)
+        self._handlers = capture.handlers
+        self._executor = executor
+        self._interceptors = tuple(interceptors)
+        self._found = {}
+        self._cache = {}
+
+    def service(self, handler_call_details):
+        if self._interceptors:
+            # Interceptors may wrap every call differently, only the lookup is cached
+            method_handler = self._intercept(handler_call_details, 0)
+            return self._wrap(method_handler) if method_handler is not None else None
+
+        method = handler_call_details.method
+        if method not in self._cache:
+            method_handler = self._find(handler_call_details)
+            self._cache[method] = self._wrap(method_handler) if method_handler is not None else None
+        return self._cache[method]
+
+    def _intercept(self, handler_call_details, index):
+        if index == len(self._interceptors):
+            return self._find(handler_call_details)
+        return self._interceptors[index].intercept_service(
+            lambda details: self._intercept(details, index + 1), handler_call_details)
+
+    def _find(self, handler_call_details):
+        method = handler_call_details.method
+        if method not in self._found:
+            self._found[method] = None
+            for handler in self._handlers:
+                method_handler = handler.service(handler_call_details)
+                if method_handler is not None:
+                    self._found[method] = method_handler
+                    break
+        return self._found[method]
+
+    def _wrap(self, method_handler):
+        if method_handler.unary_unary:
+            return method_handler._replace(unary_unary=self._unary_response(method_handler.unary_unary, False))
+        if method_handler.stream_unary:
+            return method_handler._replace(stream_unary=self._unary_response(method_handler.stream_unary, True))
+        if method_handler.unary_stream:
+            return method_handler._replace(unary_stream=self._stream_response(method_handler.unary_stream, False))
+        return method_handler._replace(stream_stream=self._stream_response(method_handler.stream_stream, True))
+
+    def _unary_response(self, behavior, request_streaming):
+        executor = self._executor
+
+        async def handler(request, context):
+            loop = asyncio.get_running_loop()
+            if request_streaming:
+                request = _sync_iterator(request, loop)
+            sync_context = SyncContext(context, loop)
+            try:
+                response = await loop.run_in_executor(executor, behavior, request, sync_context)
+            except _Abort as e:
+                await context.abort(e.code, e.details)
+            finally:
+                sync_context.finish()
+            sync_context.apply()
+            return response
+
+        return handler
+
+    def _stream_response(self, behavior, request_streaming):
+        executor = self._executor
+
+        async def handler(request, context):
+            loop = asyncio.get_running_loop()
+            if request_streaming:
+                request = _sync_iterator(request, loop)
+            sync_context = SyncContext(context, loop)
+            responses = iter(behavior(request, sync_context))
+            try:
+                while True:
+                    response = await loop.run_in_executor(executor, next, responses, _DONE)
+                    if response is _DONE:
+                        break
+                    yield response
+            except _Abort as e:
+                await context.abort(e.code, e.details)
+            finally:
+                sync_context.finish()
+                # Runs the servicer's own cleanup if the client went away early
+                close = getattr(responses, "close", None)
+                if close:
+                    await loop.run_in_executor(executor, close)
+            sync_context.apply()
+
+        return handler
+
+
+async def _count_messages(messages, counter):
+    async for message in messages:
+        counter.inc()
+        yield message
+
+
+class PromAioServerInterceptor(grpc.aio.ServerInterceptor):
+    """The metrics py_grpc_prometheus' PromServerInterceptor keeps, for grpc.aio servers.
+
+    PromServerInterceptor reads the call's status off grpc.server's context,
+    which grpc.aio's has no equivalent of. Calls are counted as it counts
+    them: grpc_server_started_total for calls with a single request, message
+    counts for streams, and grpc_server_handled_total, by status code, for
+    calls with a single response. Only one of the two may register its
+    metrics with a registry.
+    """
+
+    def __init__(self, registry=REGISTRY):
+        self._metrics = server_metrics.init_metrics(registry)
+        self._handled = server_metrics.get_grpc_server_handled_counter(False, registry)
+
+    def _wrap(self, behavior, labels, request_streaming):
+        metrics = self._metrics
+
+        async def counted(request_or_iterator, context):
+            if request_streaming:
+                request_or_iterator = _count_messages(
+                    request_or_iterator, metrics["grpc_server_stream_msg_received"].labels(**labels))
+            else:
+                metrics["grpc_server_started_counter"].labels(**labels).inc()
+            code = grpc.StatusCode.UNKNOWN
+            try:
+                response = await behavior(request_or_iterator, context)
+                code = STATUS_CODES.get(context.code() or 0, code)
+                return response
+            except grpc.aio.AbortError:
+                code = STATUS_CODES.get(context.code(), code)
+                raise
+            except asyncio.CancelledError:
+                code = grpc.StatusCode.CANCELLED
+                raise
+            finally:
+                self._handled.labels(grpc_code=code.name, **labels).inc()
+        return counted
+
+    def _wrap_stream(self, behavior, labels, request_streaming):
+        metrics = self._metrics
+
+        async def counted(request_or_iterator, context):
+            if request_streaming:
+                request_or_iterator = _count_messages(
+                    request_or_iterator, metrics["grpc_server_stream_msg_received"].labels(**labels))
+            else:
+                metrics["grpc_server_started_counter"].labels(**labels).inc()
+            sent = metrics["grpc_server_stream_msg_sent"].labels(**labels)
+            async for response in behavior(request_or_iterator, context):
+                sent.inc()
+                yield response
+        return counted
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        service, method, _ = grpc_utils.split_method_call(handler_call_details)
+        labels = {"grpc_type": grpc_utils.get_method_type(handler.request_streaming, handler.response_streaming),
+                  "grpc_service": service, "grpc_method": method}
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=self._wrap(handler.unary_unary, labels, False))
+        if handler.stream_unary:
+            return handler._replace(stream_unary=self._wrap(handler.stream_unary, labels, True))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=self._wrap_stream(handler.unary_stream, labels, False))
+        return handler._replace(stream_stream=self._wrap_stream(handler.stream_stream, labels, True))
@@ -0,0 +1,122 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import grpc
+
+# Shared by the records and prescription services, keep both copies in sync.
+#
+# Every insert, update and delete on a table is appended to a change log
+# table by triggers, so the entry commits in the same transaction as the
+# change itself whichever code path (or process) made it. Offsets are the
+# AUTOINCREMENT seq of the log: never reused, and since SQLite has a single
+# writer their order is commit order.
+
+# Values of the ChangeOp enum in records.proto and prescription.proto
+CREATED = 1
+UPDATED = 2
+DELETED = 3
+
+
+def create_change_log(connection, table, changes_table, id_column, retention):
+    """Create the log table and triggers for `table`, keeping the last `retention` entries.
+
+    `table` needs a version column, each entry records the version the row
+    got (one past the last one for deletes). Updates that keep the version,
+    such as rewriting a row's storage format, are not logged.
+    """
+    connection.executescript(f'''
+        CREATE TABLE IF NOT EXISTS {changes_table} (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            op INTEGER NOT NULL,
+            {id_column} INTEGER NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+    ''')
+    columns = [row[1] for row in connection.execute(f"PRAGMA table_info({changes_table})")]
+    if "version" not in columns:
+        connection.execute(f"ALTER TABLE {changes_table} ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    # Triggers are recreated on every start so changed definitions and a new
+    # retention take effect
+    connection.executescript(f'''
+        DROP TRIGGER IF EXISTS {table}_insert_change;
+        CREATE TRIGGER {table}_insert_change AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO {changes_table} (op, {id_column}, version) VALUES ({CREATED}, NEW.id, NEW.version);
+        END;
+        DROP TRIGGER IF EXISTS {table}_update_change;
+        CREATE TRIGGER {table}_update_change AFTER UPDATE ON {table}
+        WHEN NEW.version != OLD.version
+        BEGIN
+            INSERT INTO {changes_table} (op, {id_column}, version) VALUES ({UPDATED}, NEW.id, NEW.version);
+        END;
+        DROP TRIGGER IF EXISTS {table}_delete_change;
+        CREATE TRIGGER {table}_delete_change AFTER DELETE ON {table}
+        BEGIN
+            INSERT INTO {changes_table} (op, {id_column}, version) VALUES ({DELETED}, OLD.id, OLD.version + 1);
+        END;
+        DROP TRIGGER IF EXISTS {changes_table}_retention;
+        CREATE TRIGGER {changes_table}_retention AFTER INSERT ON {changes_table}
+        WHEN NEW.seq % 1000 = 0
+        BEGIN
+            DELETE FROM {changes_table} WHERE seq <= NEW.seq - {int(retention)};
+        END;
+    ''')
+
+
+class WatcherSlots:
+    """Caps the long-lived change streams (WatchChanges, Replicate) served at once.
+
+    A stream holds its server thread for as long as the caller keeps it
+    open, so the services add `limit` threads to their MAX_WORKERS for
+    streams. Callers past the limit get RESOURCE_EXHAUSTED rather than one
+    of the threads unary calls need, and retry.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._slots = threading.BoundedSemaphore(limit)
+
+    @contextmanager
+    def hold(self, context):
+        if not self._slots.acquire(blocking=False):
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, f"At most {self.limit} change streams at once, retry.")
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+
+def log_bounds(connection, changes_table):
+    """The first offset still retained and the last one, first is last + 1 when the log is empty."""
+    first = connection.execute(f"SELECT MIN(seq) FROM {changes_table}").fetchone()[0]
+    last = connection.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (changes_table,)).fetchone()
+    last = last[0] if last else 0
+    return (first if first is not None else last + 1), last
+
+
+def watch_changes(pool, changes_table, id_column, after_offset, from_now, context, poll_interval=0.2, chunk_size=500):
+    """Yield (offset, op, id, version) log entries after after_offset, then wait for new ones.
+
+    Runs until the client goes away, holding its worker thread meanwhile:
+    serve it within a WatcherSlots slot. Aborts with OUT_OF_RANGE when entries after after_offset were already
+    pruned, the client has to reload everything and watch from_now.
+    """
+    with pool.connection() as connection:
+        first, last = log_bounds(connection, changes_table)
+    if from_now:
+        after_offset = last
+    elif after_offset < first - 1:
+        context.abort(grpc.StatusCode.OUT_OF_RANGE, f"Changes after offset {after_offset} are no longer retained.")
+
+    while context.is_active():
+        with pool.connection() as connection:
+            rows = connection.execute(
+                f"SELECT seq, op, {id_column}, version FROM {changes_table} WHERE seq > ? ORDER BY seq LIMIT ?",
+                (after_offset, chunk_size)
+            ).fetchall()
+        yield from rows
+        if rows:
+            after_offset = rows[-1][0]
+        if len(rows) < chunk_size:
+            time.sleep(poll_interval)
@@ -0,0 +1,370 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+import weakref
+from concurrent import futures
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from prometheus_client import Gauge, Histogram
+
+import stage_metrics
+import tracing
+
+# Shared by the records and prescription services, keep both copies in sync.
+
+POOL_SIZE = Gauge(
+    "sqlite_pool_size",
+    "Maximum number of SQLite connections the pool will open",
+    ["database"],
+    multiprocess_mode="livesum",
+)
+POOL_CONNECTIONS = Gauge(
+    "sqlite_pool_connections",
+    "SQLite connections currently bound to worker threads",
+    ["database"],
+    multiprocess_mode="livesum",
+)
+POOL_WAIT_SECONDS = Histogram(
+    "sqlite_pool_wait_seconds",
+    "Time a worker thread waited for a free connection slot",
+    ["database"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+WRITE_QUEUE_DEPTH = Gauge(
+    "sqlite_write_queue_depth",
+    "Writes waiting for the single writer thread",
+    ["database"],
+    multiprocess_mode="livesum",
+)
+WRITE_BATCH_SIZE = Histogram(
+    "sqlite_write_batch_size",
+    "Number of writes group-committed in one transaction",
+    ["database"],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+
+# Applied to every connection in "wal" mode. journal_mode is persistent in
+# the database file, the others are per connection.
+WAL_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Stay under SQLITE_MAX_VARIABLE_NUMBER, which is 999 before SQLite 3.32
+MAX_PARAMETERS = 500
+
+
+def batched(values, size=MAX_PARAMETERS):
+    """Split values into lists small enough for one "IN (?, ...)" clause."""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def placeholders(count):
+    return ", ".join("?" * count)
+
+
+def like_prefix(prefix):
+    """A LIKE pattern, with ESCAPE '\\', matching values that start with prefix.
+
+    Against a column indexed COLLATE NOCASE the LIKE becomes a range search
+    on that index, ignoring ASCII case like LIKE does.
+    """
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def connection_factory():
+    # Tracing times the stages too
+    if tracing.enabled():
+        return tracing.TracedConnection
+    return stage_metrics.TimedConnection if stage_metrics.ENABLED else sqlite3.Connection
+
+
+def connect(database, mode="rollback", cached_statements=256, **kwargs):
+    connection = sqlite3.connect(
+        database,
+        check_same_thread=False,
+        cached_statements=cached_statements,
+        factory=connection_factory(),
+        **kwargs
+    )
+    if mode == "wal":
+        for pragma in WAL_PRAGMAS:
+            connection.execute(pragma)
+    return connection
+
+
+class SingleWriter:
+    """Runs every write on one dedicated connection and thread.
+
+    Queued writes are drained in batches and group-committed in a single
+    transaction. Each write gets its own savepoint, so one failing statement
+    only rolls back itself and does not poison the rest of the batch.
+
+    Should the thread fail (it cannot connect, a rollback fails) it fails
+    every pending write, and any submitted later, with the error.
+    """
+
+    def __init__(self, database, max_batch=100, cached_statements=256):
+        self.database = database
+        self.max_batch = max_batch
+        self.cached_statements = cached_statements
+        self._label = os.path.basename(database)
+        self._queue = queue.Queue()
+        # Guards closed, so nothing is queued after the thread stops reading
+        self._lock = threading.Lock()
+        self.closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name=f"sqlite-writer-{self._label}", daemon=True)
+        self._thread.start()
+
+    def submit(self, write):
+        future = Future()
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            if self.closed:
+                raise RuntimeError(f"Writer for {self.database} is closed")
+            # The writer thread reports the stages and spans of each write for its caller
+            self._queue.put((tracing.propagate(stage_metrics.propagate(write)), future, stage_metrics.current_method()))
+            WRITE_QUEUE_DEPTH.labels(self._label).inc()
+        return future
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                self.closed = True
+                self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        connection = None
+        batch = []
+        try:
+            # isolation_level=None: transactions are managed explicitly below
+            connection = connect(self.database, "wal", self.cached_statements, isolation_level=None)
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                WRITE_QUEUE_DEPTH.labels(self._label).dec(len(batch))
+                WRITE_BATCH_SIZE.labels(self._label).observe(len(batch))
+                self._commit(connection, batch)
+        except Exception as e:
+            self._fail(batch, e)
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def _fail(self, batch, error):
+        with self._lock:
+            self.closed = True
+            self._error = error
+        # Nothing is queued once closed, so this drains every pending write
+        queued = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                queued.append(item)
+        WRITE_QUEUE_DEPTH.labels(self._label).dec(len(queued))
+        for _, future, _ in batch + queued:
+            # The batch's writes that were committed keep their outcome
+            if not future.done():
+                future.set_exception(error)
+
+    def _commit(self, connection, batch):
+        outcomes = []
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for write, future, _ in batch:
+                connection.execute("SAVEPOINT write")
+                try:
+                    outcomes.append((future, write(connection), None))
+                    connection.execute("RELEASE write")
+                except Exception as e:
+                    connection.execute("ROLLBACK TO write")
+                    connection.execute("RELEASE write")
+                    outcomes.append((future, None, e))
+            start = time.perf_counter()
+            connection.execute("COMMIT")
+        except Exception as e:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        if stage_metrics.ENABLED:
+            committed = time.perf_counter() - start
+            for _, _, method in batch:
+                stage_metrics.observe("commit", committed, method)
+
+        # Only acknowledge once the whole batch is durable
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+class ConnectionPool:
+    """Hands every worker thread its own long-lived SQLite connection.
+
+    A connection is opened the first time a thread asks for one and is reused
+    for every later request served by that thread, so sqlite3's per-connection
+    statement cache keeps the prepared statements alive between calls. At most
+    `max_size` connections are open at once; extra threads wait for a slot.
+
+    In "wal" mode the database runs with WAL and tuned pragmas, readers keep
+    their own connections and every write() goes through a SingleWriter.
+
+    Long-lived background threads use background() instead of a slot.
+    """
+
+    def __init__(self, database, max_size=10, timeout=30.0, cached_statements=256, mode="rollback", max_batch=100):
+        if mode not in ("rollback", "wal"):
+            raise ValueError(f"Unknown database mode {mode!r}")
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.mode = mode
+        self.max_batch = max_batch
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._label = os.path.basename(database)
+        self._local = threading.local()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._closed = False
+        POOL_SIZE.labels(self._label).set(max_size)
+
+    def _connect(self):
+        return connect(self.database, self.mode, self.cached_statements)
+
+    def acquire(self):
+        if self._closed:
+            raise RuntimeError(f"Connection pool for {self.database} is closed")
+
+        start = time.perf_counter()
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            if stage_metrics.ENABLED:
+                stage_metrics.observe("acquire", time.perf_counter() - start)
+            return connection
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No free connection to {self.database} after {self.timeout}s")
+        POOL_WAIT_SECONDS.labels(self._label).observe(time.perf_counter() - start)
+
+        try:
+            connection = self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._connections.add(connection)
+        POOL_CONNECTIONS.labels(self._label).inc()
+        self._local.connection = connection
+        # Give the slot back once the owning thread goes away
+        weakref.finalize(threading.current_thread(), self._discard, connection)
+        if stage_metrics.ENABLED:
+            stage_metrics.observe("acquire", time.perf_counter() - start)
+        return connection
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+
+    @contextmanager
+    def background(self):
+        """Serve this thread's connection() and write() from a connection outside the pool meanwhile.
+
+        For background threads, which live as long as the process: a pooled
+        connection would keep its slot from the request workers until then.
+        The connection is closed on leaving.
+        """
+        previous = getattr(self._local, "connection", None)
+        connection = self._connect()
+        self._local.connection = connection
+        try:
+            yield connection
+        finally:
+            self._local.connection = previous
+            connection.close()
+
+    def write(self, write):
+        """Run write(connection) in a transaction and return its result.
+
+        In "wal" mode raises TimeoutError if the writer has not run it
+        within `timeout` seconds.
+        """
+        if self.mode == "rollback":
+            with self.connection() as connection:
+                result = write(connection)
+                with stage_metrics.timed("commit"):
+                    connection.commit()
+                return result
+
+        with tracing.span(f"WRITE {self._label}", attributes={"db.system": "sqlite", "db.name": self._label}):
+            # Submitted under the lock so close() cannot stop the writer in between
+            with self._writer_lock:
+                if self._closed:
+                    raise RuntimeError(f"Connection pool for {self.database} is closed")
+                # A writer whose thread failed has failed its writes, start over with a new one
+                if self._writer is None or self._writer.closed:
+                    self._writer = SingleWriter(self.database, self.max_batch, self.cached_statements)
+                future = self._writer.submit(write)
+            try:
+                return future.result(timeout=self.timeout)
+            except futures.TimeoutError:
+                # The write stays queued and may still be committed
+                raise TimeoutError(f"Write to {self.database} not done after {self.timeout}s") from None
+
+    def _discard(self, connection):
+        with self._lock:
+            if connection not in self._connections:
+                return
+            self._connections.remove(connection)
+        connection.close()
+        POOL_CONNECTIONS.labels(self._label).dec()
+        self._slots.release()
+
+    def close(self):
+        with self._writer_lock:
+            self._closed = True
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            self._discard(connection)
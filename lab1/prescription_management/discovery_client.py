@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import random
+import threading
+
+import grpc
+from registration_pb2 import ServiceRegistration, DeregisterServiceRequest, SendServiceStatusRequest
+from registration_pb2_grpc import RegistrationServiceStub
+
+import tracing
+
+# Shared by the records and prescription services, keep both copies in sync.
+
+log = logging.getLogger(__name__)
+
+CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 20000),
+    ("grpc.keepalive_timeout_ms", 5000),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+
+class DiscoveryClient:
+    """Long-lived connection to the service discovery.
+
+    One channel is kept open for the life of the process. Status reports
+    double as heartbeats (discovery refreshes the heartbeat on every status
+    update), they are sent every `interval` seconds and back off
+    exponentially, with jitter, while discovery is unreachable: from a
+    thread (start()), or as a task on a grpc.aio server's event loop
+    (run_async(), over a grpc.aio channel of its own).
+
+    A read replica registers read_only and reports staleness(), the seconds
+    its data may be behind the primary (None while unknown).
+    """
+
+    def __init__(self, url, service_name, host, port, interval=1.0, max_backoff=30.0, timeout=5.0,
+                 read_only=False, staleness=None):
+        self.service_name = service_name
+        self.host = host
+        self.port = port
+        self.read_only = read_only
+        self.staleness = staleness
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.url = url
+        self._channel = grpc.insecure_channel(url, options=CHANNEL_OPTIONS)
+        self._stub = RegistrationServiceStub(self._channel)
+        self._stopping = threading.Event()
+        self._thread = None
+        self._failures = 0
+        self._registered = False
+
+    def _call(self, method, request):
+        with tracing.span(f"discovery/{method}", "CLIENT", {"rpc.system": "grpc", "rpc.method": method}):
+            return getattr(self._stub, method)(request, timeout=self.timeout)
+
+    async def _call_async(self, stub, method, request):
+        with tracing.span(f"discovery/{method}", "CLIENT", {"rpc.system": "grpc", "rpc.method": method}):
+            return await getattr(stub, method)(request, timeout=self.timeout)
+
+    def _registration(self):
+        return ServiceRegistration(name=self.service_name, host=self.host, port=self.port, read_only=self.read_only)
+
+    def register(self):
+        self._call("RegisterService", self._registration())
+        self._registered = True
+        log.info("Service registered with the Node.js gateway")
+
+    def deregister(self):
+        # Stop reporting first, a late status report would mark us alive again
+        self.stop()
+        if not self._registered:
+            return
+        self._registered = False
+        try:
+            self._call("DeregisterService", DeregisterServiceRequest(
+                name=self.service_name,
+                host=self.host,
+                port=self.port
+            ))
+            log.info("Service deregistered")
+        except grpc.RpcError as e:
+            log.warning("Failed to deregister: %s", e.code())
+
+    def _status(self, load):
+        in_flight, queue_depth = int(load.in_flight), int(load.queue_depth)
+        staleness = self.staleness() if self.staleness else 0.0
+        return SendServiceStatusRequest(
+            service_name=self.service_name,
+            port=self.port,
+            load=in_flight + queue_depth,
+            in_flight=in_flight,
+            queue_depth=queue_depth,
+            latency_ms=load.latency_ms,
+            cpu_percent=load.cpu_percent,
+            staleness_ms=staleness * 1000 if staleness is not None else float("inf")
+        )
+
+    def send_status(self, load):
+        self._call("UpdateServiceStatus", self._status(load))
+
+    def _back_off(self, error):
+        # Called from the except block that caught error
+        self._failures += 1
+        if isinstance(error, grpc.RpcError):
+            log.warning("Failed to send status and heartbeat (%s in a row): %s", self._failures, error.code())
+        else:
+            # Such as staleness() failing to read the database, the reports must go on
+            log.exception("Failed to send status and heartbeat (%s in a row)", self._failures)
+        backoff = min(self.max_backoff, self.interval * 2 ** self._failures)
+        return random.uniform(backoff / 2, backoff)
+
+    def _next_report(self):
+        return random.uniform(0.9 * self.interval, 1.1 * self.interval)
+
+    def report(self, load):
+        """Send one status report (a load_tracking.Load) and return how long to wait before the next."""
+        try:
+            self.send_status(load)
+        except Exception as e:
+            return self._back_off(e)
+
+        if self._failures:
+            # Discovery keeps registrations in memory, it may have restarted
+            self._failures = 0
+            try:
+                self.register()
+            except grpc.RpcError:
+                pass
+        return self._next_report()
+
+    async def _report_async(self, stub, current_load):
+        loop = asyncio.get_running_loop()
+        try:
+            # staleness() may read the database, off the event loop
+            request = await loop.run_in_executor(None, self._status, current_load())
+            await self._call_async(stub, "UpdateServiceStatus", request)
+        except Exception as e:
+            return self._back_off(e)
+
+        if self._failures:
+            self._failures = 0
+            try:
+                await self._call_async(stub, "RegisterService", self._registration())
+            except grpc.RpcError:
+                pass
+        return self._next_report()
+
+    async def run_async(self, current_load):
+        """Report current_load() from the running event loop until cancelled or stop()."""
+        async with grpc.aio.insecure_channel(self.url, options=CHANNEL_OPTIONS) as channel:
+            stub = RegistrationServiceStub(channel)
+            while not self._stopping.is_set():
+                await asyncio.sleep(await self._report_async(stub, current_load))
+
+    def start(self, current_load):
+        """Report current_load() from a daemon thread until stop()."""
+        def run():
+            delay = 0
+            while not self._stopping.wait(delay):
+                try:
+                    load = current_load()
+                except Exception as e:
+                    delay = self._back_off(e)
+                    continue
+                delay = self.report(load)
+
+        self._thread = threading.Thread(target=run, name="discovery-status", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        self._channel.close()
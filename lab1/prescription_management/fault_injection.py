@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+import grpc
+
+# Shared by the records and prescription services, keep both copies in sync.
+#
+# Off unless FAULT_DELAY_MS or FAULT_ERROR_RATE is set, e.g. to exercise the
+# gateway's timeouts against a slow GetRecordInfo:
+#
+#   FAULT_DELAY_MS=2000 FAULT_METHODS=GetRecordInfo
+#
+# FAULT_ERROR_RATE is a probability between 0 and 1, FAULT_ERROR_CODE a
+# grpc.StatusCode name and FAULT_METHODS a comma separated list of method
+# names (all methods when empty).
+
+log = logging.getLogger(__name__)
+
+
+class FaultInjectionInterceptor(grpc.ServerInterceptor):
+    def __init__(self, delay=0.0, error_rate=0.0, error_code=grpc.StatusCode.UNAVAILABLE, methods=()):
+        self.delay = delay
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.methods = set(methods)
+
+    def _targets(self, method):
+        # handler_call_details.method looks like "/records.RecordService/GetRecordInfo"
+        return not self.methods or method.rsplit("/", 1)[-1] in self.methods
+
+    def _inject(self, context):
+        if self.delay:
+            time.sleep(self.delay)
+        if self.error_rate and random.random() < self.error_rate:
+            context.abort(self.error_code, "Injected fault")
+
+    def _wrap(self, behavior):
+        def injected(request_or_iterator, context):
+            self._inject(context)
+            return behavior(request_or_iterator, context)
+        return injected
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or not self._targets(handler_call_details.method):
+            return handler
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=self._wrap(handler.unary_unary))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=self._wrap(handler.unary_stream))
+        if handler.stream_unary:
+            return handler._replace(stream_unary=self._wrap(handler.stream_unary))
+        return handler._replace(stream_stream=self._wrap(handler.stream_stream))
+
+
+class AsyncFaultInjectionInterceptor(grpc.aio.ServerInterceptor):
+    """FaultInjectionInterceptor for grpc.aio servers, delays without blocking the loop."""
+
+    def __init__(self, delay=0.0, error_rate=0.0, error_code=grpc.StatusCode.UNAVAILABLE, methods=()):
+        self.delay = delay
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.methods = set(methods)
+
+    def _targets(self, method):
+        return not self.methods or method.rsplit("/", 1)[-1] in self.methods
+
+    async def _inject(self, context):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.error_rate and random.random() < self.error_rate:
+            await context.abort(self.error_code, "Injected fault")
+
+    def _wrap(self, behavior):
+        async def injected(request_or_iterator, context):
+            await self._inject(context)
+            return await behavior(request_or_iterator, context)
+        return injected
+
+    def _wrap_stream(self, behavior):
+        async def injected(request_or_iterator, context):
+            await self._inject(context)
+            async for response in behavior(request_or_iterator, context):
+                yield response
+        return injected
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None or not self._targets(handler_call_details.method):
+            return handler
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=self._wrap(handler.unary_unary))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=self._wrap_stream(handler.unary_stream))
+        if handler.stream_unary:
+            return handler._replace(stream_unary=self._wrap(handler.stream_unary))
+        return handler._replace(stream_stream=self._wrap_stream(handler.stream_stream))
+
+
+def fault_injection_from_env(aio=False):
+    delay = float(os.getenv("FAULT_DELAY_MS", 0)) / 1000
+    error_rate = float(os.getenv("FAULT_ERROR_RATE", 0))
+    if not delay and not error_rate:
+        return None
+
+    error_code = grpc.StatusCode[os.getenv("FAULT_ERROR_CODE", "UNAVAILABLE")]
+    methods = [m.strip() for m in os.getenv("FAULT_METHODS", "").split(",") if m.strip()]
+    log.warning("Fault injection enabled: delay=%ss error_rate=%s code=%s methods=%s",
+                delay, error_rate, error_code.name, methods or 'all')
+    interceptor_class = AsyncFaultInjectionInterceptor if aio else FaultInjectionInterceptor
+    return interceptor_class(delay, error_rate, error_code, methods)
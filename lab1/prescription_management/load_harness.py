@@ -0,0 +1,201 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import subprocess
+import time
+
+import grpc
+
+# Shared by the records and prescription services, keep both copies in sync.
+#
+# Load generation for benchmark_load.py. Client processes, so the load does
+# not compete with the server for its GIL, each drive a share of the load
+# over their own connection:
+#
+#   closed loop  --concurrency calls in flight at all times, each client
+#                sending its next call when the last one returns
+#   open loop    --qps calls a second, sent on schedule whether or not the
+#                earlier ones returned. Latency counts from when a call was
+#                due, so a server falling behind shows in it.
+#
+# The calls are picked at random, weighted by the mix ("get=60,create=20").
+# make_operations(channel, seeded_ids, rng) gives a client its operations, by
+# name, as coroutine functions that make one call each and return the name
+# of the operation they made.
+
+PERCENTILES = (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("p999", 0.999))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def parse_mix(text, operations):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in operations:
+            raise ValueError(f"Unknown operation {name!r}, use {', '.join(operations)}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("The mix has no weight")
+    return mix
+
+
+def percentile(ordered, share):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))] if ordered else 0.0
+
+
+def rss_mb():
+    """The current and the peak resident set size of this process, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open("/proc/self/statm") as statm:
+            current = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return None, peak
+    # ru_maxrss may lag behind
+    return current, max(current, peak)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def drive(make_operations, port, seeded_ids, mix, concurrency, qps, duration, warmup, seed):
+    """Latencies and errors of this client's calls by operation, those started during warmup left out."""
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    latencies = {name: [] for name in names}
+    errors = {name: {} for name in names}
+    # A local subchannel pool gives this process its own TCP connection
+    options = [("grpc.use_local_subchannel_pool", 1)]
+    async with grpc.aio.insecure_channel(f'localhost:{port}', options=options) as channel:
+        await channel.channel_ready()
+        operations = make_operations(channel, seeded_ids, rng)
+        start = time.perf_counter()
+        measured_from, deadline = start + warmup, start + warmup + duration
+
+        async def call(name, due):
+            try:
+                name = await operations[name]()
+            except grpc.aio.AioRpcError as e:
+                if due >= measured_from:
+                    code = e.code().name
+                    errors[name][code] = errors[name].get(code, 0) + 1
+                return
+            if due >= measured_from:
+                latencies.setdefault(name, []).append(time.perf_counter() - due)
+
+        if qps:
+            pending = set()
+            interval, due = 1 / qps, start
+            while due < deadline:
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                task = asyncio.ensure_future(call(rng.choices(names, weights)[0], due))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                due += interval
+            await asyncio.gather(*pending)
+        else:
+            async def client():
+                while time.perf_counter() < deadline:
+                    await call(rng.choices(names, weights)[0], time.perf_counter())
+            await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, errors
+
+
+def _client_process(connection, *args):
+    connection.send(asyncio.run(drive(*args)))
+    connection.close()
+
+
+def run_load(make_operations, port, seeded_ids, mix, processes=2, concurrency=32, qps=0, duration=10.0, warmup=1.0,
+             seed=0):
+    """Drive the server on port from `processes` clients, returns summarize() of their calls."""
+    context = multiprocessing.get_context("spawn")
+    clients = []
+    for number in range(processes):
+        # Spread concurrency and rate over the clients, the first ones take the remainder
+        share = concurrency // processes + (number < concurrency % processes)
+        parent, child = context.Pipe(duplex=False)
+        process = context.Process(target=_client_process, args=(
+            child, make_operations, port, seeded_ids, mix, max(1, share), qps / processes, duration, warmup,
+            seed + number))
+        process.start()
+        clients.append((process, parent))
+
+    latencies, errors = {}, {}
+    for process, connection in clients:
+        client_latencies, client_errors = connection.recv()
+        process.join()
+        for name, values in client_latencies.items():
+            latencies.setdefault(name, []).extend(values)
+        for name, codes in client_errors.items():
+            merged = errors.setdefault(name, {})
+            for code, count in codes.items():
+                merged[code] = merged.get(code, 0) + count
+    return summarize(latencies, errors, duration)
+
+
+def _stats(values, errors, duration):
+    values = sorted(values)
+    stats = {"calls": len(values), "errors": errors, "throughput": len(values) / duration}
+    for label, share in PERCENTILES:
+        stats[f"{label}_ms"] = percentile(values, share) * 1000
+    return stats
+
+
+def summarize(latencies, errors, duration):
+    operations = {name: _stats(latencies.get(name, []), errors.get(name, {}), duration)
+                  for name in sorted(set(latencies) | set(errors))}
+    every_error = {}
+    for codes in errors.values():
+        for code, count in codes.items():
+            every_error[code] = every_error.get(code, 0) + count
+    return {"operations": operations,
+            "total": _stats([value for values in latencies.values() for value in values], every_error, duration)}
+
+
+def print_results(results):
+    print(f"{'operation':>10} {'calls/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'errors':>7}")
+    for name, stats in list(results["operations"].items()) + [("total", results["total"])]:
+        print(f"{name:>10} {stats['throughput']:>9.0f} {stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} "
+              f"{stats['p99_ms']:>8.2f} {stats['p999_ms']:>8.2f} {sum(stats['errors'].values()):>7}")
+    current, peak = results["rss_mb"], results["peak_rss_mb"]
+    print(f"server RSS: {current:.0f} MiB, peak {peak:.0f} MiB" if current is not None else
+          f"server peak RSS: {peak:.0f} MiB")
+
+
+def save_results(path, results):
+    with open(path, "w") as out:
+        json.dump(results, out, indent=2, sort_keys=True)
+
+
+def compare(baseline, results, tolerance=0.1):
+    """Where results are more than `tolerance` worse than baseline: lower throughput or higher p99."""
+    regressions = []
+    for name, stats in list(results["operations"].items()) + [("total", results["total"])]:
+        before = baseline["total"] if name == "total" else baseline["operations"].get(name)
+        if not before or not before["calls"] or not stats["calls"]:
+            continue
+        if stats["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: {stats['throughput']:.0f} calls/s, was {before['throughput']:.0f}")
+        if stats["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {stats['p99_ms']:.2f} ms, was {before['p99_ms']:.2f}")
+    if baseline.get("peak_rss_mb") and results["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append(f"peak RSS {results['peak_rss_mb']:.0f} MiB, was {baseline['peak_rss_mb']:.0f}")
+    return regressions
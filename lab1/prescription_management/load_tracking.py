@@ -0,0 +1,101 @@
+import collections
+import os
+import threading
+import time
+
+import grpc
+
+# Shared by the records and prescription services, keep both copies in sync.
+
+Load = collections.namedtuple("Load", ["in_flight", "queue_depth", "latency_ms", "cpu_percent"])
+
+
+class LoadTracker:
+    """Counts calls as they are accepted, start on a worker and finish.
+
+    queue_depth is accepted - started (waiting for a worker thread),
+    in_flight is started - finished. latency_ms is an exponentially weighted
+    moving average of accept-to-finish time, and cpu_percent the process' CPU
+    use since the previous snapshot, as a share of all usable cores.
+    """
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._accepted = 0
+        self._started = 0
+        self._finished = 0
+        self._latency = 0.0
+        self._cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+        self._cpu_sample = (time.monotonic(), time.process_time())
+
+    def accept(self):
+        with self._lock:
+            self._accepted += 1
+        return time.perf_counter()
+
+    def start(self):
+        with self._lock:
+            self._started += 1
+
+    def finish(self, accepted_at):
+        latency = time.perf_counter() - accepted_at
+        with self._lock:
+            self._finished += 1
+            self._latency += self.alpha * (latency - self._latency)
+
+    def snapshot(self):
+        now = (time.monotonic(), time.process_time())
+        with self._lock:
+            (wall, cpu), self._cpu_sample = self._cpu_sample, now
+            in_flight = self._started - self._finished
+            queue_depth = self._accepted - self._started
+            latency = self._latency
+        elapsed = now[0] - wall
+        cpu_percent = 100 * (now[1] - cpu) / (elapsed * self._cpus) if elapsed > 0 else 0.0
+        return Load(in_flight, queue_depth, latency * 1000, min(cpu_percent, 100.0))
+
+
+class LoadTrackingInterceptor(grpc.ServerInterceptor):
+    """Feeds every unary call through a LoadTracker.
+
+    intercept_service runs when the call arrives, the wrapped behavior on the
+    worker thread, and the decrement sits in a finally so handlers that raise
+    or abort still count as finished. Streaming calls pass through untracked:
+    a WatchChanges or Replicate stream stays open for as long as its caller
+    likes, which would count as in flight all along and put its whole
+    lifetime into the latency average.
+    """
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def _wrap(self, behavior, accepted_at):
+        tracker = self.tracker
+
+        def tracked(request, context):
+            tracker.start()
+            try:
+                return behavior(request, context)
+            finally:
+                tracker.finish(accepted_at)
+        return tracked
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or not handler.unary_unary:
+            return handler
+        return handler._replace(unary_unary=self._wrap(handler.unary_unary, self.tracker.accept()))
+
+
+def combine_loads(loads):
+    """One Load for several worker processes: counts and CPU add up, latency is averaged."""
+    loads = list(loads)
+    if not loads:
+        return Load(0, 0, 0.0, 0.0)
+    return Load(
+        sum(load.in_flight for load in loads),
+        sum(load.queue_depth for load in loads),
+        sum(load.latency_ms for load in loads) / len(loads),
+        min(sum(load.cpu_percent for load in loads), 100.0),
+    )
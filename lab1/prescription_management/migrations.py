@@ -0,0 +1,141 @@
+import collections
+import logging
+import sqlite3
+import threading
+import time
+
+# Shared by the records and prescription services, keep both copies in sync.
+#
+# Versioned schema migrations. Each service lists its migrations in version
+# order; schema_migrations records which ones a database has. migrate() runs
+# at startup and applies the pending ones:
+#
+#   - a plain migration is apply(connection), run in one short BEGIN IMMEDIATE
+#     transaction: DDL and changes to small tables only
+#   - an online migration (online=True) is only registered by migrate(). The
+#     service runs it once serving, with run_online_migrations(), as a series
+#     of short steps: apply(pool, cursor) does one batch and returns the cursor
+#     to resume from, None once done. The cursor is saved after every step,
+#     so a restart resumes rather than starts over, and steps must be safe to
+#     repeat. Later migrations must not depend on an online one having finished.
+#
+# Two processes starting at once (a rolling deploy, pre-fork workers) apply
+# every migration once: each one re-checks schema_migrations under the write lock.
+#
+# An index is a plain migration, CREATE INDEX, as SQLite builds it in one
+# statement holding the write lock for the whole scan and sort: writes from
+# other processes wait it out, and on a large table may time out. Apply them
+# outside request traffic with the services' pre-deploy command (`python
+# records_server.py migrate`, `python prescription_server.py migrate`), which
+# applies every pending migration, online ones to completion, and exits; a
+# service started on an unmigrated database builds them at startup, before it
+# serves.
+
+log = logging.getLogger(__name__)
+
+Migration = collections.namedtuple("Migration", "version name apply online", defaults=(False,))
+
+
+def create_migrations_table(connection):
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            cursor INTEGER,
+            applied_at REAL
+        )
+    ''')
+    connection.commit()
+
+
+def applied_versions(connection):
+    """The versions of every migration applied or, online ones, started."""
+    return {row[0] for row in connection.execute("SELECT version FROM schema_migrations")}
+
+
+def is_pending(connection, migration):
+    row = connection.execute("SELECT applied_at FROM schema_migrations WHERE version = ?",
+                             (migration.version,)).fetchone()
+    # A plain migration registered but unfinished was an online one in an earlier release
+    return row is None or (row[0] is None and not migration.online)
+
+
+def migrate(connection, migrations):
+    """Apply the pending plain migrations and register the online ones, returns the versions applied."""
+    create_migrations_table(connection)
+    applied = []
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if not is_pending(connection, migration):
+            continue
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have applied it while this one waited for the lock
+            if is_pending(connection, migration):
+                if not migration.online:
+                    migration.apply(connection)
+                connection.execute(
+                    "INSERT OR REPLACE INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                    (migration.version, migration.name, None if migration.online else time.time())
+                )
+                applied.append(migration.version)
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        if applied and applied[-1] == migration.version:
+            log.info("%s migration %s (%s)", 'Registered' if migration.online else 'Applied', migration.version, migration.name)
+    return applied
+
+
+def run_online_migrations(pool, migrations, pause=0.0):
+    """Run the unfinished online migrations to completion, `pause` seconds between steps."""
+    with pool.connection() as connection:
+        unfinished = {row[0]: row[1] for row in connection.execute(
+            "SELECT version, cursor FROM schema_migrations WHERE applied_at IS NULL")}
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if not migration.online or migration.version not in unfinished:
+            continue
+        cursor = unfinished[migration.version]
+        start = time.perf_counter()
+        while True:
+            cursor = migration.apply(pool, cursor)
+            if cursor is None:
+                break
+            pool.write(lambda connection: connection.execute(
+                "UPDATE schema_migrations SET cursor = ? WHERE version = ?", (cursor, migration.version)))
+            time.sleep(pause)
+        pool.write(lambda connection: connection.execute(
+            "UPDATE schema_migrations SET cursor = NULL, applied_at = ? WHERE version = ?",
+            (time.time(), migration.version)))
+        log.info("Applied online migration %s (%s) in %.1fs", migration.version, migration.name, time.perf_counter() - start)
+
+
+def start_online_migrations(pool, migrations, pause=0.0):
+    def run():
+        try:
+            with pool.background():
+                run_online_migrations(pool, migrations, pause)
+        except sqlite3.Error as e:
+            # Resumes from the saved cursor at the next start
+            log.error("Online migrations stopped: %s", e)
+
+    threading.Thread(target=run, name="online-migrations", daemon=True).start()
+
+
+def execute_statements(connection, script):
+    """Run a script statement by statement, unlike executescript() without committing first."""
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            connection.execute(statement)
+            statement = ""
+    if statement.strip():
+        connection.execute(statement)
+
+
+def add_column(connection, table, column, definition):
+    """ALTER TABLE ADD COLUMN unless the table has it, for databases that predate migrations."""
+    if column not in [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]:
+        connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
@@ -14,27 +14,47 @@ _sym_db = _symbol_database.Default()
 from google.protobuf import empty_pb2 as google_dot_protobuf_dot_empty__pb2
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x12prescription.proto\x12\x0cprescription\x1a\x1bgoogle/protobuf/empty.proto\".\n\x0cPrescription\x12\n\n\x02id\x18\x01 \x01(\t\x12\x12\n\nmedication\x18\x02 \x01(\t\"H\n\x19\x43reatePrescriptionRequest\x12\x17\n\x0fprescription_id\x18\x01 \x01(\t\x12\x12\n\nmedication\x18\x02 \x01(\t\"1\n\x16GetPrescriptionRequest\x12\x17\n\x0fprescription_id\x18\x01 \x01(\t\"P\n\x19UpdatePrescriptionRequest\x12\x17\n\x0fprescription_id\x18\x01 \x01(\t\x12\x1a\n\x12updated_medication\x18\x02 \x01(\t\"4\n\x19\x44\x65letePrescriptionRequest\x12\x17\n\x0fprescription_id\x18\x01 \x01(\t\"#\n\rServiceStatus\x12\x12\n\nis_healthy\x18\x01 \x01(\x08\"H\n\x1eSendPrescriptionByEmailRequest\x12\x17\n\x0fprescription_id\x18\x01 \x01(\t\x12\r\n\x05\x65mail\x18\x02 \x01(\t2\xa1\x04\n\x13PrescriptionService\x12Y\n\x12\x43reatePrescription\x12\'.prescription.CreatePrescriptionRequest\x1a\x1a.prescription.Prescription\x12S\n\x0fGetPrescription\x12$.prescription.GetPrescriptionRequest\x1a\x1a.prescription.Prescription\x12Y\n\x12UpdatePrescription\x12\'.prescription.UpdatePrescriptionRequest\x1a\x1a.prescription.Prescription\x12U\n\x12\x44\x65letePrescription\x12\'.prescription.DeletePrescriptionRequest\x1a\x16.google.protobuf.Empty\x12_\n\x17SendPrescriptionByEmail\x12,.prescription.SendPrescriptionByEmailRequest\x1a\x16.google.protobuf.Empty\x12G\n\x10GetServiceStatus\x12\x16.google.protobuf.Empty\x1a\x1b.prescription.ServiceStatusb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x12prescription.proto\x12\x0cprescription\x1a\x1bgoogle/protobuf/empty.proto\"U\n\x0cPrescription\x12\n\n\x02id\x18\x01 \x01(\t\x12\x12\n\nmedication\x18\x02 \x01(\t\x12\x0f\n\x07version\x18\x03 \x01(\x03\x12\x14\n\x0cnot_modified\x18\x04 \x01(\x08\"H\n\x19\x43reatePrescriptionRequest\x12\x17\n\x0fprescription_id\x18\x01 \x01(\t\x12\x12\n\nmedication\x18\x02 \x01(\t\"H\n\x16GetPrescriptionRequest\x12\x17\n\x0fprescription_id\x18\x01 \x01(\t\x12\x15\n\rif_none_match\x18\x02 \x01(\x03\"j\n\x19UpdatePrescriptionRequest\x12\x17\n\x0fprescription_id\x18\x01 \x01(\t\x12\x1a\n\x12updated_medication\x18\x02 \x01(\t\x12\x18\n\x10\x65xpected_version\x18\x03 \x01(\x03\"4\n\x19\x44\x65letePrescriptionRequest\x12\x17\n\x0fprescription_id\x18\x01 \x01(\t\"p\n\x18ListPrescriptionsRequest\x12\x11\n\tpage_size\x18\x01 \x01(\x05\x12\x12\n\npage_token\x18\x02 \x01(\t\x12\x12\n\nmedication\x18\x03 \x01(\t\x12\x19\n\x11medication_prefix\x18\x04 \x01(\t\"g\n\x19ListPrescriptionsResponse\x12\x31\n\rprescriptions\x18\x01 \x03(\x0b\x32\x1a.prescription.Prescription\x12\x17\n\x0fnext_page_token\x18\x02 \x01(\t\"a\n\x1f\x42\x61tchCreatePrescriptionsRequest\x12>\n\rprescriptions\x18\x01 \x03(\x0b\x32\'.prescription.CreatePrescriptionRequest\"8\n\x1c\x42\x61tchGetPrescriptionsRequest\x12\x18\n\x10prescription_ids\x18\x01 \x03(\t\";\n\x1f\x42\x61tchDeletePrescriptionsRequest\x12\x18\n\x10prescription_ids\x18\x01 \x03(\t\"\x7f\n\x17\x42\x61tchPrescriptionResult\x12\x17\n\x0fprescription_id\x18\x01 \x01(\t\x12\n\n\x02ok\x18\x02 \x01(\x08\x12\r\n\x05\x65rror\x18\x03 \x01(\t\x12\x30\n\x0cprescription\x18\x04 \x01(\x0b\x32\x1a.prescription.Prescription\"T\n\x1a\x42\x61tchPrescriptionsResponse\x12\x36\n\x07results\x18\x01 \x03(\x0b\x32%.prescription.BatchPrescriptionResult\"#\n\rServiceStatus\x12\x12\n\nis_healthy\x18\x01 \x01(\x08\"=\n\x13WatchChangesRequest\x12\x14\n\x0c\x61\x66ter_offset\x18\x01 \x01(\x03\x12\x10\n\x08\x66rom_now\x18\x02 \x01(\x08\"f\n\x06\x43hange\x12\x0e\n\x06offset\x18\x01 \x01(\x03\x12\"\n\x02op\x18\x02 \x01(\x0e\x32\x16.prescription.ChangeOp\x12\x17\n\x0fprescription_id\x18\x03 \x01(\t\x12\x0f\n\x07version\x18\x04 \x01(\x03\"H\n\x1eSendPrescriptionByEmailRequest\x12\x17\n\x0fprescription_id\x18\x01 \x01(\t\x12\r\n\x05\x65mail\x18\x02 \x01(\t*L\n\x08\x43hangeOp\x12\x19\n\x15\x43HANGE_OP_UNSPECIFIED\x10\x00\x12\x0b\n\x07\x43REATED\x10\x01\x12\x0b\n\x07UPDATED\x10\x02\x12\x0b\n\x07\x44\x45LETED\x10\x03\x32\xab\x08\n\x13PrescriptionService\x12Y\n\x12\x43reatePrescription\x12\'.prescription.CreatePrescriptionRequest\x1a\x1a.prescription.Prescription\x12S\n\x0fGetPrescription\x12$.prescription.GetPrescriptionRequest\x1a\x1a.prescription.Prescription\x12Y\n\x12UpdatePrescription\x12\'.prescription.UpdatePrescriptionRequest\x1a\x1a.prescription.Prescription\x12U\n\x12\x44\x65letePrescription\x12\'.prescription.DeletePrescriptionRequest\x1a\x16.google.protobuf.Empty\x12\x64\n\x11ListPrescriptions\x12&.prescription.ListPrescriptionsRequest\x1a\'.prescription.ListPrescriptionsResponse\x12_\n\x17SendPrescriptionByEmail\x12,.prescription.SendPrescriptionByEmailRequest\x1a\x16.google.protobuf.Empty\x12G\n\x10GetServiceStatus\x12\x16.google.protobuf.Empty\x1a\x1b.prescription.ServiceStatus\x12s\n\x18\x42\x61tchCreatePrescriptions\x12-.prescription.BatchCreatePrescriptionsRequest\x1a(.prescription.BatchPrescriptionsResponse\x12m\n\x15\x42\x61tchGetPrescriptions\x12*.prescription.BatchGetPrescriptionsRequest\x1a(.prescription.BatchPrescriptionsResponse\x12s\n\x18\x42\x61tchDeletePrescriptions\x12-.prescription.BatchDeletePrescriptionsRequest\x1a(.prescription.BatchPrescriptionsResponse\x12I\n\x0cWatchChanges\x12!.prescription.WatchChangesRequest\x1a\x14.prescription.Change0\x01\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'prescription_pb2', _globals)
 if _descriptor._USE_C_DESCRIPTORS == False:
   DESCRIPTOR._options = None
+  _globals['_CHANGEOP']._serialized_start=1392
+  _globals['_CHANGEOP']._serialized_end=1468
   _globals['_PRESCRIPTION']._serialized_start=65
-  _globals['_PRESCRIPTION']._serialized_end=111
-  _globals['_CREATEPRESCRIPTIONREQUEST']._serialized_start=113
-  _globals['_CREATEPRESCRIPTIONREQUEST']._serialized_end=185
-  _globals['_GETPRESCRIPTIONREQUEST']._serialized_start=187
-  _globals['_GETPRESCRIPTIONREQUEST']._serialized_end=236
-  _globals['_UPDATEPRESCRIPTIONREQUEST']._serialized_start=238
-  _globals['_UPDATEPRESCRIPTIONREQUEST']._serialized_end=318
-  _globals['_DELETEPRESCRIPTIONREQUEST']._serialized_start=320
-  _globals['_DELETEPRESCRIPTIONREQUEST']._serialized_end=372
-  _globals['_SERVICESTATUS']._serialized_start=374
-  _globals['_SERVICESTATUS']._serialized_end=409
-  _globals['_SENDPRESCRIPTIONBYEMAILREQUEST']._serialized_start=411
-  _globals['_SENDPRESCRIPTIONBYEMAILREQUEST']._serialized_end=483
-  _globals['_PRESCRIPTIONSERVICE']._serialized_start=486
-  _globals['_PRESCRIPTIONSERVICE']._serialized_end=1031
+  _globals['_PRESCRIPTION']._serialized_end=150
+  _globals['_CREATEPRESCRIPTIONREQUEST']._serialized_start=152
+  _globals['_CREATEPRESCRIPTIONREQUEST']._serialized_end=224
+  _globals['_GETPRESCRIPTIONREQUEST']._serialized_start=226
+  _globals['_GETPRESCRIPTIONREQUEST']._serialized_end=298
+  _globals['_UPDATEPRESCRIPTIONREQUEST']._serialized_start=300
+  _globals['_UPDATEPRESCRIPTIONREQUEST']._serialized_end=406
+  _globals['_DELETEPRESCRIPTIONREQUEST']._serialized_start=408
+  _globals['_DELETEPRESCRIPTIONREQUEST']._serialized_end=460
+  _globals['_LISTPRESCRIPTIONSREQUEST']._serialized_start=462
+  _globals['_LISTPRESCRIPTIONSREQUEST']._serialized_end=574
+  _globals['_LISTPRESCRIPTIONSRESPONSE']._serialized_start=576
+  _globals['_LISTPRESCRIPTIONSRESPONSE']._serialized_end=679
+  _globals['_BATCHCREATEPRESCRIPTIONSREQUEST']._serialized_start=681
+  _globals['_BATCHCREATEPRESCRIPTIONSREQUEST']._serialized_end=778
+  _globals['_BATCHGETPRESCRIPTIONSREQUEST']._serialized_start=780
+  _globals['_BATCHGETPRESCRIPTIONSREQUEST']._serialized_end=836
+  _globals['_BATCHDELETEPRESCRIPTIONSREQUEST']._serialized_start=838
+  _globals['_BATCHDELETEPRESCRIPTIONSREQUEST']._serialized_end=897
+  _globals['_BATCHPRESCRIPTIONRESULT']._serialized_start=899
+  _globals['_BATCHPRESCRIPTIONRESULT']._serialized_end=1026
+  _globals['_BATCHPRESCRIPTIONSRESPONSE']._serialized_start=1028
+  _globals['_BATCHPRESCRIPTIONSRESPONSE']._serialized_end=1112
+  _globals['_SERVICESTATUS']._serialized_start=1114
+  _globals['_SERVICESTATUS']._serialized_end=1149
+  _globals['_WATCHCHANGESREQUEST']._serialized_start=1151
+  _globals['_WATCHCHANGESREQUEST']._serialized_end=1212
+  _globals['_CHANGE']._serialized_start=1214
+  _globals['_CHANGE']._serialized_end=1316
+  _globals['_SENDPRESCRIPTIONBYEMAILREQUEST']._serialized_start=1318
+  _globals['_SENDPRESCRIPTIONBYEMAILREQUEST']._serialized_end=1390
+  _globals['_PRESCRIPTIONSERVICE']._serialized_start=1471
+  _globals['_PRESCRIPTIONSERVICE']._serialized_end=2538
 # @@protoc_insertion_point(module_scope)
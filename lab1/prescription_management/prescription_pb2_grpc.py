@@ -35,6 +35,11 @@ class PrescriptionServiceStub(object):
                 request_serializer=prescription__pb2.DeletePrescriptionRequest.SerializeToString,
                 response_deserializer=google_dot_protobuf_dot_empty__pb2.Empty.FromString,
                 )
+        self.ListPrescriptions = channel.unary_unary(
+                '/prescription.PrescriptionService/ListPrescriptions',
+                request_serializer=prescription__pb2.ListPrescriptionsRequest.SerializeToString,
+                response_deserializer=prescription__pb2.ListPrescriptionsResponse.FromString,
+                )
         self.SendPrescriptionByEmail = channel.unary_unary(
                 '/prescription.PrescriptionService/SendPrescriptionByEmail',
                 request_serializer=prescription__pb2.SendPrescriptionByEmailRequest.SerializeToString,
@@ -45,6 +50,26 @@ class PrescriptionServiceStub(object):
                 request_serializer=google_dot_protobuf_dot_empty__pb2.Empty.SerializeToString,
                 response_deserializer=prescription__pb2.ServiceStatus.FromString,
                 )
+        self.BatchCreatePrescriptions = channel.unary_unary(
+                '/prescription.PrescriptionService/BatchCreatePrescriptions',
+                request_serializer=prescription__pb2.BatchCreatePrescriptionsRequest.SerializeToString,
+                response_deserializer=prescription__pb2.BatchPrescriptionsResponse.FromString,
+                )
+        self.BatchGetPrescriptions = channel.unary_unary(
+                '/prescription.PrescriptionService/BatchGetPrescriptions',
+                request_serializer=prescription__pb2.BatchGetPrescriptionsRequest.SerializeToString,
+                response_deserializer=prescription__pb2.BatchPrescriptionsResponse.FromString,
+                )
+        self.BatchDeletePrescriptions = channel.unary_unary(
+                '/prescription.PrescriptionService/BatchDeletePrescriptions',
+                request_serializer=prescription__pb2.BatchDeletePrescriptionsRequest.SerializeToString,
+                response_deserializer=prescription__pb2.BatchPrescriptionsResponse.FromString,
+                )
+        self.WatchChanges = channel.unary_stream(
+                '/prescription.PrescriptionService/WatchChanges',
+                request_serializer=prescription__pb2.WatchChangesRequest.SerializeToString,
+                response_deserializer=prescription__pb2.Change.FromString,
+                )
 
 
 class PrescriptionServiceServicer(object):
@@ -74,6 +99,12 @@ class PrescriptionServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def ListPrescriptions(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def SendPrescriptionByEmail(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -86,6 +117,30 @@ class PrescriptionServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def BatchCreatePrescriptions(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def BatchGetPrescriptions(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def BatchDeletePrescriptions(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def WatchChanges(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_PrescriptionServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -109,6 +164,11 @@ def add_PrescriptionServiceServicer_to_server(servicer, server):
                     request_deserializer=prescription__pb2.DeletePrescriptionRequest.FromString,
                     response_serializer=google_dot_protobuf_dot_empty__pb2.Empty.SerializeToString,
             ),
+            'ListPrescriptions': grpc.unary_unary_rpc_method_handler(
+                    servicer.ListPrescriptions,
+                    request_deserializer=prescription__pb2.ListPrescriptionsRequest.FromString,
+                    response_serializer=prescription__pb2.ListPrescriptionsResponse.SerializeToString,
+            ),
             'SendPrescriptionByEmail': grpc.unary_unary_rpc_method_handler(
                     servicer.SendPrescriptionByEmail,
                     request_deserializer=prescription__pb2.SendPrescriptionByEmailRequest.FromString,
@@ -119,6 +179,26 @@ def add_PrescriptionServiceServicer_to_server(servicer, server):
                     request_deserializer=google_dot_protobuf_dot_empty__pb2.Empty.FromString,
                     response_serializer=prescription__pb2.ServiceStatus.SerializeToString,
             ),
+            'BatchCreatePrescriptions': grpc.unary_unary_rpc_method_handler(
+                    servicer.BatchCreatePrescriptions,
+                    request_deserializer=prescription__pb2.BatchCreatePrescriptionsRequest.FromString,
+                    response_serializer=prescription__pb2.BatchPrescriptionsResponse.SerializeToString,
+            ),
+            'BatchGetPrescriptions': grpc.unary_unary_rpc_method_handler(
+                    servicer.BatchGetPrescriptions,
+                    request_deserializer=prescription__pb2.BatchGetPrescriptionsRequest.FromString,
+                    response_serializer=prescription__pb2.BatchPrescriptionsResponse.SerializeToString,
+            ),
+            'BatchDeletePrescriptions': grpc.unary_unary_rpc_method_handler(
+                    servicer.BatchDeletePrescriptions,
+                    request_deserializer=prescription__pb2.BatchDeletePrescriptionsRequest.FromString,
+                    response_serializer=prescription__pb2.BatchPrescriptionsResponse.SerializeToString,
+            ),
+            'WatchChanges': grpc.unary_stream_rpc_method_handler(
+                    servicer.WatchChanges,
+                    request_deserializer=prescription__pb2.WatchChangesRequest.FromString,
+                    response_serializer=prescription__pb2.Change.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'prescription.PrescriptionService', rpc_method_handlers)
@@ -197,6 +277,23 @@ class PrescriptionService(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def ListPrescriptions(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/prescription.PrescriptionService/ListPrescriptions',
+            prescription__pb2.ListPrescriptionsRequest.SerializeToString,
+            prescription__pb2.ListPrescriptionsResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def SendPrescriptionByEmail(request,
             target,
@@ -230,3 +327,71 @@ class PrescriptionService(object):
             prescription__pb2.ServiceStatus.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def BatchCreatePrescriptions(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/prescription.PrescriptionService/BatchCreatePrescriptions',
+            prescription__pb2.BatchCreatePrescriptionsRequest.SerializeToString,
+            prescription__pb2.BatchPrescriptionsResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def BatchGetPrescriptions(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/prescription.PrescriptionService/BatchGetPrescriptions',
+            prescription__pb2.BatchGetPrescriptionsRequest.SerializeToString,
+            prescription__pb2.BatchPrescriptionsResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def BatchDeletePrescriptions(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/prescription.PrescriptionService/BatchDeletePrescriptions',
+            prescription__pb2.BatchDeletePrescriptionsRequest.SerializeToString,
+            prescription__pb2.BatchPrescriptionsResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def WatchChanges(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/prescription.PrescriptionService/WatchChanges',
+            prescription__pb2.WatchChangesRequest.SerializeToString,
+            prescription__pb2.Change.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
@@ -2,222 +2,506 @@ import grpc
 from concurrent import futures
 import prescription_pb2
 import prescription_pb2_grpc
-from registration_pb2 import ServiceRegistration, DeregisterServiceRequest, SendServiceStatusRequest, Heartbeat
-from registration_pb2_grpc import RegistrationServiceStub
 import sqlite3
 from concurrent import futures
 from google.protobuf import empty_pb2
-import threading
-import time
+import signal
+import asyncio
+import logging
 import os
+import sys
 from dotenv import load_dotenv
 from py_grpc_prometheus.prometheus_server_interceptor import PromServerInterceptor
 from prometheus_client import start_http_server
+from db_pool import ConnectionPool, batched, like_prefix, placeholders
+from fault_injection import fault_injection_from_env
+from aio_server import AsyncServicerAdapter, PromAioServerInterceptor
+from discovery_client import DiscoveryClient
+from load_tracking import LoadTracker, LoadTrackingInterceptor
+from read_cache import ReadCache
+from change_log import WatcherSlots, create_change_log, watch_changes
+from migrations import Migration, add_column, migrate, run_online_migrations, start_online_migrations
+from prefork import prepare_multiprocess_metrics, start_multiprocess_metrics_server, publish_load, read_loads, run_workers, shared_loads
+from service_logging import configure_logging, request_logger
+from stage_metrics import stage_metrics_from_env, timed
+from tracing import configure_tracing, tracing_from_env
 
 load_dotenv()
 
 PROMETHEUS_PORT = int(os.getenv("PROMETHEUS_PORT"))
 
 SERVICE_NAME = "prescriptions-service"
+configure_logging(SERVICE_NAME)
+configure_tracing(SERVICE_NAME)
+log = logging.getLogger("prescriptions")
+# One record per call, sampled, see service_logging.py
+rpc_log = request_logger("prescriptions.rpc")
 SERVICE_HOSTNAME = os.getenv("PRESCRIPTION_SERVICE_HOSTNAME")
 PRESCRIPTION_SERVICE_PORT = int(os.getenv("PRESCRIPTION_SERVICE_PORT"))
 
 SERVICE_DISCOVERY_HOSTNAME = os.getenv("SERVICE_DISCOVERY_HOSTNAME")
 SERVICE_DISCOVERY_PORT = os.getenv("SERVICE_DISCOVERY_PORT")
 SERVICE_DISCOVERY_URL = f"{SERVICE_DISCOVERY_HOSTNAME}:{SERVICE_DISCOVERY_PORT}"
-print(SERVICE_DISCOVERY_HOSTNAME)
 
-DATABASE = "prescriptions.db"
-
-connection = sqlite3.connect(DATABASE)
-cursor = connection.cursor()
-cursor.execute('''
+DATABASE = os.getenv("PRESCRIPTION_DATABASE", "prescriptions.db")
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", 10))
+# "threads" (grpc.server on a thread pool) or "aio" (grpc.aio server, the
+# blocking handlers on MAX_WORKERS threads for now, see aio_server.py)
+SERVER_MODE = os.getenv("SERVER_MODE", "threads")
+# More than 1 starts that many worker processes sharing the port (SO_REUSEPORT)
+SERVER_PROCESSES = int(os.getenv("SERVER_PROCESSES", 1))
+# Seconds in-flight calls get to finish after SIGTERM
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", 5))
+# "rollback" (SQLite default journal) or "wal" (WAL + single group-committing writer)
+DATABASE_MODE = os.getenv("DATABASE_MODE", "rollback")
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 100))
+# GetPrescription cache, READ_CACHE_SIZE=0 turns it off. Off with several
+# worker processes: a write only invalidates the cache of the process that
+# made it, the others would serve the old row until the TTL
+READ_CACHE_SIZE = int(os.getenv("READ_CACHE_SIZE", 10000)) if SERVER_PROCESSES == 1 else 0
+READ_CACHE_BYTES = int(os.getenv("READ_CACHE_BYTES", 64 * 1024 * 1024))
+READ_CACHE_TTL = float(os.getenv("READ_CACHE_TTL", 10))
+# WatchChanges: entries kept in the change log and how often watchers poll it
+CHANGE_LOG_RETENTION = int(os.getenv("CHANGE_LOG_RETENTION", 1000000))
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", 0.2))
+# Change streams (WatchChanges, Replicate) served at once, each on a thread
+# of its own on top of MAX_WORKERS so watchers never starve unary calls
+MAX_WATCHERS = int(os.getenv("MAX_WATCHERS", 16))
+
+# Pause between the steps of online migrations, leaving the writer to requests
+MIGRATION_PAUSE = float(os.getenv("MIGRATION_PAUSE", 0.05))
+
+# Append only; versions 1-2 are the schema as it was before migrations and
+# leave databases created back then unchanged
+MIGRATIONS = [
+    Migration(1, "create prescriptions", lambda connection: connection.execute('''
         CREATE TABLE IF NOT EXISTS prescriptions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             medication TEXT
         )
-    ''')
+    ''')),
+    Migration(2, "add prescriptions.version", lambda connection: add_column(
+        connection, "prescriptions", "version", "INTEGER NOT NULL DEFAULT 1")),
+    # Searched by ListPrescriptions' medication filters, see list_prescriptions_query().
+    # Index builds hold the write lock throughout, see migrations.py
+    Migration(3, "index prescriptions.medication", lambda connection: connection.execute(
+        "CREATE INDEX IF NOT EXISTS prescriptions_medication ON prescriptions (medication COLLATE NOCASE)")),
+]
+
+connection = sqlite3.connect(DATABASE, timeout=30)
+migrate(connection, MIGRATIONS)
+create_change_log(connection, "prescriptions", "prescription_changes", "prescription_id", CHANGE_LOG_RETENTION)
 connection.commit()
-cursor.close
-
-load_counter = 1
-
-def increase_load():
-    global load_counter
-    load_counter += 1
-
-def decrease_load():
-    global load_counter
-    load_counter -= 1
+connection.close()
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_SIZE = 10000
+
+# One connection per gRPC worker thread, reused across requests
+pool = ConnectionPool(DATABASE, max_size=MAX_WORKERS + MAX_WATCHERS, mode=DATABASE_MODE, max_batch=WRITE_BATCH_SIZE)
+# Prescriptions by id, invalidated after every write that changes or removes one
+prescription_cache = ReadCache("prescriptions", READ_CACHE_SIZE, READ_CACHE_BYTES, READ_CACHE_TTL)
+
+# Fed by LoadTrackingInterceptor, reported to discovery
+load_tracker = LoadTracker()
+watcher_slots = WatcherSlots(MAX_WATCHERS)
+# Per-worker loads shared with the parent in pre-fork mode
+worker_loads = None
+
+def current_load():
+    if worker_loads is not None:
+        return read_loads(worker_loads)
+    return load_tracker.snapshot()
+
+def parse_prescription_id(prescription_id):
+    try:
+        return int(prescription_id)
+    except ValueError:
+        return None
+
+def prescription_id_or_abort(context, prescription_id):
+    parsed = parse_prescription_id(prescription_id)
+    if parsed is None:
+        context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Invalid prescription ID {prescription_id!r}.")
+    return parsed
+
+def list_prescriptions_query(request, limit):
+    # The SELECT for a ListPrescriptions page and its parameters, None if the
+    # page_token is invalid. Rows are the page's sort key (NULL when it is the
+    # id) followed by id, medication and version.
+    #
+    # The medication index holds ids in order for each medication, but a
+    # medication_prefix page is read in medication order: ordered by id,
+    # SQLite prefers walking the primary key to sorting the matches. Page
+    # tokens are the last id, followed by ":" and its medication for those.
+    where, parameters = [], []
+    keyed = False
+    if request.medication:
+        where.append("medication = ? COLLATE NOCASE")
+        parameters.append(request.medication)
+    elif request.medication_prefix:
+        keyed = True
+    if request.medication_prefix:
+        where.append("medication LIKE ? ESCAPE '\\'")
+        parameters.append(like_prefix(request.medication_prefix))
+
+    if request.page_token:
+        after_id, separator, after_medication = request.page_token.partition(":")
+        after_id = parse_prescription_id(after_id)
+        # A token of another order is not one of this listing's
+        if after_id is None or bool(separator) != keyed:
+            return None
+        if keyed:
+            where.append("(medication COLLATE NOCASE, id) > (?, ?)")
+            parameters.extend((after_medication, after_id))
+        else:
+            where.append("id > ?")
+            parameters.append(after_id)
 
-def register_service(PRESCRIPTION_SERVICE_PORT):
-    with grpc.insecure_channel(SERVICE_DISCOVERY_URL) as channel:
-        stub = RegistrationServiceStub(channel)
-        registration_info = ServiceRegistration(
-            name=SERVICE_NAME,
-            host=SERVICE_HOSTNAME,
-            port=PRESCRIPTION_SERVICE_PORT  # The port where your Python service listens
-        )
-        stub.RegisterService(registration_info)
-        print("Service registered with the Node.js gateway")
-
-def deregister_service(PRESCRIPTION_SERVICE_PORT):
-    with grpc.insecure_channel(SERVICE_DISCOVERY_URL) as channel:
-        stub = RegistrationServiceStub(channel)
-        deregistration_request = DeregisterServiceRequest(
-            name=SERVICE_NAME,
-            host=SERVICE_HOSTNAME,
-            port=PRESCRIPTION_SERVICE_PORT  # The port where your Python service listens
-        )
-    stub.DeregisterService(deregistration_request)
-
-    return empty_pb2.Empty()
-
-def update_service_status(PRESCRIPTION_SERVICE_PORT):
-    global load_counter
-    with grpc.insecure_channel(SERVICE_DISCOVERY_URL) as channel:
-        stub = RegistrationServiceStub(channel)
-        status_request = SendServiceStatusRequest(
-            service_name=SERVICE_NAME,
-            port=PRESCRIPTION_SERVICE_PORT,
-            load=load_counter
-        )
-        stub.UpdateServiceStatus(status_request)
-        # print(f"Service status updated {load_counter}")
-
-def update_service_heartbeat(PRESCRIPTION_SERVICE_PORT):
-    with grpc.insecure_channel(SERVICE_DISCOVERY_URL) as channel:
-        stub = RegistrationServiceStub(channel)
-        heartbeat = Heartbeat(
-            service_name=SERVICE_NAME,
-            port=PRESCRIPTION_SERVICE_PORT
-        )
-        stub.UpdateServiceHeartbeat(heartbeat)
-        # print("Service heartbeat updated")
-        
-def update_service_status_and_heartbeat_periodically(PRESCRIPTION_SERVICE_PORT):
-    while True:
-        try:
-            update_service_status(PRESCRIPTION_SERVICE_PORT)
-            update_service_heartbeat(PRESCRIPTION_SERVICE_PORT)
-            # print("Service status and heartbeat sent")
-        except Exception as e:
-            print(f"Failed to send status and heartbeat: {e}")
-
-        # Adjust the sleep interval (in seconds) as needed
-        time.sleep(1)
+    sql = f"SELECT {'medication' if keyed else 'NULL'}, id, medication, version FROM prescriptions"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY medication COLLATE NOCASE, id LIMIT ?" if keyed else " ORDER BY id LIMIT ?"
+    return sql, parameters + [limit]
 
 class PrescriptionServicer(prescription_pb2_grpc.PrescriptionServiceServicer):
     def CreatePrescription(self, request, context):
-        increase_load()
-        connection = sqlite3.connect(DATABASE)
-        cursor = connection.cursor()
-        print(request.medication)
-        
-        cursor.execute(
-            "INSERT INTO prescriptions (medication) VALUES (?)",
-            (request.medication,)
-        )
-
-        connection.commit()
-
-        prescription_id = cursor.lastrowid
+        def insert(connection):
+            cursor = connection.execute(
+                "INSERT INTO prescriptions (medication) VALUES (?)",
+                (request.medication,)
+            )
+            return cursor.lastrowid
 
-        connection.close()
-        
+        prescription_id = pool.write(insert)
+        rpc_log.info("CreatePrescription", prescription_id=prescription_id)
         prescription = prescription_pb2.Prescription(
             id=str(prescription_id),
-            medication=request.medication
+            medication=request.medication,
+            version=1
         )
-        decrease_load()
         return prescription
 
     def GetPrescription(self, request, context):
-        increase_load()
-        connection = sqlite3.connect(DATABASE)
-        cursor = connection.cursor()
-
-        cursor.execute(
-            "SELECT id, medication FROM prescriptions WHERE id = ?",
-            (request.prescription_id,)
-        )
-
-        result = cursor.fetchone()
-        connection.close()
-
-        if result:
-            prescription = prescription_pb2.Prescription(
-                id=str(result[0]),
-                medication=result[1]
-            )
-            decrease_load()
+        prescription_id = prescription_id_or_abort(context, request.prescription_id)
+        prescription = prescription_cache.get(prescription_id)
+        if prescription is None and request.if_none_match:
+            # Revalidation: compare versions before reading the prescription
+            with pool.connection() as connection:
+                result = connection.execute(
+                    "SELECT version FROM prescriptions WHERE id = ?", (prescription_id,)).fetchone()
+            if result and result[0] == request.if_none_match:
+                return prescription_pb2.Prescription(id=request.prescription_id, version=result[0], not_modified=True)
+        if prescription is None:
+            generation = prescription_cache.generation
+            with pool.connection() as connection:
+                cursor = connection.cursor()
+
+                cursor.execute(
+                    "SELECT id, medication, version FROM prescriptions WHERE id = ?",
+                    (prescription_id,)
+                )
+
+                result = cursor.fetchone()
+                cursor.close()
+
+            if result:
+                with timed("build"):
+                    prescription = prescription_pb2.Prescription(
+                        id=str(result[0]),
+                        medication=result[1],
+                        version=result[2]
+                    )
+                prescription_cache.put(prescription_id, prescription, generation)
+
+        if prescription is not None:
+            if request.if_none_match and prescription.version == request.if_none_match:
+                return prescription_pb2.Prescription(id=prescription.id, version=prescription.version, not_modified=True)
             return prescription
         else:
             context.set_code(grpc.StatusCode.NOT_FOUND)
             context.set_details("Prescription not found")
-            decrease_load()
             return prescription_pb2.Prescription()
 
     def UpdatePrescription(self, request, context):
-        increase_load()
-        connection = sqlite3.connect(DATABASE)
-        cursor = connection.cursor()
-
-        cursor.execute(
-            "UPDATE prescriptions SET medication = ? WHERE id = ?",
-            (request.updated_medication, request.prescription_id)
-        )
-
-        connection.commit()
-        connection.close()
-        print(request.updated_medication)
-        print(request.prescription_id)
+        prescription_id = prescription_id_or_abort(context, request.prescription_id)
+        expected_version = request.expected_version
+
+        def update(connection):
+            # expected_version 0 updates whatever the current version is
+            updated = connection.execute(
+                "UPDATE prescriptions SET medication = ?, version = version + 1 WHERE id = ? AND (? = 0 OR version = ?)",
+                (request.updated_medication, prescription_id, expected_version, expected_version)
+            ).rowcount
+            result = connection.execute(
+                "SELECT version FROM prescriptions WHERE id = ?", (prescription_id,)).fetchone()
+            return updated, result[0] if result else None
+
+        updated, version = pool.write(update)
+        if version is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, "Prescription not found")
+        if not updated:
+            context.abort(grpc.StatusCode.ABORTED,
+                          f"Prescription {request.prescription_id} is at version {version}, not {expected_version}.")
+        prescription_cache.invalidate([prescription_id])
+        rpc_log.info("UpdatePrescription", prescription_id=request.prescription_id, version=version)
         # Return the updated prescription
         prescription = prescription_pb2.Prescription(
             id=request.prescription_id,
-            medication=request.updated_medication
+            medication=request.updated_medication,
+            version=version
         )
-        decrease_load()
         return prescription
 
     def DeletePrescription(self, request, context):
-        increase_load()
-        connection = sqlite3.connect(DATABASE)
-        cursor = connection.cursor()
-
-        cursor.execute(
+        prescription_id = prescription_id_or_abort(context, request.prescription_id)
+        pool.write(lambda connection: connection.execute(
             "DELETE FROM prescriptions WHERE id = ?",
-            (request.prescription_id,)
-        )
-
-        connection.commit()
-        connection.close()
+            (prescription_id,)
+        ))
+        prescription_cache.invalidate([prescription_id])
 
-        decrease_load()
         return empty_pb2.Empty()
 
+    def ListPrescriptions(self, request, context):
+        page_size = request.page_size or DEFAULT_PAGE_SIZE
+        # Fetch one extra row to know whether there is a next page
+        query = list_prescriptions_query(request, min(page_size, MAX_PAGE_SIZE) + 1)
+        if page_size < 0 or query is None:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid page_size or page_token.")
+        page_size = min(page_size, MAX_PAGE_SIZE)
+
+        with pool.connection() as connection:
+            rows = connection.execute(*query).fetchall()
+
+        next_page_token = ''
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            key, prescription_id = rows[-1][0], rows[-1][1]
+            next_page_token = str(prescription_id) if key is None else f"{prescription_id}:{key}"
+
+        with timed("build"):
+            prescriptions = [prescription_pb2.Prescription(id=str(row[1]), medication=row[2], version=row[3]) for row in rows]
+            return prescription_pb2.ListPrescriptionsResponse(prescriptions=prescriptions, next_page_token=next_page_token)
+
     def SendPrescriptionByEmail(self, request, context):
-        # increase_load()
         return empty_pb2.Empty()
 
+    def BatchCreatePrescriptions(self, request, context):
+        if len(request.prescriptions) > MAX_BATCH_SIZE:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(f"At most {MAX_BATCH_SIZE} prescriptions per batch.")
+            return prescription_pb2.BatchPrescriptionsResponse()
+
+        rows = [(p.medication,) for p in request.prescriptions]
+
+        def insert(connection):
+            connection.executemany("INSERT INTO prescriptions (medication) VALUES (?)", rows)
+            # AUTOINCREMENT ids of one statement in one transaction are consecutive
+            return connection.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+        first_id = pool.write(insert) - len(rows) + 1 if rows else 0
+        results = [prescription_pb2.BatchPrescriptionResult(
+            prescription_id=str(first_id + i),
+            ok=True,
+            prescription=prescription_pb2.Prescription(id=str(first_id + i), medication=medication, version=1)
+        ) for i, (medication,) in enumerate(rows)]
+
+        return prescription_pb2.BatchPrescriptionsResponse(results=results)
+
+    def BatchGetPrescriptions(self, request, context):
+        if len(request.prescription_ids) > MAX_BATCH_SIZE:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(f"At most {MAX_BATCH_SIZE} prescriptions per batch.")
+            return prescription_pb2.BatchPrescriptionsResponse()
+
+        ids = {parse_prescription_id(prescription_id) for prescription_id in request.prescription_ids} - {None}
+        rows = []
+        with pool.connection() as connection:
+            for chunk in batched(ids):
+                rows += connection.execute(
+                    f"SELECT id, medication, version FROM prescriptions WHERE id IN ({placeholders(len(chunk))})",
+                    chunk
+                ).fetchall()
+
+        with timed("build"):
+            found = {row[0]: prescription_pb2.Prescription(id=str(row[0]), medication=row[1], version=row[2])
+                     for row in rows}
+            results = []
+            for prescription_id in request.prescription_ids:
+                prescription = found.get(parse_prescription_id(prescription_id))
+                if prescription:
+                    results.append(prescription_pb2.BatchPrescriptionResult(
+                        prescription_id=prescription_id, ok=True, prescription=prescription))
+                else:
+                    results.append(prescription_pb2.BatchPrescriptionResult(
+                        prescription_id=prescription_id, error="Prescription not found"))
+            return prescription_pb2.BatchPrescriptionsResponse(results=results)
+
+    def BatchDeletePrescriptions(self, request, context):
+        if len(request.prescription_ids) > MAX_BATCH_SIZE:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(f"At most {MAX_BATCH_SIZE} prescriptions per batch.")
+            return prescription_pb2.BatchPrescriptionsResponse()
+
+        ids = {parse_prescription_id(prescription_id) for prescription_id in request.prescription_ids} - {None}
+
+        def delete(connection):
+            deleted = set()
+            for chunk in batched(ids):
+                in_clause = placeholders(len(chunk))
+                deleted.update(row[0] for row in connection.execute(
+                    f"SELECT id FROM prescriptions WHERE id IN ({in_clause})", chunk))
+                connection.execute(f"DELETE FROM prescriptions WHERE id IN ({in_clause})", chunk)
+            return deleted
+
+        deleted = pool.write(delete) if ids else set()
+        prescription_cache.invalidate(deleted)
+        results = []
+        for prescription_id in request.prescription_ids:
+            if parse_prescription_id(prescription_id) in deleted:
+                results.append(prescription_pb2.BatchPrescriptionResult(prescription_id=prescription_id, ok=True))
+            else:
+                results.append(prescription_pb2.BatchPrescriptionResult(
+                    prescription_id=prescription_id, error="Prescription not found"))
+
+        return prescription_pb2.BatchPrescriptionsResponse(results=results)
+
+    def WatchChanges(self, request, context):
+        with watcher_slots.hold(context):
+            changes = watch_changes(pool, "prescription_changes", "prescription_id", request.after_offset,
+                                    request.from_now, context, WATCH_POLL_INTERVAL)
+            for offset, op, prescription_id, version in changes:
+                yield prescription_pb2.Change(offset=offset, op=op, prescription_id=str(prescription_id),
+                                              version=version)
+
     def GetServiceStatus(self, request, context):
-        # increase_load()
         return prescription_pb2.ServiceStatus(is_healthy=True)
 
-def serve(PRESCRIPTION_SERVICE_PORT):
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), interceptors=(PromServerInterceptor(),))
+def create_server(PRESCRIPTION_SERVICE_PORT):
+    interceptors = [LoadTrackingInterceptor(load_tracker), PromServerInterceptor()]
+    tracing = tracing_from_env()
+    if tracing:
+        # Outermost, so the call's span covers the other interceptors
+        interceptors.insert(0, tracing)
+    stage_metrics = stage_metrics_from_env()
+    if stage_metrics:
+        interceptors.append(stage_metrics)
+    fault_injector = fault_injection_from_env()
+    if fault_injector:
+        interceptors.append(fault_injector)
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=MAX_WORKERS + MAX_WATCHERS),
+        interceptors=interceptors,
+        options=[("grpc.so_reuseport", 1)]
+    )
     prescription_pb2_grpc.add_PrescriptionServiceServicer_to_server(PrescriptionServicer(), server)
     server.add_insecure_port(f'[::]:{PRESCRIPTION_SERVICE_PORT}')
+    return server
+
+def stop_on_sigterm(server, on_shutdown=None):
+    # Leave discovery first so the gateway stops routing here, then let
+    # in-flight calls finish
+    def stop(signum, frame):
+        if on_shutdown:
+            on_shutdown()
+        server.stop(SHUTDOWN_GRACE)
+
+    signal.signal(signal.SIGTERM, stop)
+
+def serve(PRESCRIPTION_SERVICE_PORT, on_shutdown=None):
+    server = create_server(PRESCRIPTION_SERVICE_PORT)
     server.start()
-    print(f"Server started on port {PRESCRIPTION_SERVICE_PORT}")
+    stop_on_sigterm(server, on_shutdown)
+    log.info("Server started on port %s", PRESCRIPTION_SERVICE_PORT)
     start_http_server(PROMETHEUS_PORT, SERVICE_HOSTNAME)
-    print(f"Prometheus started on port {PROMETHEUS_PORT}")
-    server.wait_for_termination()
+    log.info("Prometheus started on port %s", PROMETHEUS_PORT)
+    try:
+        server.wait_for_termination()
+    finally:
+        pool.close()
+
+def serve_worker(PRESCRIPTION_SERVICE_PORT, shared_worker_loads, index):
+    # Runs in a spawned worker process: no registration, heartbeat or /metrics
+    # server of its own, the parent does those for all workers.
+    publish_load(shared_worker_loads, index, load_tracker.snapshot)
+    server = create_server(PRESCRIPTION_SERVICE_PORT)
+    server.start()
+    stop_on_sigterm(server)
+    log.info("Worker %s (pid %s) serving on port %s", index, os.getpid(), PRESCRIPTION_SERVICE_PORT)
+    try:
+        server.wait_for_termination()
+    finally:
+        pool.close()
+
+def serve_prefork(PRESCRIPTION_SERVICE_PORT, processes, on_shutdown=None):
+    global worker_loads
+    prepare_multiprocess_metrics()
+    worker_loads = shared_loads(processes)
+    start_multiprocess_metrics_server(PROMETHEUS_PORT, SERVICE_HOSTNAME)
+    log.info("Prometheus started on port %s", PROMETHEUS_PORT)
+    run_workers(serve_worker, processes, PRESCRIPTION_SERVICE_PORT, worker_loads, on_shutdown)
+
+async def serve_aio(PRESCRIPTION_SERVICE_PORT, on_shutdown=None, discovery=None):
+    # discovery: a DiscoveryClient to report status from this event loop
+    executor = futures.ThreadPoolExecutor(max_workers=MAX_WORKERS + MAX_WATCHERS)
+    interceptors = [PromAioServerInterceptor()]
+    fault_injector = fault_injection_from_env(aio=True)
+    if fault_injector:
+        interceptors.append(fault_injector)
+    server = grpc.aio.server(interceptors=interceptors)
+    sync_interceptors = [LoadTrackingInterceptor(load_tracker)]
+    tracing = tracing_from_env()
+    if tracing:
+        sync_interceptors.insert(0, tracing)
+    stage_metrics = stage_metrics_from_env()
+    if stage_metrics:
+        sync_interceptors.append(stage_metrics)
+    server.add_generic_rpc_handlers((AsyncServicerAdapter(prescription_pb2_grpc.add_PrescriptionServiceServicer_to_server, PrescriptionServicer(), executor, sync_interceptors),))
+    server.add_insecure_port(f'[::]:{PRESCRIPTION_SERVICE_PORT}')
+    await server.start()
+    log.info("Server (aio) started on port %s", PRESCRIPTION_SERVICE_PORT)
+    start_http_server(PROMETHEUS_PORT, SERVICE_HOSTNAME)
+    log.info("Prometheus started on port %s", PROMETHEUS_PORT)
+
+    loop = asyncio.get_running_loop()
+    reporting = asyncio.ensure_future(discovery.run_async(current_load)) if discovery else None
+
+    async def stop():
+        if reporting:
+            # A late status report would mark us alive again
+            reporting.cancel()
+        if on_shutdown:
+            await loop.run_in_executor(None, on_shutdown)
+        await server.stop(SHUTDOWN_GRACE)
+
+    loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(stop()))
+    try:
+        await server.wait_for_termination()
+    finally:
+        if reporting:
+            reporting.cancel()
+        executor.shutdown()
+        pool.close()
 
 if __name__ == '__main__':
-    register_service(PRESCRIPTION_SERVICE_PORT)
-    status_heartbeat_thread = threading.Thread(target=update_service_status_and_heartbeat_periodically, args=(PRESCRIPTION_SERVICE_PORT,))
-    status_heartbeat_thread.daemon = True
-    status_heartbeat_thread.start()
-
-    serve(PRESCRIPTION_SERVICE_PORT)
+    if sys.argv[1:] == ["migrate"]:
+        # Pre-deploy: importing applied the plain migrations, finish the online ones
+        run_online_migrations(pool, MIGRATIONS)
+        sys.exit()
+    discovery = DiscoveryClient(SERVICE_DISCOVERY_URL, SERVICE_NAME, SERVICE_HOSTNAME, PRESCRIPTION_SERVICE_PORT)
+    discovery.register()
+    if SERVER_MODE != "aio" or SERVER_PROCESSES > 1:
+        # serve_aio reports from its event loop
+        discovery.start(current_load)
+    start_online_migrations(pool, MIGRATIONS, MIGRATION_PAUSE)
+    try:
+        if SERVER_PROCESSES > 1:
+            serve_prefork(PRESCRIPTION_SERVICE_PORT, SERVER_PROCESSES, discovery.deregister)
+        elif SERVER_MODE == "aio":
+            asyncio.run(serve_aio(PRESCRIPTION_SERVICE_PORT, discovery.deregister, discovery))
+        else:
+            serve(PRESCRIPTION_SERVICE_PORT, discovery.deregister)
+    finally:
+        discovery.deregister()
+        discovery.close()
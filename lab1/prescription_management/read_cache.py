@@ -0,0 +1,97 @@
+import collections
+import threading
+import time
+
+from prometheus_client import Counter, Gauge
+
+# Shared by the records and prescription services, keep both copies in sync.
+#
+# Each process caches on its own: with several instances on one database, a
+# write only invalidates the cache of the process that made it and the others
+# may serve the old row for up to the TTL. The services turn the cache off
+# when they run SERVER_PROCESSES > 1 workers for that reason.
+
+CACHE_HITS = Counter("read_cache_hits_total", "Reads served from the in-process cache", ["cache"])
+CACHE_MISSES = Counter("read_cache_misses_total", "Reads that went to SQLite", ["cache"])
+CACHE_EVICTIONS = Counter("read_cache_evictions_total", "Entries dropped to stay within the limits or expired", ["cache", "reason"])
+CACHE_ENTRIES = Gauge("read_cache_entries", "Entries in the in-process cache", ["cache"], multiprocess_mode="livesum")
+CACHE_BYTES = Gauge("read_cache_bytes", "Serialized size of the cached messages", ["cache"], multiprocess_mode="livesum")
+
+
+class ReadCache:
+    """LRU cache of protobuf messages bounded by entries, bytes and age.
+
+    Callers read `generation` before querying and pass it to put(): a write
+    that invalidates in the meantime bumps it, so a row read before that write
+    committed is not cached. max_entries=0 disables the cache.
+    """
+
+    def __init__(self, name, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=10.0):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = CACHE_HITS.labels(name)
+        self._misses = CACHE_MISSES.labels(name)
+        self._entries_gauge = CACHE_ENTRIES.labels(name)
+        self._bytes_gauge = CACHE_BYTES.labels(name)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._remove(key, "expired")
+                self._update_gauges()
+                entry = None
+            if entry is None:
+                self._misses.inc()
+                return None
+            self._entries.move_to_end(key)
+        self._hits.inc()
+        return entry[0]
+
+    def put(self, key, message, generation):
+        if not self.max_entries:
+            return
+        size = message.ByteSize()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (message, size, time.monotonic() + self.ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)), "size")
+            self._update_gauges()
+
+    def invalidate(self, keys):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+            self._update_gauges()
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._bytes = 0
+            self._update_gauges()
+
+    def _remove(self, key, reason=None):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+        if reason:
+            CACHE_EVICTIONS.labels(self.name, reason).inc()
+
+    def _update_gauges(self):
+        self._entries_gauge.set(len(self._entries))
+        self._bytes_gauge.set(self._bytes)
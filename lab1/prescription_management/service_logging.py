@@ -0,0 +1,155 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+from prometheus_client import Counter
+
+# Shared by the records and prescription services, keep both copies in sync.
+#
+# Logs are JSON lines on stdout. A call that logs only puts the record on a
+# bounded queue, a background thread formats and writes it; when the writer
+# falls behind, records are dropped (and counted) rather than making calls
+# wait. Per-request records go through a SampledLogger, which keeps
+# LOG_SAMPLE_RATE of them and decides before building anything.
+#
+#   LOG_LEVEL        DEBUG, INFO (default), WARNING, ...
+#   LOG_SAMPLE_RATE  share of the per-request records kept, 0-1
+#   LOG_QUEUE_SIZE   records waiting for the writer before new ones are dropped
+#
+# Patient data is never written: fields named in REDACTED_FIELDS, whether
+# extra= fields of a record or fields of a dict or protobuf message in one,
+# are replaced. Messages themselves should not carry any.
+
+REDACTED_FIELDS = frozenset({"name", "medical_history", "updated_medical_history", "entry", "medication",
+                             "updated_medication", "email", "query"})
+REDACTED = "[redacted]"
+
+LOG_RECORDS_DROPPED = Counter("log_records_dropped_total", "Log records dropped because the log writer fell behind")
+
+# Attributes every LogRecord has, the rest were passed in extra=
+_STANDARD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+_listener = None
+_handler = None
+
+
+def redact(value):
+    """value with REDACTED_FIELDS replaced, protobuf messages as dicts."""
+    if isinstance(value, dict):
+        return {key: REDACTED if key in REDACTED_FIELDS else redact(item) for key, item in value.items()}
+    if hasattr(value, "ListFields"):
+        return {field.name: REDACTED if field.name in REDACTED_FIELDS else redact(item)
+                for field, item in value.ListFields()}
+    if isinstance(value, (list, tuple)) or type(value).__name__.startswith("Repeated"):
+        return [redact(item) for item in value]
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, service=None):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if self.service:
+            entry["service"] = self.service
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRIBUTES:
+                entry[key] = REDACTED if key in REDACTED_FIELDS else redact(value)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of failing."""
+
+    def prepare(self, record):
+        # Only what cannot wait for the writer: the arguments are merged and
+        # the traceback rendered while they are current
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+class StdoutHandler(logging.StreamHandler):
+    """StreamHandler on whatever sys.stdout is when it writes."""
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class SampledLogger:
+    """Logs `rate` of its calls at INFO, for records logged on every request."""
+
+    def __init__(self, logger, rate):
+        self.logger = logger
+        self.rate = rate
+
+    def info(self, message, **fields):
+        if (self.rate >= 1 or random.random() < self.rate) and self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(message, extra=fields)
+
+
+def request_logger(name):
+    return SampledLogger(logging.getLogger(name), float(os.getenv("LOG_SAMPLE_RATE", 0.01)))
+
+
+def configure_logging(service, level=None, queue_size=None, stream_handler=None):
+    """Send every log record through the queue to the JSON writer, once per process."""
+    global _listener, _handler
+    if _listener is not None:
+        return _listener
+    level = level or os.getenv("LOG_LEVEL", "INFO").upper()
+    queue_size = queue_size or int(os.getenv("LOG_QUEUE_SIZE", 10000))
+
+    records = queue.Queue(queue_size)
+    writer = stream_handler or StdoutHandler()
+    writer.setFormatter(JsonFormatter(service))
+    _listener = logging.handlers.QueueListener(records, writer)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    _handler = DroppingQueueHandler(records)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Write out what is still queued and stop the writer thread."""
+    global _listener, _handler
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_handler)
+    _listener.stop()
+    _listener = _handler = None
@@ -1,22 +1,48 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
 import unittest
+
+# prescription_server reads its settings on import: without them, the tests
+# get a throwaway database rather than the shipped one
+os.environ.setdefault("PRESCRIPTION_DATABASE", os.path.join(tempfile.mkdtemp(), "prescriptions.db"))
+os.environ.setdefault("PRESCRIPTION_SERVICE_PORT", "0")
+os.environ.setdefault("PROMETHEUS_PORT", "0")
+
 import grpc
 import prescription_pb2
 import prescription_pb2_grpc
-from prescription_server import PrescriptionServicer
+import prescription_server
+from prescription_server import MIGRATIONS, PrescriptionServicer, list_prescriptions_query, pool
 from concurrent import futures
+from google.protobuf import empty_pb2
+from db_pool import ConnectionPool, SingleWriter
+from fault_injection import FaultInjectionInterceptor
+from discovery_client import DiscoveryClient
+from load_tracking import Load, LoadTracker, LoadTrackingInterceptor
+from read_cache import ReadCache
+from change_log import WatcherSlots, create_change_log, watch_changes
+from load_harness import free_port
+from migrations import Migration, add_column, migrate, run_online_migrations
+import registration_pb2_grpc
+import sqlite3
+import threading
+import uuid
 
 class TestPrescriptionService(unittest.TestCase):
     def setUp(self):
         self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
         prescription_pb2_grpc.add_PrescriptionServiceServicer_to_server(
             PrescriptionServicer(), self.server)
-        self.server.add_insecure_port('[::]:50051')  # Use the correct port
+        port = self.server.add_insecure_port('localhost:0')
         self.server.start()
-        self.channel = grpc.insecure_channel('localhost:50051')  # Use the correct host and port
+        self.channel = grpc.insecure_channel(f'localhost:{port}')
         self.stub = prescription_pb2_grpc.PrescriptionServiceStub(self.channel)
 
     def tearDown(self):
-        # Stop the gRPC server
+        self.channel.close()
         self.server.stop(0)
 
     # Write test methods for the service's functionality
@@ -31,14 +57,623 @@ class TestPrescriptionService(unittest.TestCase):
         self.assertEqual(response.medication, "MedicationName")
 
     def test_GetPrescription(self):
-        # Create a request
-        request = prescription_pb2.GetPrescriptionRequest(prescription_id="6")
+        created = self.stub.CreatePrescription(prescription_pb2.CreatePrescriptionRequest(medication="MedicationName"))
+        request = prescription_pb2.GetPrescriptionRequest(prescription_id=created.id)
 
         # Call the service method
         response = self.stub.GetPrescription(request)
 
         # Assert the response and test for correctness
-        self.assertEqual(response.id, "6")
+        self.assertEqual(response.id, created.id)
+        self.assertEqual(response.medication, "MedicationName")
+
+    def test_BatchCreateAndGetPrescriptions(self):
+        created = self.stub.BatchCreatePrescriptions(prescription_pb2.BatchCreatePrescriptionsRequest(
+            prescriptions=[prescription_pb2.CreatePrescriptionRequest(medication=m) for m in ("A", "B")]))
+        ids = [result.prescription_id for result in created.results]
+
+        response = self.stub.BatchGetPrescriptions(
+            prescription_pb2.BatchGetPrescriptionsRequest(prescription_ids=ids + ["not-an-id"]))
+
+        self.assertEqual([r.prescription.medication for r in response.results[:2]], ["A", "B"])
+        self.assertFalse(response.results[2].ok)
+
+    def test_UpdateAndDeleteInvalidateCachedPrescription(self):
+        created = self.stub.CreatePrescription(prescription_pb2.CreatePrescriptionRequest(medication="Before"))
+        get = prescription_pb2.GetPrescriptionRequest(prescription_id=created.id)
+        self.stub.GetPrescription(get)
+
+        self.stub.UpdatePrescription(prescription_pb2.UpdatePrescriptionRequest(
+            prescription_id=created.id, updated_medication="After"))
+        updated = self.stub.GetPrescription(get)
+        self.stub.DeletePrescription(prescription_pb2.DeletePrescriptionRequest(prescription_id=created.id))
+
+        with self.assertRaises(grpc.RpcError) as error:
+            self.stub.GetPrescription(get)
+        self.assertEqual(updated.medication, "After")
+        self.assertEqual(error.exception.code(), grpc.StatusCode.NOT_FOUND)
+
+
+    def test_ConditionalGetAndUpdate(self):
+        created = self.stub.CreatePrescription(prescription_pb2.CreatePrescriptionRequest(medication="Before"))
+
+        unchanged = self.stub.GetPrescription(prescription_pb2.GetPrescriptionRequest(
+            prescription_id=created.id, if_none_match=created.version))
+        with self.assertRaises(grpc.RpcError) as error:
+            self.stub.UpdatePrescription(prescription_pb2.UpdatePrescriptionRequest(
+                prescription_id=created.id, updated_medication="After", expected_version=created.version + 1))
+        updated = self.stub.UpdatePrescription(prescription_pb2.UpdatePrescriptionRequest(
+            prescription_id=created.id, updated_medication="After", expected_version=created.version))
+
+        self.assertTrue(unchanged.not_modified)
+        self.assertEqual(error.exception.code(), grpc.StatusCode.ABORTED)
+        self.assertEqual(updated.version, created.version + 1)
+
+    def test_NonNumericPrescriptionIdIsInvalid(self):
+        calls = [
+            (self.stub.GetPrescription, prescription_pb2.GetPrescriptionRequest(prescription_id="abc")),
+            (self.stub.UpdatePrescription, prescription_pb2.UpdatePrescriptionRequest(
+                prescription_id="abc", updated_medication="m")),
+            (self.stub.DeletePrescription, prescription_pb2.DeletePrescriptionRequest(prescription_id="")),
+        ]
+        for call, request in calls:
+            with self.subTest(request=type(request).__name__):
+                with self.assertRaises(grpc.RpcError) as error:
+                    call(request)
+                self.assertEqual(error.exception.code(), grpc.StatusCode.INVALID_ARGUMENT)
+
+    def test_ListPrescriptionsByMedication(self):
+        # Medications no other run of the suite has written
+        name = "m" + uuid.uuid4().hex
+        created = self.stub.BatchCreatePrescriptions(prescription_pb2.BatchCreatePrescriptionsRequest(
+            prescriptions=[prescription_pb2.CreatePrescriptionRequest(medication=m)
+                           for m in (f"{name}-b", f"{name}-a", f"{name.upper()}-A", f"{name}_c")]))
+        ids = [result.prescription_id for result in created.results]
+        list_prescriptions = lambda **kwargs: self.stub.ListPrescriptions(
+            prescription_pb2.ListPrescriptionsRequest(**kwargs))
+
+        exact = list_prescriptions(medication=f"{name}-a")
+        first = list_prescriptions(medication_prefix=f"{name}-", page_size=2)
+        second = list_prescriptions(medication_prefix=f"{name}-", page_size=2, page_token=first.next_page_token)
+        # "_" and "%" are matched literally
+        underscore = list_prescriptions(medication_prefix=f"{name}_")
+        with self.assertRaises(grpc.RpcError) as error:
+            list_prescriptions(page_token="not-an-id")
+
+        self.assertEqual([p.id for p in exact.prescriptions], [ids[1], ids[2]])
+        self.assertEqual([p.id for p in first.prescriptions] + [p.id for p in second.prescriptions],
+                         [ids[1], ids[2], ids[0]])
+        self.assertEqual(second.next_page_token, '')
+        self.assertEqual([p.id for p in underscore.prescriptions], [ids[3]])
+        self.assertEqual(error.exception.code(), grpc.StatusCode.INVALID_ARGUMENT)
+
+    def test_FilteredListsSearchTheMedicationIndex(self):
+        run_online_migrations(pool, MIGRATIONS)
+        requests = [
+            prescription_pb2.ListPrescriptionsRequest(medication="Amoxicillin", page_token="5"),
+            prescription_pb2.ListPrescriptionsRequest(medication_prefix="Amox", page_token="5:Amoxicillin"),
+            prescription_pb2.ListPrescriptionsRequest(medication="Amoxicillin", medication_prefix="Amox"),
+        ]
+        for request in requests:
+            sql, parameters = list_prescriptions_query(request, 10)
+            with self.subTest(request=request), pool.connection() as connection:
+                # EXPLAIN does not notice a schema changed by another connection, a query does
+                connection.execute("SELECT count(*) FROM sqlite_master").fetchone()
+                plan = [row[3] for row in connection.execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+                self.assertFalse([step for step in plan if step.startswith("SCAN")], plan)
+                self.assertIn("INDEX prescriptions_medication", plan[0])
+                self.assertNotIn("TEMP B-TREE", " ".join(plan))
+
+class TestFaultInjection(unittest.TestCase):
+    def setUp(self):
+        interceptor = FaultInjectionInterceptor(error_rate=1.0, methods=["GetServiceStatus"])
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=2), interceptors=(interceptor,))
+        prescription_pb2_grpc.add_PrescriptionServiceServicer_to_server(
+            PrescriptionServicer(), self.server)
+        port = self.server.add_insecure_port('localhost:0')
+        self.server.start()
+        self.channel = grpc.insecure_channel(f'localhost:{port}')
+        self.stub = prescription_pb2_grpc.PrescriptionServiceStub(self.channel)
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(0)
+
+    def test_TargetedMethodFails(self):
+        with self.assertRaises(grpc.RpcError) as error:
+            self.stub.GetServiceStatus(empty_pb2.Empty())
+
+        self.assertEqual(error.exception.code(), grpc.StatusCode.UNAVAILABLE)
+
+    def test_OtherMethodsAreUntouched(self):
+        response = self.stub.SendPrescriptionByEmail(
+            prescription_pb2.SendPrescriptionByEmailRequest(prescription_id="1"))
+
+        self.assertEqual(response, empty_pb2.Empty())
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        fd, self.database = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.pool = ConnectionPool(self.database, max_size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        os.remove(self.database)
+
+    def test_ConnectionIsReusedWithinThread(self):
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+
+    def test_EachThreadGetsItsOwnConnection(self):
+        connections = []
+        worker = threading.Thread(target=lambda: connections.append(self.pool.acquire()))
+        worker.start()
+        worker.join()
+
+        self.assertIsNot(connections[0], self.pool.acquire())
+
+    def test_ClosedPoolRefusesConnections(self):
+        self.pool.acquire()
+        self.pool.close()
+
+        with self.assertRaises(RuntimeError):
+            self.pool.acquire()
+
+    def test_BackgroundThreadsTakeNoSlot(self):
+        pool = ConnectionPool(self.database, max_size=1, timeout=0.5)
+        pool.write(lambda connection: connection.execute("CREATE TABLE items (id INTEGER PRIMARY KEY)"))
+        results = []
+
+        def background_job():
+            with pool.background():
+                pool.write(lambda connection: connection.execute("INSERT INTO items VALUES (1)"))
+                with pool.connection() as connection:
+                    results.append(connection.execute("SELECT COUNT(*) FROM items").fetchone()[0])
+            # Its connection was closed, the pool's only slot is still the test's
+            try:
+                pool.acquire()
+            except TimeoutError:
+                results.append("no slot")
+
+        worker = threading.Thread(target=background_job)
+        worker.start()
+        worker.join()
+        pool.close()
+
+        self.assertEqual(results, [1, "no slot"])
+
+    def test_WalModeGroupCommitsConcurrentWrites(self):
+        pool = ConnectionPool(self.database, max_size=4, mode="wal")
+        pool.write(lambda connection: connection.execute("CREATE TABLE items (id INTEGER PRIMARY KEY)"))
+        with futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(
+                lambda i: pool.write(lambda connection: connection.execute("INSERT INTO items VALUES (?)", (i,))),
+                range(50)
+            ))
+
+        with pool.connection() as connection:
+            journal_mode = connection.execute("PRAGMA journal_mode").fetchone()[0]
+            count = connection.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+        pool.close()
+
+        self.assertEqual(journal_mode, "wal")
+        self.assertEqual(count, 50)
+
+    def test_FailedWriteDoesNotAbortItsBatch(self):
+        pool = ConnectionPool(self.database, mode="wal")
+        pool.write(lambda connection: connection.execute("CREATE TABLE items (id INTEGER PRIMARY KEY)"))
+        pool.write(lambda connection: connection.execute("INSERT INTO items VALUES (1)"))
+
+        with self.assertRaises(Exception):
+            pool.write(lambda connection: connection.execute("INSERT INTO items VALUES (1)"))
+        pool.write(lambda connection: connection.execute("INSERT INTO items VALUES (2)"))
+
+        with pool.connection() as connection:
+            count = connection.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+        pool.close()
+        self.assertEqual(count, 2)
+
+    def test_WriterThatFailsFailsItsWrites(self):
+        pool = ConnectionPool(os.path.join(tempfile.mkdtemp(), "missing", "items.db"), mode="wal", timeout=5)
+
+        # The writer thread cannot connect: each write fails rather than waits forever
+        for _ in range(2):
+            with self.assertRaises(sqlite3.OperationalError):
+                pool.write(lambda connection: connection.execute("CREATE TABLE items (id INTEGER PRIMARY KEY)"))
+        pool.close()
+
+    def test_ClosedWriterRefusesWrites(self):
+        writer = SingleWriter(self.database)
+        writer.close()
+
+        with self.assertRaises(RuntimeError):
+            writer.submit(lambda connection: connection.execute("CREATE TABLE items (id INTEGER PRIMARY KEY)"))
+
+    def test_WriteWaitsAtMostTheTimeout(self):
+        pool = ConnectionPool(self.database, mode="wal", timeout=0.1)
+
+        with self.assertRaises(TimeoutError):
+            pool.write(lambda connection: time.sleep(0.5))
+        pool.close()
+
+
+class FakeDiscovery(registration_pb2_grpc.RegistrationServiceServicer):
+    def __init__(self):
+        self.calls = []
+
+    def RegisterService(self, request, context):
+        self.calls.append(("register", request.name, request.port))
+        return empty_pb2.Empty()
+
+    def DeregisterService(self, request, context):
+        self.calls.append(("deregister", request.name, request.port))
+        return empty_pb2.Empty()
+
+    def UpdateServiceStatus(self, request, context):
+        self.calls.append(("status", request.service_name, request.in_flight, request.queue_depth))
+        return empty_pb2.Empty()
+
+
+class TestDiscoveryClient(unittest.TestCase):
+    def setUp(self):
+        self.discovery = FakeDiscovery()
+        self.server, self.port = self.start_discovery()
+        self.client = DiscoveryClient(f'localhost:{self.port}', "prescriptions-service", "localhost", 50052, interval=0.01)
+
+    def start_discovery(self, port=0):
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+        registration_pb2_grpc.add_RegistrationServiceServicer_to_server(self.discovery, server)
+        port = server.add_insecure_port(f'localhost:{port}')
+        server.start()
+        return server, port
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop(0)
+
+    def test_RegisterReportAndDeregisterOnce(self):
+        self.client.register()
+        self.client.report(Load(2, 1, 5.0, 10.0))
+        self.client.deregister()
+        self.client.deregister()
+
+        self.assertEqual(self.discovery.calls, [
+            ("register", "prescriptions-service", 50052),
+            ("status", "prescriptions-service", 2, 1),
+            ("deregister", "prescriptions-service", 50052),
+        ])
+
+    def test_BacksOffWhileUnreachableThenRegistersAgain(self):
+        self.server.stop(0).wait()
+        delays = [self.client.report(Load(1, 0, 0.0, 0.0)) for _ in range(3)]
+        for failures, delay in enumerate(delays, 1):
+            self.assertGreaterEqual(delay, 0.01 * 2 ** failures / 2)
+            self.assertLessEqual(delay, 0.01 * 2 ** failures)
+
+        self.server, _ = self.start_discovery(self.port)
+        grpc.channel_ready_future(self.client._channel).result(timeout=10)
+        self.assertLessEqual(self.client.report(Load(2, 0, 0.0, 0.0)), 0.011)
+        self.assertEqual(self.discovery.calls, [
+            ("status", "prescriptions-service", 2, 0),
+            ("register", "prescriptions-service", 50052),
+        ])
+
+    def test_KeepsReportingWhenStalenessFails(self):
+        # One for report(), one for the reporting thread
+        failures = [sqlite3.OperationalError("database is locked")] * 2
+
+        def staleness():
+            if failures:
+                raise failures.pop()
+            return 0.5
+
+        client = DiscoveryClient(f'localhost:{self.port}', "prescriptions-service", "localhost", 50052,
+                                 interval=0.01, staleness=staleness)
+        with self.assertLogs("discovery_client", logging.ERROR) as logs:
+            delay = client.report(Load(1, 0, 0.0, 0.0))
+            client.start(lambda: Load(3, 0, 0.0, 0.0))
+            deadline = time.monotonic() + 10
+            while ("status", "prescriptions-service", 3, 0) not in self.discovery.calls and time.monotonic() < deadline:
+                time.sleep(0.01)
+            client.close()
+
+        self.assertGreaterEqual(delay, 0.01)
+        self.assertLessEqual(delay, 0.02)
+        self.assertIn(("status", "prescriptions-service", 3, 0), self.discovery.calls)
+        self.assertEqual(len(logs.records), 2)
+
+    def test_ReportsFromAnEventLoop(self):
+        failures = [sqlite3.OperationalError("database is locked")]
+
+        def staleness():
+            if failures:
+                raise failures.pop()
+            return 0.5
+
+        client = DiscoveryClient(f'localhost:{self.port}', "prescriptions-service", "localhost", 50052,
+                                 interval=0.01, staleness=staleness)
+
+        async def report():
+            reporting = asyncio.ensure_future(client.run_async(lambda: Load(4, 1, 0.0, 0.0)))
+            deadline = time.monotonic() + 10
+            while ("status", "prescriptions-service", 4, 1) not in self.discovery.calls and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            reporting.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await reporting
+
+        with self.assertLogs("discovery_client", logging.ERROR):
+            asyncio.run(report())
+        client.close()
+
+        # Reported, and registered again after the failure
+        self.assertEqual(self.discovery.calls[:2], [
+            ("status", "prescriptions-service", 4, 1),
+            ("register", "prescriptions-service", 50052),
+        ])
+
+
+class TestLoadTracking(unittest.TestCase):
+    def setUp(self):
+        self.tracker = LoadTracker()
+        self.interceptor = LoadTrackingInterceptor(self.tracker)
+
+    def intercept(self, handler):
+        return self.interceptor.intercept_service(lambda details: handler, None)
+
+    def test_QueuedRunningAndFailedCalls(self):
+        def fail(request, context):
+            self.assertEqual(self.tracker.snapshot()[:2], (1, 0))
+            raise RuntimeError("handler failed")
+
+        handler = self.intercept(grpc.unary_unary_rpc_method_handler(fail))
+        self.assertEqual(self.tracker.snapshot()[:2], (0, 1))
+
+        with self.assertRaises(RuntimeError):
+            handler.unary_unary(None, None)
+        load = self.tracker.snapshot()
+        self.assertEqual(load[:2], (0, 0))
+        self.assertGreater(load.latency_ms, 0)
+
+    def test_StreamsAreNotTracked(self):
+        def stream(request, context):
+            yield from range(10)
+
+        responses = self.intercept(grpc.unary_stream_rpc_method_handler(stream)).unary_stream(None, None)
+        next(responses)
+        self.assertEqual(self.tracker.snapshot()[:2], (0, 0))
+
+        responses.close()
+        load = self.tracker.snapshot()
+        self.assertEqual(load[:2], (0, 0))
+        self.assertEqual(load.latency_ms, 0)
+
+
+class TestReadCache(unittest.TestCase):
+    def message(self, medication):
+        return prescription_pb2.Prescription(id="1", medication=medication)
+
+    def test_EvictsLeastRecentlyUsed(self):
+        cache = ReadCache("test-lru", max_entries=2)
+        for key in (1, 2):
+            cache.put(key, self.message(str(key)), cache.generation)
+        cache.get(1)
+        cache.put(3, self.message("3"), cache.generation)
+
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1).medication, "1")
+
+    def test_ByteLimitAndTtl(self):
+        small = self.message("x")
+        cache = ReadCache("test-bytes", max_bytes=small.ByteSize() * 2 + 1)
+        for key in (1, 2, 3):
+            cache.put(key, small, cache.generation)
+        self.assertIsNone(cache.get(1))
+
+        expired = ReadCache("test-ttl", ttl=-1)
+        expired.put(1, small, expired.generation)
+        self.assertIsNone(expired.get(1))
+
+    def test_ReadRacingAWriteIsNotCached(self):
+        cache = ReadCache("test-race")
+        generation = cache.generation
+        cache.invalidate([1])
+        cache.put(1, self.message("stale"), generation)
+
+        self.assertIsNone(cache.get(1))
+
+
+class OneShotContext:
+    def __init__(self):
+        self.active = iter([True, False])
+
+    def is_active(self):
+        return next(self.active)
+
+    def abort(self, code, details):
+        raise grpc.RpcError(code)
+
+
+class TestChangeLog(unittest.TestCase):
+    def setUp(self):
+        fd, self.database = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.pool = ConnectionPool(self.database)
+        with self.pool.connection() as connection:
+            connection.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, version INTEGER NOT NULL DEFAULT 1)")
+            create_change_log(connection, "items", "item_changes", "item_id", 10)
+
+    def tearDown(self):
+        self.pool.close()
+        os.remove(self.database)
+
+    def watch(self, after_offset):
+        return list(watch_changes(self.pool, "item_changes", "item_id", after_offset, False, OneShotContext(), 0))
+
+    def test_LogIsPrunedToRetention(self):
+        self.pool.write(lambda connection: connection.executemany(
+            "INSERT INTO items (id) VALUES (?)", ((i,) for i in range(1, 1001))))
+
+        self.assertEqual(self.watch(995), [(offset, 1, offset, 1) for offset in range(996, 1001)])
+        with self.assertRaises(grpc.RpcError):
+            self.watch(5)
+
+    def test_WatcherSlotsTurnAwayExtraStreams(self):
+        slots = WatcherSlots(1)
+        with slots.hold(OneShotContext()):
+            with self.assertRaises(grpc.RpcError) as error:
+                with slots.hold(OneShotContext()):
+                    pass
+        with slots.hold(OneShotContext()):
+            pass
+
+        self.assertEqual(error.exception.args, (grpc.StatusCode.RESOURCE_EXHAUSTED,))
+
+    def test_WatchersLeaveTheWorkersToUnaryCalls(self):
+        port = free_port()
+        server = prescription_server.create_server(port)
+        server.start()
+        channel = grpc.insecure_channel(f'localhost:{port}')
+        stub = prescription_pb2_grpc.PrescriptionServiceStub(channel)
+        try:
+            watchers = [stub.WatchChanges(prescription_pb2.WatchChangesRequest(from_now=True))
+                        for _ in range(prescription_server.MAX_WORKERS)]
+            time.sleep(0.5)
+            created = stub.CreatePrescription(prescription_pb2.CreatePrescriptionRequest(medication="Unblocked"),
+                                              timeout=5)
+            for watcher in watchers:
+                watcher.cancel()
+        finally:
+            channel.close()
+            server.stop(0)
+
+        self.assertEqual(created.medication, "Unblocked")
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        fd, self.database = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.pool = ConnectionPool(self.database)
+        self.connection = sqlite3.connect(self.database)
+        self.migrations = [
+            Migration(1, "create items", lambda connection: connection.execute(
+                "CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, name TEXT)")),
+            Migration(2, "add items.size", lambda connection: add_column(connection, "items", "size", "INTEGER")),
+            Migration(3, "index items.name", lambda connection: connection.execute(
+                "CREATE INDEX IF NOT EXISTS items_name ON items (name)")),
+            Migration(4, "fill items.size", self.fill_sizes, online=True),
+        ]
+
+    @staticmethod
+    def fill_sizes(pool, cursor):
+        with pool.connection() as connection:
+            last_id = connection.execute("SELECT max(id) FROM (SELECT id FROM items WHERE id > ? ORDER BY id LIMIT 10)",
+                                         (cursor or 0,)).fetchone()[0]
+        if last_id is None:
+            return None
+        pool.write(lambda connection: connection.execute(
+            "UPDATE items SET size = length(name) WHERE id > ? AND id <= ?", (cursor or 0, last_id)))
+        return last_id
+
+    def tearDown(self):
+        self.connection.close()
+        self.pool.close()
+        os.remove(self.database)
+
+    def test_AppliesPendingMigrationsOnce(self):
+        # A database from before migrations, with version 1's table already there
+        self.connection.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)")
+
+        first = migrate(self.connection, self.migrations)
+        again = migrate(self.connection, self.migrations)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(items)")]
+        applied = self.connection.execute("SELECT version, applied_at IS NOT NULL FROM schema_migrations").fetchall()
+
+        self.assertEqual((first, again), ([1, 2, 3, 4], []))
+        self.assertEqual(columns, ["id", "name", "size"])
+        self.assertEqual(applied, [(1, 1), (2, 1), (3, 1), (4, 0)])
+
+    def test_FailedMigrationIsRolledBack(self):
+        failing = Migration(4, "fails halfway", lambda connection: (
+            connection.execute("CREATE TABLE halfway (id INTEGER)"), connection.execute("NOT SQL")))
+
+        with self.assertRaises(sqlite3.Error):
+            migrate(self.connection, self.migrations + [failing._replace(version=5)])
+
+        tables = {row[0] for row in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self.assertNotIn("halfway", tables)
+        self.assertEqual(migrate(self.connection, self.migrations), [])
+
+    def test_OnlineMigrationRunsInStepsAndResumes(self):
+        migrate(self.connection, self.migrations)
+        self.pool.write(lambda connection: connection.executemany(
+            "INSERT INTO items (name) VALUES (?)", ((f"item {i}",) for i in range(25))))
+        steps = []
+        interrupted = self.migrations[3]._replace(apply=lambda pool, cursor: steps.append(cursor) or (
+            self.fill_sizes(pool, cursor) if len(steps) < 3 else self.fail_step()))
+
+        with self.assertRaises(sqlite3.OperationalError):
+            run_online_migrations(self.pool, [interrupted])
+        saved = self.connection.execute("SELECT cursor FROM schema_migrations WHERE version = 4").fetchone()[0]
+        run_online_migrations(self.pool, self.migrations)
+        unfilled = self.connection.execute("SELECT count(*) FROM items WHERE size IS NULL").fetchone()[0]
+
+        self.assertEqual(steps, [None, 10, 20])
+        self.assertEqual(saved, 20)
+        self.assertEqual(unfilled, 0)
+        self.assertEqual(migrate(self.connection, self.migrations), [])
+        self.assertEqual(self.connection.execute(
+            "SELECT count(*) FROM schema_migrations WHERE applied_at IS NULL").fetchone()[0], 0)
+
+    def fail_step(self):
+        raise sqlite3.OperationalError("interrupted")
+
+    def test_FinishesIndexesRegisteredAsOnline(self):
+        # Index builds were online migrations in earlier releases, left registered but unfinished
+        migrate(self.connection, self.migrations[:2])
+        self.connection.execute("INSERT INTO schema_migrations (version, name, cursor) VALUES (3, 'index items.name', 10)")
+        self.connection.commit()
+
+        applied = migrate(self.connection, self.migrations)
+        indexes = [row[1] for row in self.connection.execute("PRAGMA index_list(items)")]
+
+        self.assertEqual(applied, [3, 4])
+        self.assertEqual(indexes, ["items_name"])
+
+    def test_WritesWaitForTheWholeIndexBuild(self):
+        migrate(self.connection, self.migrations[:2])
+        self.pool.write(lambda connection: connection.executemany(
+            "INSERT INTO items (name) VALUES (?)", ((f"item {i:07d}" * 8,) for i in range(200000))))
+        building = threading.Event()
+        built = []
+
+        def build_index(connection):
+            building.set()
+            self.migrations[2].apply(connection)
+            built.append(time.perf_counter())
+
+        def apply():
+            connection = sqlite3.connect(self.database, timeout=30)
+            migrate(connection, self.migrations[:2] + [self.migrations[2]._replace(apply=build_index)])
+            connection.close()
+
+        migration = threading.Thread(target=apply)
+        migration.start()
+        building.wait()
+        start = time.perf_counter()
+        self.pool.write(lambda connection: connection.execute("INSERT INTO items (name) VALUES ('during the build')"))
+        written = time.perf_counter()
+        migration.join()
+
+        # The write waited out the rest of the build, the lock is not released part way
+        self.assertGreaterEqual(written - start, built[0] - start)
 
 
 if __name__ == '__main__':
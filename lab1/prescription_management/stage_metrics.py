@@ -0,0 +1,220 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import grpc
+from prometheus_client import Histogram
+
+# Shared by the records and prescription services, keep both copies in sync.
+#
+# Where the time of a call goes, by gRPC method:
+#
+#   acquire  getting the thread's SQLite connection from the pool
+#   execute  running a statement, up to its first row
+#   fetch    reading the rest of its rows
+#   build    turning rows into protobuf messages
+#   commit   committing a write, in "wal" mode the group commit it was part of
+#
+# plus the SQLite rows each call read and the bytes of its responses.
+# StageMetricsInterceptor tells which method a thread is serving; the pool's
+# connections (TimedConnection) and the single writer report their stages
+# for it, the servicers time "build" themselves. Work outside a call, such as
+# the history compactor, is labelled "background". STAGE_METRICS=0 turns it
+# all off.
+
+ENABLED = os.getenv("STAGE_METRICS", "1") != "0"
+
+STAGE_SECONDS = Histogram(
+    "rpc_stage_seconds",
+    "Time calls spent in each stage of serving them",
+    ["method", "stage"],
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+ROWS_READ = Histogram(
+    "rpc_sqlite_rows",
+    "SQLite rows a call read",
+    ["method"],
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000),
+)
+RESPONSE_BYTES = Histogram(
+    "rpc_response_bytes",
+    "Serialized size of the responses of a call, all of a stream's",
+    ["method"],
+    buckets=(64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216),
+)
+
+BACKGROUND = "background"
+
+_call = threading.local()
+# labels() takes a lock, the children are looked up here instead
+_stages = {}
+
+
+def current_method():
+    return getattr(_call, "method", None) or BACKGROUND
+
+
+def observe(stage, seconds, method=None):
+    key = (method or current_method(), stage)
+    child = _stages.get(key)
+    if child is None:
+        child = _stages[key] = STAGE_SECONDS.labels(*key)
+    child.observe(seconds)
+
+
+def count_rows(count):
+    rows = getattr(_call, "rows", None)
+    if rows is not None:
+        rows[0] += count
+
+
+@contextmanager
+def timed(stage):
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def serving(method, rows):
+    """Attribute the stages of this thread to `method`, and the rows it reads to `rows` ([count]), meanwhile."""
+    previous = getattr(_call, "method", None), getattr(_call, "rows", None)
+    _call.method, _call.rows = method, rows
+    try:
+        yield
+    finally:
+        _call.method, _call.rows = previous
+
+
+def propagate(function):
+    """function, attributing its stages to the calling thread's call wherever it runs."""
+    method, rows = getattr(_call, "method", None), getattr(_call, "rows", None)
+    if method is None:
+        return function
+
+    def run(*args, **kwargs):
+        with serving(method, rows):
+            return function(*args, **kwargs)
+    return run
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        observe("execute", time.perf_counter() - start)
+        return self
+
+    def executemany(self, sql, parameters):
+        start = time.perf_counter()
+        super().executemany(sql, parameters)
+        observe("execute", time.perf_counter() - start)
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        observe("fetch", time.perf_counter() - start)
+        count_rows(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        observe("fetch", time.perf_counter() - start)
+        count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        observe("fetch", time.perf_counter() - start)
+        count_rows(len(rows))
+        return rows
+
+    def __next__(self):
+        # Observed once the rows run out, not row by row
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched = getattr(self, "_fetched", 0.0) + time.perf_counter() - start
+            observe("fetch", self._fetched)
+            count_rows(getattr(self, "_rows", 0))
+            raise
+        self._fetched = getattr(self, "_fetched", 0.0) + time.perf_counter() - start
+        self._rows = getattr(self, "_rows", 0) + 1
+        return row
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3.Connection reporting the execute and fetch stages, pass it as connect(factory=)."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+
+class StageMetricsInterceptor(grpc.ServerInterceptor):
+    """Tells the stages which method they serve, records rows read and response bytes per call."""
+
+    def _finish(self, method, rows, response_bytes):
+        ROWS_READ.labels(method).observe(rows[0])
+        RESPONSE_BYTES.labels(method).observe(response_bytes)
+
+    def _wrap(self, method, behavior):
+        def measured(request_or_iterator, context):
+            rows = [0]
+            with serving(method, rows):
+                response = behavior(request_or_iterator, context)
+            self._finish(method, rows, response.ByteSize() if response is not None else 0)
+            return response
+        return measured
+
+    def _wrap_stream(self, method, behavior):
+        def measured(request_or_iterator, context):
+            # A stream may be pulled by a different thread for every message
+            rows, response_bytes = [0], 0
+            with serving(method, rows):
+                responses = behavior(request_or_iterator, context)
+            while True:
+                with serving(method, rows):
+                    try:
+                        response = next(responses)
+                    except StopIteration:
+                        break
+                response_bytes += response.ByteSize()
+                yield response
+            self._finish(method, rows, response_bytes)
+        return measured
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return handler
+        # handler_call_details.method looks like "/records.RecordService/GetRecordInfo"
+        method = handler_call_details.method.rsplit("/", 1)[-1]
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=self._wrap(method, handler.unary_unary))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=self._wrap_stream(method, handler.unary_stream))
+        if handler.stream_unary:
+            return handler._replace(stream_unary=self._wrap(method, handler.stream_unary))
+        return handler._replace(stream_stream=self._wrap_stream(method, handler.stream_stream))
+
+
+def stage_metrics_from_env():
+    return StageMetricsInterceptor() if ENABLED else None
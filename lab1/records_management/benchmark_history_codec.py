@@ -0,0 +1,222 @@
+"""Database size, page cache footprint and bytes on the wire with and without history compression.
+
+Each scenario runs in a fresh process against a throwaway database filled
+with the same synthetic histories, with the read cache off:
+
+  db MB         records.db after inserting every row
+  cache MB      pages of records.db in the OS page cache after --requests
+                random GetRecordInfo calls, starting from a cold cache
+  get B, list B bytes the server sent over TCP per GetRecordInfo and per
+                default-size ListRecords page (HTTP/2 framing included)
+
+    python benchmark_history_codec.py [--rows 20000] [--requests 2000]
+"""
+import argparse
+import ctypes
+import ctypes.util
+import mmap
+import multiprocessing
+import os
+import random
+import socket
+import sqlite3
+import tempfile
+import sys
+import threading
+
+SENTENCES = [
+    "Patient presents with {n} day history of productive cough and low grade fever.",
+    "Blood pressure {n}/{m} mmHg, heart rate {m} bpm, afebrile.",
+    "Prescribed amoxicillin {n} mg three times daily for seven days.",
+    "Known allergy to penicillin, reaction documented as rash.",
+    "HbA1c {n}.{m}%, metformin dose adjusted, dietary advice given.",
+    "Follow up in {n} weeks or sooner if symptoms worsen.",
+    "Chest X-ray shows no focal consolidation.",
+    "Reports intermittent lower back pain for {n} months, worse after lifting.",
+    "Referred to physiotherapy, ibuprofen {n} mg as needed.",
+    "Vaccinations up to date, influenza vaccine given {n}/{m}.",
+    "Family history of type 2 diabetes and hypertension.",
+    "Non-smoker, drinks {n} units of alcohol per week.",
+]
+
+SCENARIOS = [
+    ("raw, wire off", {}),
+    ("raw, gzip", {"GRPC_COMPRESSION": "gzip"}),
+    ("zlib, gzip", {"HISTORY_CODEC": "zlib", "GRPC_COMPRESSION": "gzip"}),
+    ("zlib+dict, gzip", {"HISTORY_CODEC": "zlib", "GRPC_COMPRESSION": "gzip", "dictionary": "zlib"}),
+    ("zstd+dict, gzip", {"HISTORY_CODEC": "zstd", "GRPC_COMPRESSION": "gzip", "dictionary": "zstd"}),
+]
+
+
+def history(rng):
+    return " ".join(
+        rng.choice(SENTENCES).format(n=rng.randint(1, 200), m=rng.randint(1, 99))
+        for _ in range(rng.randint(2, 30))
+    )
+
+
+def resident_bytes(path):
+    # mincore() over a mapping of the file: which of its pages are cached
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+    size = os.path.getsize(path)
+    pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        address = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        vector = ctypes.create_string_buffer(pages)
+        try:
+            if libc.mincore(address, size, vector) != 0:
+                raise OSError(ctypes.get_errno(), "mincore failed")
+        finally:
+            libc.munmap(address, size)
+    finally:
+        os.close(fd)
+    return sum(byte & 1 for byte in vector.raw) * mmap.PAGESIZE
+
+
+def drop_from_page_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+class CountingProxy:
+    """Forwards localhost TCP connections to `port`, counting the bytes sent back."""
+
+    def __init__(self, port):
+        self.port = port
+        self.received = 0
+        self._lock = threading.Lock()
+        self._listener = socket.create_server(("localhost", 0))
+        self.listen_port = self._listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            client, _ = self._listener.accept()
+            upstream = socket.create_connection(("localhost", self.port))
+            threading.Thread(target=self._pipe, args=(client, upstream, False), daemon=True).start()
+            threading.Thread(target=self._pipe, args=(upstream, client, True), daemon=True).start()
+
+    def _pipe(self, source, destination, count):
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = None
+            if not data:
+                destination.close()
+                return
+            if count:
+                with self._lock:
+                    self.received += len(data)
+            destination.sendall(data)
+
+    def take(self):
+        with self._lock:
+            received, self.received = self.received, 0
+        return received
+
+
+def run_scenario(database, settings, rows, requests, pipe):
+    # The servicer prints every request
+    sys.stdout = open(os.devnull, "w")
+    os.environ.update({
+        "RECORDS_DATABASE": database,
+        "PROMETHEUS_PORT": "0",
+        "RECORDS_SERVICE_PORT": "0",
+        "READ_CACHE_SIZE": "0",
+    })
+    os.environ.update({key: value for key, value in settings.items() if key.isupper()})
+    rng = random.Random(42)
+    histories = [history(rng) for _ in range(rows)]
+
+    if "dictionary" in settings:
+        from history_codec import create_dictionary_table, store_dictionary, train_dictionary
+        connection = sqlite3.connect(database)
+        create_dictionary_table(connection)
+        store_dictionary(connection, settings["dictionary"], train_dictionary(settings["dictionary"], histories[:5000]))
+        connection.commit()
+        connection.close()
+
+    from concurrent import futures
+    import grpc
+    from google.protobuf import empty_pb2
+    import records_pb2
+    import records_pb2_grpc
+    from records_server import RecordService
+    from response_compression import response_compression_from_env
+
+    servicer = RecordService()
+    for start in range(0, rows, 1000):
+        servicer.BatchCreateRecords(records_pb2.BatchCreateRecordsRequest(records=[
+            records_pb2.CreateRecordRequest(name=f"Patient {i}", medical_history=histories[i])
+            for i in range(start, min(start + 1000, rows))
+        ]), None)
+    database_size = os.path.getsize(database)
+
+    compression = response_compression_from_env()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), interceptors=[compression] if compression else [])
+    records_pb2_grpc.add_RecordServiceServicer_to_server(servicer, server)
+    proxy = CountingProxy(server.add_insecure_port('localhost:0'))
+    server.start()
+
+    with grpc.insecure_channel(f'localhost:{proxy.listen_port}') as channel:
+        stub = records_pb2_grpc.RecordServiceStub(channel)
+        stub.GetServiceStatus(empty_pb2.Empty())
+        drop_from_page_cache(database)
+        proxy.take()
+        for _ in range(requests):
+            stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id=str(rng.randint(1, rows))))
+        get_bytes = proxy.take() / requests
+        cached = resident_bytes(database)
+        pages = 20
+        token = ''
+        for _ in range(pages):
+            token = stub.ListRecords(records_pb2.ListRecordsRequest(page_token=token)).next_page_token
+        list_bytes = proxy.take() / pages
+    server.stop(0)
+    pipe.send((database_size, cached, get_bytes, list_bytes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    multiprocessing.set_start_method("spawn")
+
+    try:
+        import zstandard  # noqa: F401
+        scenarios = SCENARIOS
+    except ImportError:
+        print("zstandard is not installed, skipping the zstd scenario")
+        scenarios = [scenario for scenario in SCENARIOS if "zstd" not in scenario[0]]
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for number, (name, settings) in enumerate(scenarios):
+            database = os.path.join(directory, f"records-{number}.db")
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_scenario, args=(database, settings, args.rows, args.requests, child))
+            process.start()
+            while not parent.poll(1):
+                if not process.is_alive():
+                    raise SystemExit(f"Scenario {name!r} failed")
+            results.append((name, parent.recv()))
+            process.join()
+
+    print(f"{'scenario':>16} {'db MB':>8} {'cache MB':>9} {'get B':>8} {'list B':>9}")
+    for name, (database_size, cached, get_bytes, list_bytes) in results:
+        print(f"{name:>16} {database_size / 2**20:>8.1f} {cached / 2**20:>9.1f} {get_bytes:>8.0f} {list_bytes:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
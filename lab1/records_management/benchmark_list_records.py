@@ -0,0 +1,149 @@
+"""Peak server RSS and time-to-first-byte of listing a large records table.
+
+Each scenario runs in a fresh server process against a throwaway database:
+
+  materialized  the old ListRecords: every row in one ListRecordsResponse
+                (built in-process, a 1M row response is far over gRPC's 4 MB limit)
+  first page    keyset-paginated ListRecords, default page size
+  stream        StreamRecords drained to the end
+
+    python benchmark_list_records.py [--rows 1000000]
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sqlite3
+import tempfile
+import time
+
+HISTORY = "Seasonal allergies, no chronic conditions. " * 5
+
+
+def build_database(database, rows):
+    connection = sqlite3.connect(database)
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            medical_history TEXT
+        )
+    ''')
+    batch = 10000
+    for start in range(0, rows, batch):
+        connection.executemany(
+            "INSERT INTO records (name, medical_history) VALUES (?, ?)",
+            ((f"Patient {i}", HISTORY) for i in range(start, min(start + batch, rows)))
+        )
+    connection.commit()
+    connection.close()
+
+
+def configure_env(database):
+    os.environ["RECORDS_DATABASE"] = database
+    os.environ.setdefault("PROMETHEUS_PORT", "0")
+    os.environ.setdefault("RECORDS_SERVICE_PORT", "0")
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def materialized(database, pipe):
+    configure_env(database)
+    import records_pb2
+    from records_server import pool
+
+    start = time.perf_counter()
+    with pool.connection() as connection:
+        rows = connection.execute("SELECT id, name, medical_history FROM records").fetchall()
+    response = records_pb2.ListRecordsResponse(records=[
+        records_pb2.Record(id=str(row[0]), name=row[1], medical_history=row[2]) for row in rows
+    ])
+    payload = response.SerializeToString()
+    elapsed = time.perf_counter() - start
+    pipe.send((elapsed, elapsed, len(payload), peak_rss_mb()))
+
+
+def serve(database, pipe):
+    configure_env(database)
+    from concurrent import futures
+    import grpc
+    import records_pb2_grpc
+    from records_server import RecordService
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    records_pb2_grpc.add_RecordServiceServicer_to_server(RecordService(), server)
+    pipe.send(server.add_insecure_port('localhost:0'))
+    server.start()
+    pipe.recv()
+    server.stop(0)
+    pipe.send(peak_rss_mb())
+
+
+def run_over_grpc(database, call):
+    import grpc
+    import records_pb2_grpc
+
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve, args=(database, child))
+    process.start()
+    port = parent.recv()
+    with grpc.insecure_channel(f'localhost:{port}', options=[('grpc.max_receive_message_length', -1)]) as channel:
+        grpc.channel_ready_future(channel).result(timeout=10)
+        stub = records_pb2_grpc.RecordServiceStub(channel)
+        first_byte, total, payload = call(stub)
+    parent.send("stop")
+    rss = parent.recv()
+    process.join()
+    return first_byte, total, payload, rss
+
+
+def first_page(stub):
+    import records_pb2
+
+    start = time.perf_counter()
+    response = stub.ListRecords(records_pb2.ListRecordsRequest())
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed, response.ByteSize()
+
+
+def stream(stub):
+    import records_pb2
+
+    start = time.perf_counter()
+    first_byte = None
+    payload = 0
+    for record in stub.StreamRecords(records_pb2.StreamRecordsRequest()):
+        if first_byte is None:
+            first_byte = time.perf_counter() - start
+        payload += record.ByteSize()
+    return first_byte, time.perf_counter() - start, payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    args = parser.parse_args()
+    multiprocessing.set_start_method("spawn")
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "records.db")
+        print(f"Building {args.rows} rows...")
+        build_database(database, args.rows)
+
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=materialized, args=(database, child))
+        process.start()
+        results = [("materialized", parent.recv())]
+        process.join()
+        results.append(("first page", run_over_grpc(database, first_page)))
+        results.append(("stream", run_over_grpc(database, stream)))
+
+    print(f"{'scenario':>13} {'ttfb ms':>9} {'total ms':>10} {'payload MB':>11} {'peak RSS MB':>12}")
+    for name, (first_byte, total, payload, rss) in results:
+        print(f"{name:>13} {first_byte * 1000:>9.1f} {total * 1000:>10.1f} {payload / 2**20:>11.1f} {rss:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
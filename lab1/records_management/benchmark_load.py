@@ -0,0 +1,147 @@
+"""Throughput and latency of the records service under a mix of calls.
+
+Serves RecordService in this process, as records_server.create_server()
+does, against a throwaway database seeded with --rows records, and drives it
+from --processes client processes (see load_harness.py): with --concurrency
+calls in flight, or at --qps calls a second. Gets, updates and lists use the
+seeded records; deletes remove records the client created itself, a delete
+with none left is a create. The service's settings (DATABASE_MODE,
+MAX_WORKERS, READ_CACHE_SIZE...) come from the environment.
+
+Prints throughput, p50/p95/p99/p999 latency per operation and the server's
+RSS. --output saves them as JSON; --baseline compares them with an earlier
+--output and exits 1 when throughput, p99 or RSS got more than --tolerance
+worse:
+
+    python benchmark_load.py [--mix get=60,list=10,create=15,update=10,delete=5]
+                             [--concurrency 32 | --qps 2000] [--duration 10]
+                             [--output after.json] [--baseline before.json]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import grpc
+import records_pb2
+import records_pb2_grpc
+
+from load_harness import compare, free_port, git_commit, parse_mix, print_results, rss_mb, run_load, save_results
+
+OPERATIONS = ("create", "get", "update", "delete", "list")
+HISTORY = "benchmark history " * 20
+LIST_PAGE_SIZE = 20
+SEED_BATCH = 1000
+TIMEOUT = 30
+
+
+def make_operations(channel, seeded_ids, rng):
+    stub = records_pb2_grpc.RecordServiceStub(channel)
+    created = []
+
+    async def create():
+        record = await stub.CreateRecord(records_pb2.CreateRecordRequest(
+            name=f"Patient {rng.randrange(1000000)}", medical_history=HISTORY), timeout=TIMEOUT)
+        created.append(record.id)
+        return "create"
+
+    async def get():
+        await stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id=rng.choice(seeded_ids)), timeout=TIMEOUT)
+        return "get"
+
+    async def update():
+        await stub.UpdateRecordInfo(records_pb2.UpdateRecordInfoRequest(
+            record_id=rng.choice(seeded_ids), updated_medical_history=HISTORY), timeout=TIMEOUT)
+        return "update"
+
+    async def delete():
+        if not created:
+            return await create()
+        record_id = created.pop(rng.randrange(len(created)))
+        await stub.DeleteRecord(records_pb2.DeleteRecordRequest(record_id=record_id), timeout=TIMEOUT)
+        return "delete"
+
+    async def list_page():
+        await stub.ListRecords(records_pb2.ListRecordsRequest(
+            page_size=LIST_PAGE_SIZE, min_id=rng.choice(seeded_ids)), timeout=TIMEOUT)
+        return "list"
+
+    return {"create": create, "get": get, "update": update, "delete": delete, "list": list_page}
+
+
+def seed(port, rows):
+    ids = []
+    with grpc.insecure_channel(f'localhost:{port}') as channel:
+        stub = records_pb2_grpc.RecordServiceStub(channel)
+        for first in range(0, rows, SEED_BATCH):
+            response = stub.BatchCreateRecords(records_pb2.BatchCreateRecordsRequest(records=[
+                records_pb2.CreateRecordRequest(name=f"Patient {i}", medical_history=HISTORY)
+                for i in range(first, min(rows, first + SEED_BATCH))
+            ]))
+            ids.extend(result.record_id for result in response.results if result.ok)
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mix", default="get=60,list=10,create=15,update=10,delete=5",
+                        help=f"weighted operations, of {', '.join(OPERATIONS)}")
+    parser.add_argument("--concurrency", type=int, default=32, help="calls in flight, without --qps")
+    parser.add_argument("--qps", type=float, default=0, help="calls a second, whatever the latency")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0, help="seconds of calls left out of the results first")
+    parser.add_argument("--rows", type=int, default=10000, help="records in the database to start with")
+    parser.add_argument("--processes", type=int, default=2, help="client processes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="worse than the baseline by more fails, 0-1")
+    args = parser.parse_args()
+    try:
+        mix = parse_mix(args.mix, OPERATIONS)
+    except ValueError as e:
+        parser.error(str(e))
+
+    with tempfile.TemporaryDirectory() as directory:
+        port = free_port()
+        os.environ.update(RECORDS_DATABASE=os.path.join(directory, "records.db"), RECORDS_SERVICE_PORT=str(port),
+                          PROMETHEUS_PORT=str(free_port()))
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        # Reads its settings on import
+        import records_server
+        server = records_server.create_server(port)
+        server.start()
+        try:
+            seeded_ids = seed(port, args.rows)
+            results = run_load(make_operations, port, seeded_ids, mix, args.processes, args.concurrency, args.qps,
+                               args.duration, args.warmup, args.seed)
+        finally:
+            server.stop(0)
+        results["rss_mb"], results["peak_rss_mb"] = rss_mb()
+        results.update(service="records", commit=git_commit(), settings={
+            "mix": mix, "concurrency": None if args.qps else args.concurrency, "qps": args.qps or None,
+            "duration": args.duration, "warmup": args.warmup, "rows": args.rows, "processes": args.processes,
+            "database_mode": records_server.DATABASE_MODE, "max_workers": records_server.MAX_WORKERS,
+            "read_cache_size": records_server.READ_CACHE_SIZE,
+        })
+
+    print_results(results)
+    if args.output:
+        save_results(args.output, results)
+    if args.baseline:
+        with open(args.baseline) as saved:
+            baseline = json.load(saved)
+        changed = sorted(name for name, value in results["settings"].items()
+                         if baseline.get("settings", {}).get(name) != value)
+        if changed:
+            print(f"The baseline ran with other settings: {', '.join(changed)}")
+        regressions = compare(baseline, results, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""What logging costs a request, next to the print() calls it replaced.
+
+Times, per call and on the calling thread, the print(request) and
+print(medical_history) GetRecordInfo and CreateRecord used to make, and
+service_logging's per-request record: sampled at --sample-rate, kept every
+time (queued for the writer thread) and below the log level. Output goes to
+/dev/null, so the prints are timed without a slow terminal or pipe. Exits 1
+when a sampled call costs more than --budget-us microseconds:
+
+    python benchmark_logging.py [--calls 200000] [--sample-rate 0.01] [--budget-us 1.0]
+"""
+import argparse
+import contextlib
+import logging
+import os
+import sys
+import time
+
+import records_pb2
+from service_logging import LOG_RECORDS_DROPPED, SampledLogger, configure_logging, stop_logging
+
+# About the size of a history a few visits long
+MEDICAL_HISTORY = "Follow-up visit, blood pressure 128/84, continue current medication. " * 12
+
+
+def time_calls(call, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        call()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--sample-rate", type=float, default=0.01)
+    parser.add_argument("--budget-us", type=float, default=1.0,
+                        help="most a sampled per-request record may cost the calling thread")
+    args = parser.parse_args()
+
+    request = records_pb2.GetRecordInfoRequest(record_id="12345")
+    devnull = open(os.devnull, "w")
+    configure_logging("benchmark", level="INFO", queue_size=args.calls,
+                      stream_handler=logging.StreamHandler(devnull))
+    logger = logging.getLogger("benchmark.rpc")
+
+    def log(rpc_log):
+        return lambda: rpc_log.info("GetRecordInfo", record_id=12345, cached=False, found=True)
+
+    results = []
+    with contextlib.redirect_stdout(devnull):
+        results.append(("print(request)", time_calls(lambda: print(request), args.calls)))
+        results.append(("print(medical_history)", time_calls(lambda: print(MEDICAL_HISTORY), args.calls)))
+    sampled = time_calls(log(SampledLogger(logger, args.sample_rate)), args.calls)
+    results.append((f"sampled at {args.sample_rate}", sampled))
+    start = time.perf_counter()
+    results.append(("every call", time_calls(log(SampledLogger(logger, 1.0)), args.calls)))
+    # The writer thread catching up with the queue
+    stop_logging()
+    written_per_second = args.calls / (time.perf_counter() - start)
+    logger.setLevel(logging.WARNING)
+    results.append(("below LOG_LEVEL", time_calls(log(SampledLogger(logger, 1.0)), args.calls)))
+
+    print(f"{'':>24} {'us/call':>8}")
+    for name, microseconds in results:
+        print(f"{name:>24} {microseconds:>8.3f}")
+    print(f"writer: {written_per_second:.0f} records/s, {LOG_RECORDS_DROPPED._value.get():.0f} dropped")
+    if sampled > args.budget_us:
+        print(f"A sampled call costs {sampled:.3f} us, over the {args.budget_us} us budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
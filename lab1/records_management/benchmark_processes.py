@@ -0,0 +1,130 @@
+"""GetRecordInfo throughput of the pre-fork server by number of worker processes.
+
+Starts serve_prefork() with 1, 2, 4... workers against a throwaway database
+and drives it from several client processes, each on its own connection so
+SO_REUSEPORT can spread them across the workers. Scaling is bounded by the
+cores of the machine, client processes included.
+
+    python benchmark_processes.py [--workers 1 2 4] [--clients 8]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+RECORDS = 1000
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def build_database(database):
+    connection = sqlite3.connect(database)
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            medical_history TEXT
+        )
+    ''')
+    connection.executemany(
+        "INSERT INTO records (name, medical_history) VALUES (?, ?)",
+        ((f"Patient {i}", "history " * 20) for i in range(RECORDS))
+    )
+    connection.commit()
+    connection.close()
+
+
+def client(port, concurrency, duration, results):
+    import grpc
+    import records_pb2
+    import records_pb2_grpc
+
+    async def run():
+        completed = 0
+        deadline = time.perf_counter() + duration
+        # A local subchannel pool gives this process its own TCP connection
+        options = [("grpc.use_local_subchannel_pool", 1)]
+        async with grpc.aio.insecure_channel(f'localhost:{port}', options=options) as channel:
+            stub = records_pb2_grpc.RecordServiceStub(channel)
+
+            async def worker(number):
+                nonlocal completed
+                i = number
+                while time.perf_counter() < deadline:
+                    await stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id=str(i % RECORDS + 1)))
+                    completed += 1
+                    i += concurrency
+
+            await asyncio.gather(*(worker(n) for n in range(concurrency)))
+        return completed
+
+    results.put(asyncio.run(run()))
+
+
+def measure(port, clients, concurrency, duration):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [context.Process(target=client, args=(port, concurrency, duration, results)) for _ in range(clients)]
+    for process in processes:
+        process.start()
+    completed = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return completed / duration
+
+
+def wait_for_server(port, timeout=30):
+    import grpc
+
+    with grpc.insecure_channel(f'localhost:{port}') as channel:
+        grpc.channel_ready_future(channel).result(timeout=timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=8, help="client processes")
+    parser.add_argument("--concurrency", type=int, default=8, help="in-flight calls per client process")
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f"cores: {os.cpu_count()}")
+    print(f"{'workers':>8} {'req/s':>8} {'speedup':>8}")
+    baseline = None
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "records.db")
+        build_database(database)
+        for workers in args.workers:
+            port = free_port()
+            env = dict(
+                os.environ,
+                RECORDS_DATABASE=database,
+                RECORDS_SERVICE_PORT=str(port),
+                RECORDS_SERVICE_HOSTNAME="localhost",
+                PROMETHEUS_PORT=str(free_port()),
+            )
+            code = f"import records_server; records_server.serve_prefork(records_server.RECORDS_SERVICE_PORT, {workers})"
+            server = subprocess.Popen([sys.executable, "-c", code], env=env, stdout=subprocess.DEVNULL)
+            try:
+                wait_for_server(port)
+                time.sleep(1)  # let every worker bind
+                qps = measure(port, args.clients, args.concurrency, args.duration)
+            finally:
+                server.terminate()
+                server.wait()
+            baseline = baseline or qps
+            print(f"{workers:>8} {qps:>8.0f} {qps / baseline:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
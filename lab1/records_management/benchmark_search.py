@@ -0,0 +1,122 @@
+"""SearchRecords latency against a throwaway database of synthetic records.
+
+Fills the database through BatchCreateRecords, so the index is built the way
+the service maintains it, then times first-page SearchRecords calls over gRPC
+for a rare term, common ones, a prefix and a phrase, ranking the newest
+--window matches (as SEARCH_RANK_WINDOW would) and then every match, next to
+the LIKE scan SearchRecords replaces:
+
+    python benchmark_search.py [--rows 1000000] [--requests 200] [--window 5000]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmark_history_codec import history
+
+# One record in RARE_EVERY has this in its history
+RARE = " Biopsy confirms mesothelioma."
+RARE_EVERY = 10000
+
+QUERIES = [
+    ("rare", "mesothelioma"),
+    ("two terms", "penicillin AND rash"),
+    ("common", "cough"),
+    ("prefix", "physio*"),
+    ("phrase", '"lower back pain"'),
+    ("everywhere", "patient OR history OR blood OR follow OR known"),
+]
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--window", type=int, default=5000, help="newest matches ranked, against every match")
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    database = os.path.join(directory.name, "records.db")
+    os.environ.update({
+        "RECORDS_DATABASE": database,
+        "PROMETHEUS_PORT": "0",
+        "RECORDS_SERVICE_PORT": "0",
+        "READ_CACHE_SIZE": "0",
+        "HISTORY_COMPACT_INTERVAL": "0",
+    })
+    # The servicer prints every request
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+
+    from concurrent import futures
+    import grpc
+    import records_pb2
+    import records_pb2_grpc
+    import records_server
+    from records_server import RecordService, pool
+
+    servicer = RecordService()
+    rng = random.Random(42)
+    start = time.perf_counter()
+    for first in range(0, args.rows, 1000):
+        servicer.BatchCreateRecords(records_pb2.BatchCreateRecordsRequest(records=[
+            records_pb2.CreateRecordRequest(name=f"Patient {i}",
+                                            medical_history=history(rng) + (RARE if i % RARE_EVERY == 0 else ''))
+            for i in range(first, min(first + 1000, args.rows))
+        ]), None)
+    load_seconds = time.perf_counter() - start
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    records_pb2_grpc.add_RecordServiceServicer_to_server(servicer, server)
+    port = server.add_insecure_port('localhost:0')
+    server.start()
+
+    window = args.window
+    results = []
+    with grpc.insecure_channel(f'localhost:{port}') as channel:
+        stub = records_pb2_grpc.RecordServiceStub(channel)
+        for name, query in QUERIES:
+            request = records_pb2.SearchRecordsRequest(query=query, page_size=args.page_size)
+            timings = []
+            for records_server.SEARCH_RANK_WINDOW in (window, 0):
+                stub.SearchRecords(request)
+                latencies = []
+                for _ in range(args.requests):
+                    start = time.perf_counter()
+                    response = stub.SearchRecords(request)
+                    latencies.append(time.perf_counter() - start)
+                timings.append(latencies)
+            results.append((name, len(response.results), timings))
+
+    # What a search cost before the index: a scan of every history
+    with pool.connection() as connection:
+        start = time.perf_counter()
+        connection.execute("SELECT count(*) FROM records WHERE medical_history LIKE ?", ("%lower back pain%",)).fetchone()
+        scan_seconds = time.perf_counter() - start
+    server.stop(0)
+    database_size = os.path.getsize(database)
+    sys.stdout = stdout
+
+    print(f"{args.rows} records loaded in {load_seconds:.0f} s ({args.rows / load_seconds:.0f} rows/s), "
+          f"database {database_size / 2**20:.0f} MB")
+    print(f"{'':>12} {'':>8} {f'newest {window} matches':>17} {'every match':>17}")
+    print(f"{'query':>12} {'results':>8} {'p50 ms':>8} {'p99 ms':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, found, timings in results:
+        print(f"{name:>12} {found:>8} " + " ".join(
+            f"{statistics.median(latencies) * 1000:>8.2f} {percentile(latencies, 0.99) * 1000:>8.2f}"
+            for latencies in timings))
+    print(f"{'LIKE scan':>12} {'':>8} {scan_seconds * 1000:>8.2f}")
+    directory.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Concurrent-request capacity of the threads and aio server modes.
+
+Starts records_server in each SERVER_MODE against a throwaway database and
+drives GetRecordInfo with an increasing number of concurrent clients. Both
+modes run the SQLite work on MAX_WORKERS threads, so the comparison is the
+one without a delay: what aio mode saves is the thread per waiting call.
+
+--delay-ms injects a per-call wait through the fault injection interceptor.
+In aio mode it is an asyncio.sleep that holds no thread, which no call of the
+service does on its own: it shows what an async data path would gain, not
+what aio mode gains today.
+
+    python benchmark_server_modes.py [--concurrency 10 100 500] [--delay-ms 0]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import grpc
+import records_pb2
+import records_pb2_grpc
+
+RECORDS = 1000
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def build_database(database):
+    connection = sqlite3.connect(database)
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            medical_history TEXT
+        )
+    ''')
+    connection.executemany(
+        "INSERT INTO records (name, medical_history) VALUES (?, ?)",
+        ((f"Patient {i}", "history " * 20) for i in range(RECORDS))
+    )
+    connection.commit()
+    connection.close()
+
+
+def start_server(mode, database, port, delay_ms):
+    env = dict(
+        os.environ,
+        SERVER_MODE=mode,
+        RECORDS_DATABASE=database,
+        RECORDS_SERVICE_PORT=str(port),
+        RECORDS_SERVICE_HOSTNAME="localhost",
+        PROMETHEUS_PORT=str(free_port()),
+        FAULT_DELAY_MS=str(delay_ms),
+        FAULT_METHODS="GetRecordInfo",
+    )
+    if mode == "aio":
+        code = "import asyncio, records_server; asyncio.run(records_server.serve_aio(records_server.RECORDS_SERVICE_PORT))"
+    else:
+        code = "import records_server; records_server.serve(records_server.RECORDS_SERVICE_PORT)"
+    return subprocess.Popen([sys.executable, "-c", code], env=env, stdout=subprocess.DEVNULL)
+
+
+async def load(port, concurrency, duration):
+    latencies = []
+    errors = 0
+
+    async with grpc.aio.insecure_channel(f'localhost:{port}') as channel:
+        await channel.channel_ready()
+        # From when the server is up, it may still be starting
+        deadline = time.perf_counter() + duration
+        stub = records_pb2_grpc.RecordServiceStub(channel)
+
+        async def client(number):
+            nonlocal errors
+            i = number
+            while time.perf_counter() < deadline:
+                request = records_pb2.GetRecordInfoRequest(record_id=str(i % RECORDS + 1))
+                start = time.perf_counter()
+                try:
+                    await stub.GetRecordInfo(request, timeout=30)
+                    latencies.append(time.perf_counter() - start)
+                except grpc.aio.AioRpcError:
+                    errors += 1
+                i += concurrency
+
+        await asyncio.gather(*(client(n) for n in range(concurrency)))
+
+    latencies.sort()
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+    return len(latencies) / duration, percentile(0.5), percentile(0.99), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--delay-ms", type=int, default=0, help="injected wait per call, see above")
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    if args.delay_ms:
+        print(f"With {args.delay_ms} ms of injected wait, async in aio mode only")
+    print(f"{'mode':>8} {'clients':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "records.db")
+        build_database(database)
+        for mode in ("threads", "aio"):
+            port = free_port()
+            server = start_server(mode, database, port, args.delay_ms)
+            try:
+                for concurrency in args.concurrency:
+                    qps, p50, p99, errors = asyncio.run(load(port, concurrency, args.duration))
+                    print(f"{mode:>8} {concurrency:>8} {qps:>8.0f} {p50:>8.1f} {p99:>8.1f} {errors:>7}")
+            finally:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Write throughput of records.db with 1, 10 and 100 concurrent writers.
+
+Compares the default rollback-journal mode (every worker commits on its own
+connection) with "wal" mode (WAL, tuned pragmas and one group-committing
+writer thread). Runs against a throwaway database:
+
+    python benchmark_writes.py [--writes-per-writer 200]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from db_pool import ConnectionPool
+
+SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            medical_history TEXT
+        )
+    '''
+INSERT = "INSERT INTO records (name, medical_history) VALUES (?, ?)"
+
+
+def run(mode, writers, writes_per_writer, directory):
+    database = os.path.join(directory, f"records-{mode}-{writers}.db")
+    connection = sqlite3.connect(database)
+    connection.execute(SCHEMA)
+    connection.close()
+
+    pool = ConnectionPool(database, max_size=writers, mode=mode)
+    errors = []
+    start_barrier = threading.Barrier(writers + 1)
+
+    def writer(number):
+        start_barrier.wait()
+        for i in range(writes_per_writer):
+            try:
+                pool.write(lambda connection: connection.execute(
+                    INSERT, (f"patient {number}-{i}", "benchmark history " * 20)
+                ))
+            except sqlite3.OperationalError as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    pool.close()
+
+    committed = writers * writes_per_writer - len(errors)
+    return committed / elapsed, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writes-per-writer", type=int, default=200)
+    parser.add_argument("--writers", type=int, nargs="+", default=[1, 10, 100])
+    args = parser.parse_args()
+
+    print(f"{'writers':>8} {'mode':>9} {'writes/s':>10} {'errors':>7}")
+    with tempfile.TemporaryDirectory() as directory:
+        for writers in args.writers:
+            for mode in ("rollback", "wal"):
+                throughput, errors = run(mode, writers, args.writes_per_writer, directory)
+                print(f"{writers:>8} {mode:>9} {throughput:>10.0f} {errors:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import collections
+import struct
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Storage codec for records.medical_history, off unless HISTORY_CODEC is set:
+#
+#   HISTORY_CODEC=zlib      (or zstd, needs the zstandard package)
+#   HISTORY_COMPRESS_MIN=256
+#
+# Histories shorter than HISTORY_COMPRESS_MIN bytes, or that would not get any
+# smaller, stay plain TEXT. Compressed ones are BLOBs starting with a header
+# naming the codec and the dictionary they were compressed with, so rows
+# written under any setting (or none) stay readable after it changes.
+# Dictionaries are trained from existing histories by
+# train_history_dictionary.py and kept in the database; the newest one for
+# the configured codec is used for new writes.
+
+ZLIB = 1
+ZSTD = 2
+CODECS = {"zlib": ZLIB, "zstd": ZSTD}
+# codec, dictionary id (0 for none)
+HEADER = struct.Struct(">BI")
+# zlib only looks back 32 KiB, a longer dictionary would be cut anyway
+ZLIB_MAX_DICTIONARY = 32 * 1024
+
+
+def create_dictionary_table(connection):
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS history_dictionaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            codec INTEGER NOT NULL,
+            dictionary BLOB NOT NULL
+        )
+    ''')
+
+
+def load_dictionaries(connection):
+    """All stored dictionaries as {id: (codec, dictionary)}."""
+    return {row[0]: (row[1], row[2]) for row in connection.execute(
+        "SELECT id, codec, dictionary FROM history_dictionaries")}
+
+
+def store_dictionary(connection, codec, dictionary):
+    return connection.execute(
+        "INSERT INTO history_dictionaries (codec, dictionary) VALUES (?, ?)",
+        (CODECS[codec], dictionary)
+    ).lastrowid
+
+
+def train_dictionary(codec, samples, size=16 * 1024):
+    """Build a dictionary of at most `size` bytes from sample histories (str)."""
+    samples = [sample.encode() for sample in samples if sample]
+    if codec == "zstd":
+        _require_zstandard()
+        return zstandard.train_dictionary(size, samples).as_bytes()
+
+    # zlib has no trainer: use the phrases (word trigrams) that occur in the
+    # most samples, the most common last as zlib finds close matches cheapest
+    counts = collections.Counter()
+    for sample in samples:
+        words = sample.split(b" ")
+        counts.update({b" ".join(words[i:i + 3]) + b" " for i in range(max(len(words) - 2, 1))})
+    phrases = []
+    total = 0
+    for phrase, count in counts.most_common():
+        if count < 2 or total + len(phrase) > min(size, ZLIB_MAX_DICTIONARY):
+            break
+        phrases.append(phrase)
+        total += len(phrase)
+    return b"".join(reversed(phrases))
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise RuntimeError("The zstd history codec needs the zstandard package (pip install zstandard)")
+
+
+class HistoryCodec:
+    """Encodes medical_history for storage and decodes what was stored.
+
+    `dictionaries` is load_dictionaries()' result. Values compressed with a
+    dictionary that is not in it (trained after startup) are looked up with
+    `load_dictionary(id)`, which returns (codec, dictionary) or None.
+    """
+
+    def __init__(self, codec=None, dictionaries=None, min_size=256, level=None, load_dictionary=None):
+        if codec and codec not in CODECS:
+            raise ValueError(f"Unknown history codec {codec!r}, expected one of {', '.join(CODECS)}")
+        if codec == "zstd":
+            _require_zstandard()
+        self.codec = CODECS.get(codec)
+        self.min_size = min_size
+        self.level = level
+        self._dictionaries = dict(dictionaries or {})
+        self._load_dictionary = load_dictionary
+        self._local = threading.local()
+        self.dictionary_id = max(
+            (i for i, (dictionary_codec, _) in self._dictionaries.items() if dictionary_codec == self.codec),
+            default=0)
+
+    def encode(self, text):
+        if not self.codec or text is None:
+            return text
+        raw = text.encode()
+        if len(raw) < self.min_size:
+            return text
+        dictionary = self._dictionary(self.dictionary_id)
+        if self.codec == ZLIB:
+            level = self.level if self.level is not None else 6
+            compressor = zlib.compressobj(level, zdict=dictionary) if dictionary else zlib.compressobj(level)
+            body = compressor.compress(raw) + compressor.flush()
+        else:
+            body = self._zstd_compressor().compress(raw)
+        if len(body) + HEADER.size >= len(raw):
+            return text
+        return HEADER.pack(self.codec, self.dictionary_id) + body
+
+    def decode(self, value):
+        if not isinstance(value, bytes):
+            return value
+        codec, dictionary_id = HEADER.unpack_from(value)
+        dictionary = self._dictionary(dictionary_id)
+        body = value[HEADER.size:]
+        if codec == ZLIB:
+            decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+            return (decompressor.decompress(body) + decompressor.flush()).decode()
+        if codec == ZSTD:
+            _require_zstandard()
+            dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(body).decode()
+        raise ValueError(f"Unknown history codec {codec} in stored value")
+
+    def _dictionary(self, dictionary_id):
+        if not dictionary_id:
+            return None
+        if dictionary_id not in self._dictionaries:
+            found = self._load_dictionary(dictionary_id) if self._load_dictionary else None
+            if found is None:
+                raise ValueError(f"History dictionary {dictionary_id} not found")
+            self._dictionaries[dictionary_id] = found
+        return self._dictionaries[dictionary_id][1]
+
+    def _zstd_compressor(self):
+        # ZstdCompressor is not thread safe, keep one per worker thread
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            dictionary = self._dictionary(self.dictionary_id)
+            compressor = zstandard.ZstdCompressor(
+                level=self.level if self.level is not None else 3,
+                dict_data=zstandard.ZstdCompressionDict(dictionary) if dictionary else None)
+            self._local.compressor = compressor
+        return compressor
@@ -0,0 +1,117 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from load_tracking import Load, combine_loads
+
+# Shared by the records and prescription services, keep both copies in sync.
+#
+# Pre-fork mode: the parent process registers with discovery, sends the
+# status reports and serves /metrics, while SERVER_PROCESSES worker processes each
+# run their own gRPC server on the same port (SO_REUSEPORT) and the kernel
+# spreads incoming connections between them.
+#
+# Workers are started with "spawn" rather than fork(): gRPC core is not
+# fork-safe once initialised, and a fresh interpreter also picks up
+# PROMETHEUS_MULTIPROC_DIR when it first imports prometheus_client.
+
+log = logging.getLogger(__name__)
+
+# Each worker's Load takes this many slots of the shared array
+LOAD_WIDTH = len(Load._fields)
+
+
+def prepare_multiprocess_metrics():
+    """Point prometheus_client in the workers at a shared directory.
+
+    Leave PROMETHEUS_MULTIPROC_DIR unset to get a fresh temporary one. If it
+    is set it must already exist, and files left by earlier runs are removed.
+    """
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if not directory:
+        directory = tempfile.mkdtemp(prefix="prometheus-")
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = directory
+        atexit.register(shutil.rmtree, directory, True)
+    own_files = f"_{os.getpid()}.db"
+    for name in os.listdir(directory):
+        if name.endswith(".db") and not name.endswith(own_files):
+            os.remove(os.path.join(directory, name))
+    return directory
+
+
+def start_multiprocess_metrics_server(port, addr):
+    from prometheus_client import CollectorRegistry, start_http_server
+    from prometheus_client import multiprocess
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, addr, registry=registry)
+
+
+def publish_load(worker_loads, index, current_load, interval=0.5):
+    """Copy a worker's Load into its slot of the shared array, from a daemon thread."""
+    def publish():
+        while True:
+            worker_loads[index * LOAD_WIDTH:(index + 1) * LOAD_WIDTH] = list(current_load())
+            time.sleep(interval)
+
+    thread = threading.Thread(target=publish, daemon=True)
+    thread.start()
+    return thread
+
+
+def read_loads(worker_loads):
+    """The combined Load of every worker publishing into worker_loads."""
+    values = worker_loads[:]
+    return combine_loads(Load(*values[i:i + LOAD_WIDTH]) for i in range(0, len(values), LOAD_WIDTH))
+
+
+def run_workers(target, count, port, worker_loads, on_shutdown=None):
+    """Start `count` processes running target(port, worker_loads, index) and keep them alive.
+
+    Dead workers are restarted; SIGTERM/SIGINT call on_shutdown(), stop every
+    worker and return.
+    """
+    from prometheus_client import multiprocess
+
+    context = multiprocessing.get_context("spawn")
+    stopping = threading.Event()
+
+    def start(index):
+        process = context.Process(target=target, args=(port, worker_loads, index), name=f"worker-{index}")
+        process.start()
+        log.info("Started worker %s (pid %s)", index, process.pid)
+        return process
+
+    def stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    workers = [start(index) for index in range(count)]
+    while not stopping.wait(1):
+        for index, process in enumerate(workers):
+            if not process.is_alive():
+                log.error("Worker %s (pid %s) exited with %s, restarting", index, process.pid, process.exitcode)
+                multiprocess.mark_process_dead(process.pid)
+                worker_loads[index * LOAD_WIDTH:(index + 1) * LOAD_WIDTH] = [0] * LOAD_WIDTH
+                workers[index] = start(index)
+
+    if on_shutdown:
+        on_shutdown()
+    for process in workers:
+        process.terminate()
+    for process in workers:
+        process.join()
+        multiprocess.mark_process_dead(process.pid)
+
+
+def shared_loads(count):
+    return multiprocessing.get_context("spawn").Array("d", count * LOAD_WIDTH)
@@ -12,31 +12,67 @@ _sym_db = _symbol_database.Default()
 
 
 from google.protobuf import empty_pb2 as google_dot_protobuf_dot_empty__pb2
+from google.protobuf import field_mask_pb2 as google_dot_protobuf_dot_field__mask__pb2
+from google.protobuf import timestamp_pb2 as google_dot_protobuf_dot_timestamp__pb2
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rrecords.proto\x12\x07records\x1a\x1bgoogle/protobuf/empty.proto\";\n\x06Record\x12\n\n\x02id\x18\x01 \x01(\t\x12\x0c\n\x04name\x18\x02 \x01(\t\x12\x17\n\x0fmedical_history\x18\x03 \x01(\t\"<\n\x13\x43reateRecordRequest\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x17\n\x0fmedical_history\x18\x02 \x01(\t\")\n\x14GetRecordInfoRequest\x12\x11\n\trecord_id\x18\x01 \x01(\t\"M\n\x17UpdateRecordInfoRequest\x12\x11\n\trecord_id\x18\x01 \x01(\t\x12\x1f\n\x17updated_medical_history\x18\x02 \x01(\t\"(\n\x13\x44\x65leteRecordRequest\x12\x11\n\trecord_id\x18\x01 \x01(\t\"\x14\n\x12ListRecordsRequest\"7\n\x13ListRecordsResponse\x12 \n\x07records\x18\x01 \x03(\x0b\x32\x0f.records.Record\"#\n\rServiceStatus\x12\x12\n\nis_healthy\x18\x01 \x01(\x08\x32\xaa\x03\n\rRecordService\x12=\n\x0c\x43reateRecord\x12\x1c.records.CreateRecordRequest\x1a\x0f.records.Record\x12?\n\rGetRecordInfo\x12\x1d.records.GetRecordInfoRequest\x1a\x0f.records.Record\x12\x45\n\x10UpdateRecordInfo\x12 .records.UpdateRecordInfoRequest\x1a\x0f.records.Record\x12\x44\n\x0c\x44\x65leteRecord\x12\x1c.records.DeleteRecordRequest\x1a\x16.google.protobuf.Empty\x12H\n\x0bListRecords\x12\x1b.records.ListRecordsRequest\x1a\x1c.records.ListRecordsResponse\x12\x42\n\x10GetServiceStatus\x12\x16.google.protobuf.Empty\x1a\x16.records.ServiceStatusb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rrecords.proto\x12\x07records\x1a\x1bgoogle/protobuf/empty.proto\x1a google/protobuf/field_mask.proto\x1a\x1fgoogle/protobuf/timestamp.proto\"b\n\x06Record\x12\n\n\x02id\x18\x01 \x01(\t\x12\x0c\n\x04name\x18\x02 \x01(\t\x12\x17\n\x0fmedical_history\x18\x03 \x01(\t\x12\x0f\n\x07version\x18\x04 \x01(\x03\x12\x14\n\x0cnot_modified\x18\x05 \x01(\x08\"<\n\x13\x43reateRecordRequest\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x17\n\x0fmedical_history\x18\x02 \x01(\t\"o\n\x14GetRecordInfoRequest\x12\x11\n\trecord_id\x18\x01 \x01(\t\x12\x15\n\rif_none_match\x18\x02 \x01(\x03\x12-\n\tread_mask\x18\x03 \x01(\x0b\x32\x1a.google.protobuf.FieldMask\"g\n\x17UpdateRecordInfoRequest\x12\x11\n\trecord_id\x18\x01 \x01(\t\x12\x1f\n\x17updated_medical_history\x18\x02 \x01(\t\x12\x18\n\x10\x65xpected_version\x18\x03 \x01(\x03\"Y\n\x1b\x41ppendMedicalHistoryRequest\x12\x11\n\trecord_id\x18\x01 \x01(\t\x12\r\n\x05\x65ntry\x18\x02 \x01(\t\x12\x18\n\x10\x65xpected_version\x18\x03 \x01(\x03\"(\n\x13\x44\x65leteRecordRequest\x12\x11\n\trecord_id\x18\x01 \x01(\t\"\xd2\x01\n\x12ListRecordsRequest\x12\x11\n\tpage_size\x18\x01 \x01(\x05\x12\x12\n\npage_token\x18\x02 \x01(\t\x12-\n\tread_mask\x18\x03 \x01(\x0b\x32\x1a.google.protobuf.FieldMask\x12\x13\n\x0bname_prefix\x18\x04 \x01(\t\x12\x0e\n\x06min_id\x18\x05 \x01(\t\x12\x0e\n\x06max_id\x18\x06 \x01(\t\x12\x31\n\rupdated_since\x18\x07 \x01(\x0b\x32\x1a.google.protobuf.Timestamp\"P\n\x13ListRecordsResponse\x12 \n\x07records\x18\x01 \x03(\x0b\x32\x0f.records.Record\x12\x17\n\x0fnext_page_token\x18\x02 \x01(\t\"m\n\x14StreamRecordsRequest\x12\x12\n\npage_token\x18\x01 \x01(\t\x12\x12\n\nchunk_size\x18\x02 \x01(\x05\x12-\n\tread_mask\x18\x03 \x01(\x0b\x32\x1a.google.protobuf.FieldMask\"{\n\x14SearchRecordsRequest\x12\r\n\x05query\x18\x01 \x01(\t\x12\x11\n\tpage_size\x18\x02 \x01(\x05\x12\x12\n\npage_token\x18\x03 \x01(\t\x12-\n\tread_mask\x18\x04 \x01(\x0b\x32\x1a.google.protobuf.FieldMask\">\n\x0cSearchResult\x12\x1f\n\x06record\x18\x01 \x01(\x0b\x32\x0f.records.Record\x12\r\n\x05score\x18\x02 \x01(\x01\"k\n\x15SearchRecordsResponse\x12&\n\x07results\x18\x01 \x03(\x0b\x32\x15.records.SearchResult\x12\x17\n\x0fnext_page_token\x18\x02 \x01(\t\x12\x11\n\ttruncated\x18\x03 \x01(\x08\"J\n\x19\x42\x61tchCreateRecordsRequest\x12-\n\x07records\x18\x01 \x03(\x0b\x32\x1c.records.CreateRecordRequest\",\n\x16\x42\x61tchGetRecordsRequest\x12\x12\n\nrecord_ids\x18\x01 \x03(\t\"/\n\x19\x42\x61tchDeleteRecordsRequest\x12\x12\n\nrecord_ids\x18\x01 \x03(\t\"b\n\x11\x42\x61tchRecordResult\x12\x11\n\trecord_id\x18\x01 \x01(\t\x12\n\n\x02ok\x18\x02 \x01(\x08\x12\r\n\x05\x65rror\x18\x03 \x01(\t\x12\x1f\n\x06record\x18\x04 \x01(\x0b\x32\x0f.records.Record\"C\n\x14\x42\x61tchRecordsResponse\x12+\n\x07results\x18\x01 \x03(\x0b\x32\x1a.records.BatchRecordResult\"J\n\rImportSummary\x12\x10\n\x08imported\x18\x01 \x01(\x03\x12\x0e\n\x06\x66\x61iled\x18\x02 \x01(\x03\x12\x17\n\x0frows_per_second\x18\x03 \x01(\x01\"#\n\rServiceStatus\x12\x12\n\nis_healthy\x18\x01 \x01(\x08\"=\n\x13WatchChangesRequest\x12\x14\n\x0c\x61\x66ter_offset\x18\x01 \x01(\x03\x12\x10\n\x08\x66rom_now\x18\x02 \x01(\x08\"[\n\x06\x43hange\x12\x0e\n\x06offset\x18\x01 \x01(\x03\x12\x1d\n\x02op\x18\x02 \x01(\x0e\x32\x11.records.ChangeOp\x12\x11\n\trecord_id\x18\x03 \x01(\t\x12\x0f\n\x07version\x18\x04 \x01(\x03\":\n\x10ReplicateRequest\x12\x14\n\x0c\x61\x66ter_offset\x18\x01 \x01(\x03\x12\x10\n\x08snapshot\x18\x02 \x01(\x08\"j\n\x10ReplicatedRecord\x12\n\n\x02id\x18\x01 \x01(\t\x12\x0c\n\x04name\x18\x02 \x01(\t\x12\x17\n\x0fmedical_history\x18\x03 \x01(\t\x12\x0f\n\x07version\x18\x04 \x01(\x03\x12\x12\n\nupdated_at\x18\x05 \x01(\x03\"\xa1\x01\n\x10ReplicationBatch\x12\x0e\n\x06offset\x18\x01 \x01(\x03\x12*\n\x07records\x18\x02 \x03(\x0b\x32\x19.records.ReplicatedRecord\x12\x13\n\x0b\x64\x65leted_ids\x18\x03 \x03(\t\x12\x10\n\x08snapshot\x18\x04 \x01(\x08\x12\x15\n\rsnapshot_done\x18\x05 \x01(\x08\x12\x13\n\x0bhead_offset\x18\x06 \x01(\x03*L\n\x08\x43hangeOp\x12\x19\n\x15\x43HANGE_OP_UNSPECIFIED\x10\x00\x12\x0b\n\x07\x43REATED\x10\x01\x12\x0b\n\x07UPDATED\x10\x02\x12\x0b\n\x07\x44\x45LETED\x10\x03\x32\xe0\x08\n\rRecordService\x12=\n\x0c\x43reateRecord\x12\x1c.records.CreateRecordRequest\x1a\x0f.records.Record\x12?\n\rGetRecordInfo\x12\x1d.records.GetRecordInfoRequest\x1a\x0f.records.Record\x12\x45\n\x10UpdateRecordInfo\x12 .records.UpdateRecordInfoRequest\x1a\x0f.records.Record\x12M\n\x14\x41ppendMedicalHistory\x12$.records.AppendMedicalHistoryRequest\x1a\x0f.records.Record\x12\x44\n\x0c\x44\x65leteRecord\x12\x1c.records.DeleteRecordRequest\x1a\x16.google.protobuf.Empty\x12H\n\x0bListRecords\x12\x1b.records.ListRecordsRequest\x1a\x1c.records.ListRecordsResponse\x12\x41\n\rStreamRecords\x12\x1d.records.StreamRecordsRequest\x1a\x0f.records.Record0\x01\x12N\n\rSearchRecords\x12\x1d.records.SearchRecordsRequest\x1a\x1e.records.SearchRecordsResponse\x12W\n\x12\x42\x61tchCreateRecords\x12\".records.BatchCreateRecordsRequest\x1a\x1d.records.BatchRecordsResponse\x12Q\n\x0f\x42\x61tchGetRecords\x12\x1f.records.BatchGetRecordsRequest\x1a\x1d.records.BatchRecordsResponse\x12W\n\x12\x42\x61tchDeleteRecords\x12\".records.BatchDeleteRecordsRequest\x1a\x1d.records.BatchRecordsResponse\x12G\n\rImportRecords\x12\x1c.records.CreateRecordRequest\x1a\x16.records.ImportSummary(\x01\x12?\n\x0cWatchChanges\x12\x1c.records.WatchChangesRequest\x1a\x0f.records.Change0\x01\x12\x43\n\tReplicate\x12\x19.records.ReplicateRequest\x1a\x19.records.ReplicationBatch0\x01\x12\x42\n\x10GetServiceStatus\x12\x16.google.protobuf.Empty\x1a\x16.records.ServiceStatusb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'records_pb2', _globals)
 if _descriptor._USE_C_DESCRIPTORS == False:
   DESCRIPTOR._options = None
-  _globals['_RECORD']._serialized_start=55
-  _globals['_RECORD']._serialized_end=114
-  _globals['_CREATERECORDREQUEST']._serialized_start=116
-  _globals['_CREATERECORDREQUEST']._serialized_end=176
-  _globals['_GETRECORDINFOREQUEST']._serialized_start=178
-  _globals['_GETRECORDINFOREQUEST']._serialized_end=219
-  _globals['_UPDATERECORDINFOREQUEST']._serialized_start=221
-  _globals['_UPDATERECORDINFOREQUEST']._serialized_end=298
-  _globals['_DELETERECORDREQUEST']._serialized_start=300
-  _globals['_DELETERECORDREQUEST']._serialized_end=340
-  _globals['_LISTRECORDSREQUEST']._serialized_start=342
-  _globals['_LISTRECORDSREQUEST']._serialized_end=362
-  _globals['_LISTRECORDSRESPONSE']._serialized_start=364
-  _globals['_LISTRECORDSRESPONSE']._serialized_end=419
-  _globals['_SERVICESTATUS']._serialized_start=421
-  _globals['_SERVICESTATUS']._serialized_end=456
-  _globals['_RECORDSERVICE']._serialized_start=459
-  _globals['_RECORDSERVICE']._serialized_end=885
+  _globals['_CHANGEOP']._serialized_start=2280
+  _globals['_CHANGEOP']._serialized_end=2356
+  _globals['_RECORD']._serialized_start=122
+  _globals['_RECORD']._serialized_end=220
+  _globals['_CREATERECORDREQUEST']._serialized_start=222
+  _globals['_CREATERECORDREQUEST']._serialized_end=282
+  _globals['_GETRECORDINFOREQUEST']._serialized_start=284
+  _globals['_GETRECORDINFOREQUEST']._serialized_end=395
+  _globals['_UPDATERECORDINFOREQUEST']._serialized_start=397
+  _globals['_UPDATERECORDINFOREQUEST']._serialized_end=500
+  _globals['_APPENDMEDICALHISTORYREQUEST']._serialized_start=502
+  _globals['_APPENDMEDICALHISTORYREQUEST']._serialized_end=591
+  _globals['_DELETERECORDREQUEST']._serialized_start=593
+  _globals['_DELETERECORDREQUEST']._serialized_end=633
+  _globals['_LISTRECORDSREQUEST']._serialized_start=636
+  _globals['_LISTRECORDSREQUEST']._serialized_end=846
+  _globals['_LISTRECORDSRESPONSE']._serialized_start=848
+  _globals['_LISTRECORDSRESPONSE']._serialized_end=928
+  _globals['_STREAMRECORDSREQUEST']._serialized_start=930
+  _globals['_STREAMRECORDSREQUEST']._serialized_end=1039
+  _globals['_SEARCHRECORDSREQUEST']._serialized_start=1041
+  _globals['_SEARCHRECORDSREQUEST']._serialized_end=1164
+  _globals['_SEARCHRESULT']._serialized_start=1166
+  _globals['_SEARCHRESULT']._serialized_end=1228
+  _globals['_SEARCHRECORDSRESPONSE']._serialized_start=1230
+  _globals['_SEARCHRECORDSRESPONSE']._serialized_end=1337
+  _globals['_BATCHCREATERECORDSREQUEST']._serialized_start=1339
+  _globals['_BATCHCREATERECORDSREQUEST']._serialized_end=1413
+  _globals['_BATCHGETRECORDSREQUEST']._serialized_start=1415
+  _globals['_BATCHGETRECORDSREQUEST']._serialized_end=1459
+  _globals['_BATCHDELETERECORDSREQUEST']._serialized_start=1461
+  _globals['_BATCHDELETERECORDSREQUEST']._serialized_end=1508
+  _globals['_BATCHRECORDRESULT']._serialized_start=1510
+  _globals['_BATCHRECORDRESULT']._serialized_end=1608
+  _globals['_BATCHRECORDSRESPONSE']._serialized_start=1610
+  _globals['_BATCHRECORDSRESPONSE']._serialized_end=1677
+  _globals['_IMPORTSUMMARY']._serialized_start=1679
+  _globals['_IMPORTSUMMARY']._serialized_end=1753
+  _globals['_SERVICESTATUS']._serialized_start=1755
+  _globals['_SERVICESTATUS']._serialized_end=1790
+  _globals['_WATCHCHANGESREQUEST']._serialized_start=1792
+  _globals['_WATCHCHANGESREQUEST']._serialized_end=1853
+  _globals['_CHANGE']._serialized_start=1855
+  _globals['_CHANGE']._serialized_end=1946
+  _globals['_REPLICATEREQUEST']._serialized_start=1948
+  _globals['_REPLICATEREQUEST']._serialized_end=2006
+  _globals['_REPLICATEDRECORD']._serialized_start=2008
+  _globals['_REPLICATEDRECORD']._serialized_end=2114
+  _globals['_REPLICATIONBATCH']._serialized_start=2117
+  _globals['_REPLICATIONBATCH']._serialized_end=2278
+  _globals['_RECORDSERVICE']._serialized_start=2359
+  _globals['_RECORDSERVICE']._serialized_end=3479
 # @@protoc_insertion_point(module_scope)
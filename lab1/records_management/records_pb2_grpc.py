@@ -30,6 +30,11 @@ class RecordServiceStub(object):
                 request_serializer=records__pb2.UpdateRecordInfoRequest.SerializeToString,
                 response_deserializer=records__pb2.Record.FromString,
                 )
+        self.AppendMedicalHistory = channel.unary_unary(
+                '/records.RecordService/AppendMedicalHistory',
+                request_serializer=records__pb2.AppendMedicalHistoryRequest.SerializeToString,
+                response_deserializer=records__pb2.Record.FromString,
+                )
         self.DeleteRecord = channel.unary_unary(
                 '/records.RecordService/DeleteRecord',
                 request_serializer=records__pb2.DeleteRecordRequest.SerializeToString,
@@ -40,6 +45,46 @@ class RecordServiceStub(object):
                 request_serializer=records__pb2.ListRecordsRequest.SerializeToString,
                 response_deserializer=records__pb2.ListRecordsResponse.FromString,
                 )
+        self.StreamRecords = channel.unary_stream(
+                '/records.RecordService/StreamRecords',
+                request_serializer=records__pb2.StreamRecordsRequest.SerializeToString,
+                response_deserializer=records__pb2.Record.FromString,
+                )
+        self.SearchRecords = channel.unary_unary(
+                '/records.RecordService/SearchRecords',
+                request_serializer=records__pb2.SearchRecordsRequest.SerializeToString,
+                response_deserializer=records__pb2.SearchRecordsResponse.FromString,
+                )
+        self.BatchCreateRecords = channel.unary_unary(
+                '/records.RecordService/BatchCreateRecords',
+                request_serializer=records__pb2.BatchCreateRecordsRequest.SerializeToString,
+                response_deserializer=records__pb2.BatchRecordsResponse.FromString,
+                )
+        self.BatchGetRecords = channel.unary_unary(
+                '/records.RecordService/BatchGetRecords',
+                request_serializer=records__pb2.BatchGetRecordsRequest.SerializeToString,
+                response_deserializer=records__pb2.BatchRecordsResponse.FromString,
+                )
+        self.BatchDeleteRecords = channel.unary_unary(
+                '/records.RecordService/BatchDeleteRecords',
+                request_serializer=records__pb2.BatchDeleteRecordsRequest.SerializeToString,
+                response_deserializer=records__pb2.BatchRecordsResponse.FromString,
+                )
+        self.ImportRecords = channel.stream_unary(
+                '/records.RecordService/ImportRecords',
+                request_serializer=records__pb2.CreateRecordRequest.SerializeToString,
+                response_deserializer=records__pb2.ImportSummary.FromString,
+                )
+        self.WatchChanges = channel.unary_stream(
+                '/records.RecordService/WatchChanges',
+                request_serializer=records__pb2.WatchChangesRequest.SerializeToString,
+                response_deserializer=records__pb2.Change.FromString,
+                )
+        self.Replicate = channel.unary_stream(
+                '/records.RecordService/Replicate',
+                request_serializer=records__pb2.ReplicateRequest.SerializeToString,
+                response_deserializer=records__pb2.ReplicationBatch.FromString,
+                )
         self.GetServiceStatus = channel.unary_unary(
                 '/records.RecordService/GetServiceStatus',
                 request_serializer=google_dot_protobuf_dot_empty__pb2.Empty.SerializeToString,
@@ -68,6 +113,13 @@ class RecordServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def AppendMedicalHistory(self, request, context):
+        """only id and the new version are set
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def DeleteRecord(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -81,6 +133,54 @@ class RecordServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def StreamRecords(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def SearchRecords(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def BatchCreateRecords(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def BatchGetRecords(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def BatchDeleteRecords(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def ImportRecords(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def WatchChanges(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Replicate(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def GetServiceStatus(self, request, context):
         """New status endpoint
         """
@@ -106,6 +206,11 @@ def add_RecordServiceServicer_to_server(servicer, server):
                     request_deserializer=records__pb2.UpdateRecordInfoRequest.FromString,
                     response_serializer=records__pb2.Record.SerializeToString,
             ),
+            'AppendMedicalHistory': grpc.unary_unary_rpc_method_handler(
+                    servicer.AppendMedicalHistory,
+                    request_deserializer=records__pb2.AppendMedicalHistoryRequest.FromString,
+                    response_serializer=records__pb2.Record.SerializeToString,
+            ),
             'DeleteRecord': grpc.unary_unary_rpc_method_handler(
                     servicer.DeleteRecord,
                     request_deserializer=records__pb2.DeleteRecordRequest.FromString,
@@ -116,6 +221,46 @@ def add_RecordServiceServicer_to_server(servicer, server):
                     request_deserializer=records__pb2.ListRecordsRequest.FromString,
                     response_serializer=records__pb2.ListRecordsResponse.SerializeToString,
             ),
+            'StreamRecords': grpc.unary_stream_rpc_method_handler(
+                    servicer.StreamRecords,
+                    request_deserializer=records__pb2.StreamRecordsRequest.FromString,
+                    response_serializer=records__pb2.Record.SerializeToString,
+            ),
+            'SearchRecords': grpc.unary_unary_rpc_method_handler(
+                    servicer.SearchRecords,
+                    request_deserializer=records__pb2.SearchRecordsRequest.FromString,
+                    response_serializer=records__pb2.SearchRecordsResponse.SerializeToString,
+            ),
+            'BatchCreateRecords': grpc.unary_unary_rpc_method_handler(
+                    servicer.BatchCreateRecords,
+                    request_deserializer=records__pb2.BatchCreateRecordsRequest.FromString,
+                    response_serializer=records__pb2.BatchRecordsResponse.SerializeToString,
+            ),
+            'BatchGetRecords': grpc.unary_unary_rpc_method_handler(
+                    servicer.BatchGetRecords,
+                    request_deserializer=records__pb2.BatchGetRecordsRequest.FromString,
+                    response_serializer=records__pb2.BatchRecordsResponse.SerializeToString,
+            ),
+            'BatchDeleteRecords': grpc.unary_unary_rpc_method_handler(
+                    servicer.BatchDeleteRecords,
+                    request_deserializer=records__pb2.BatchDeleteRecordsRequest.FromString,
+                    response_serializer=records__pb2.BatchRecordsResponse.SerializeToString,
+            ),
+            'ImportRecords': grpc.stream_unary_rpc_method_handler(
+                    servicer.ImportRecords,
+                    request_deserializer=records__pb2.CreateRecordRequest.FromString,
+                    response_serializer=records__pb2.ImportSummary.SerializeToString,
+            ),
+            'WatchChanges': grpc.unary_stream_rpc_method_handler(
+                    servicer.WatchChanges,
+                    request_deserializer=records__pb2.WatchChangesRequest.FromString,
+                    response_serializer=records__pb2.Change.SerializeToString,
+            ),
+            'Replicate': grpc.unary_stream_rpc_method_handler(
+                    servicer.Replicate,
+                    request_deserializer=records__pb2.ReplicateRequest.FromString,
+                    response_serializer=records__pb2.ReplicationBatch.SerializeToString,
+            ),
             'GetServiceStatus': grpc.unary_unary_rpc_method_handler(
                     servicer.GetServiceStatus,
                     request_deserializer=google_dot_protobuf_dot_empty__pb2.Empty.FromString,
@@ -182,6 +327,23 @@ class RecordService(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def AppendMedicalHistory(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/records.RecordService/AppendMedicalHistory',
+            records__pb2.AppendMedicalHistoryRequest.SerializeToString,
+            records__pb2.Record.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def DeleteRecord(request,
             target,
@@ -216,6 +378,142 @@ class RecordService(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def StreamRecords(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/records.RecordService/StreamRecords',
+            records__pb2.StreamRecordsRequest.SerializeToString,
+            records__pb2.Record.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def SearchRecords(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/records.RecordService/SearchRecords',
+            records__pb2.SearchRecordsRequest.SerializeToString,
+            records__pb2.SearchRecordsResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def BatchCreateRecords(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/records.RecordService/BatchCreateRecords',
+            records__pb2.BatchCreateRecordsRequest.SerializeToString,
+            records__pb2.BatchRecordsResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def BatchGetRecords(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/records.RecordService/BatchGetRecords',
+            records__pb2.BatchGetRecordsRequest.SerializeToString,
+            records__pb2.BatchRecordsResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def BatchDeleteRecords(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/records.RecordService/BatchDeleteRecords',
+            records__pb2.BatchDeleteRecordsRequest.SerializeToString,
+            records__pb2.BatchRecordsResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def ImportRecords(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(request_iterator, target, '/records.RecordService/ImportRecords',
+            records__pb2.CreateRecordRequest.SerializeToString,
+            records__pb2.ImportSummary.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def WatchChanges(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/records.RecordService/WatchChanges',
+            records__pb2.WatchChangesRequest.SerializeToString,
+            records__pb2.Change.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def Replicate(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/records.RecordService/Replicate',
+            records__pb2.ReplicateRequest.SerializeToString,
+            records__pb2.ReplicationBatch.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def GetServiceStatus(request,
             target,
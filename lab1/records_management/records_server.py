@@ -1,247 +1,1072 @@
 import grpc
 import records_pb2
 import records_pb2_grpc
-from registration_pb2 import ServiceRegistration, DeregisterServiceRequest, SendServiceStatusRequest, Heartbeat
-from registration_pb2_grpc import RegistrationServiceStub
 import sqlite3
 from concurrent import futures
 from google.protobuf import empty_pb2
+import signal
 import threading
 import time
+import asyncio
+import heapq
+import logging
 import os
+import queue
+import string
+import sys
 from dotenv import load_dotenv
 from py_grpc_prometheus.prometheus_server_interceptor import PromServerInterceptor
-from prometheus_client import start_http_server
+from prometheus_client import start_http_server, Counter, Gauge
+from db_pool import ConnectionPool, batched, like_prefix, placeholders
+from fault_injection import fault_injection_from_env
+from aio_server import AsyncServicerAdapter, PromAioServerInterceptor
+from discovery_client import DiscoveryClient
+from load_tracking import LoadTracker, LoadTrackingInterceptor
+from read_cache import ReadCache
+from change_log import WatcherSlots, create_change_log, log_bounds, watch_changes
+from history_codec import HistoryCodec, create_dictionary_table, load_dictionaries
+from response_compression import response_compression_from_env
+from search_index import (backfill_search_index, create_search_index, index_records, rank_floor, refresh_schema,
+                          reindex_history, search)
+from migrations import Migration, add_column, execute_statements, migrate, run_online_migrations, start_online_migrations
+from shards import SHARD_BITS, SLOTS, ShardSet, SlotMoving, create_shard_tables, initialize_shards
+import replication
+from replication import Replica, ReplicaInterceptor, create_replication_state
+from prefork import prepare_multiprocess_metrics, start_multiprocess_metrics_server, publish_load, read_loads, run_workers, shared_loads
+from service_logging import configure_logging, request_logger
+from stage_metrics import stage_metrics_from_env, timed
+from tracing import configure_tracing, tracing_from_env
 
 load_dotenv()
 PROMETHEUS_PORT = int(os.getenv("PROMETHEUS_PORT"))
 PROMETHEUS_HOSTNAME = os.getenv("PROMETHEUS_HOSTNAME")
-print(PROMETHEUS_HOSTNAME)
-print(PROMETHEUS_PORT)
 
 SERVICE_NAME = "records-service"
+configure_logging(SERVICE_NAME)
+configure_tracing(SERVICE_NAME)
+log = logging.getLogger("records")
+# One record per call, sampled, see service_logging.py
+rpc_log = request_logger("records.rpc")
 SERVICE_HOSTNAME = os.getenv("RECORDS_SERVICE_HOSTNAME")
 RECORDS_SERVICE_PORT = int(os.getenv("RECORDS_SERVICE_PORT"))
 
 SERVICE_DISCOVERY_HOSTNAME = os.getenv("SERVICE_DISCOVERY_HOSTNAME")
 SERVICE_DISCOVERY_PORT = os.getenv("SERVICE_DISCOVERY_PORT")
 SERVICE_DISCOVERY_URL = f"{SERVICE_DISCOVERY_HOSTNAME}:{SERVICE_DISCOVERY_PORT}"
-print(SERVICE_DISCOVERY_HOSTNAME)
 
-DATABASE = "records.db"
+DATABASE = os.getenv("RECORDS_DATABASE", "records.db")
+# Sharded storage, see shards.py: the shard databases, comma separated,
+# replacing RECORDS_DATABASE. Only ever append to the list, a shard's
+# position in it is part of the ids it allocates.
+RECORDS_SHARDS = [path.strip() for path in os.getenv("RECORDS_SHARDS", "").split(",") if path.strip()]
+# Seconds between reloads of the slot map, which reshard.py changes
+SHARD_MAP_REFRESH = float(os.getenv("SHARD_MAP_REFRESH", 1))
+# A read replica of the records service at this address (host:port), see replication.py
+RECORDS_PRIMARY = os.getenv("RECORDS_PRIMARY")
+# Seconds a replica's data may be behind the primary before it refuses reads
+MAX_REPLICA_STALENESS = float(os.getenv("MAX_REPLICA_STALENESS", 5))
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", 10))
+# "threads" (grpc.server on a thread pool) or "aio" (grpc.aio server, the
+# blocking handlers on MAX_WORKERS threads for now, see aio_server.py)
+SERVER_MODE = os.getenv("SERVER_MODE", "threads")
+# More than 1 starts that many worker processes sharing the port (SO_REUSEPORT)
+SERVER_PROCESSES = int(os.getenv("SERVER_PROCESSES", 1))
+# Seconds in-flight calls get to finish after SIGTERM
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", 5))
+# "rollback" (SQLite default journal) or "wal" (WAL + single group-committing writer)
+DATABASE_MODE = os.getenv("DATABASE_MODE", "rollback")
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 100))
+# GetRecordInfo cache, READ_CACHE_SIZE=0 turns it off. Off with several
+# worker processes: a write only invalidates the cache of the process that
+# made it, the others would serve the old row until the TTL
+READ_CACHE_SIZE = int(os.getenv("READ_CACHE_SIZE", 10000)) if SERVER_PROCESSES == 1 else 0
+READ_CACHE_BYTES = int(os.getenv("READ_CACHE_BYTES", 64 * 1024 * 1024))
+READ_CACHE_TTL = float(os.getenv("READ_CACHE_TTL", 10))
+# WatchChanges: entries kept in the change log and how often watchers poll it
+CHANGE_LOG_RETENTION = int(os.getenv("CHANGE_LOG_RETENTION", 1000000))
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", 0.2))
+# Change streams (WatchChanges, Replicate) served at once, each on a thread
+# of its own on top of MAX_WORKERS so watchers never starve unary calls
+MAX_WATCHERS = int(os.getenv("MAX_WATCHERS", 16))
+# Storage codec for medical_history ("zlib" or "zstd"), see history_codec.py
+HISTORY_CODEC = os.getenv("HISTORY_CODEC")
+HISTORY_COMPRESS_MIN = int(os.getenv("HISTORY_COMPRESS_MIN", 256))
+# Records with at least HISTORY_COMPACT_ENTRIES appended entries get them
+# folded into medical_history every HISTORY_COMPACT_INTERVAL seconds (0 never)
+HISTORY_COMPACT_ENTRIES = int(os.getenv("HISTORY_COMPACT_ENTRIES", 32))
+HISTORY_COMPACT_INTERVAL = float(os.getenv("HISTORY_COMPACT_INTERVAL", 30))
+# SearchRecords ranks every match of a query, or only the newest
+# SEARCH_RANK_WINDOW of them (responses leaving older ones out are truncated)
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", 0))
 
-connection = sqlite3.connect(DATABASE)
-cursor = connection.cursor()
-cursor.execute('''
+# Pause between the steps of online migrations, leaving the writer to requests
+MIGRATION_PAUSE = float(os.getenv("MIGRATION_PAUSE", 0.05))
+
+def create_records(connection):
+    connection.execute('''
         CREATE TABLE IF NOT EXISTS records (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT,
             medical_history TEXT
         )
     ''')
-connection.commit()
-cursor.close
-
-load_counter = 1
-
-def increase_load():
-    global load_counter
-    load_counter += 1
-
-def decrease_load():
-    global load_counter
-    load_counter -= 1
-
-def register_service(RECORDS_SERVICE_PORT):
-    with grpc.insecure_channel(SERVICE_DISCOVERY_URL) as channel:
-        stub = RegistrationServiceStub(channel)
-        registration_info = ServiceRegistration(
-            name=SERVICE_NAME,
-            host=SERVICE_HOSTNAME,
-            port=RECORDS_SERVICE_PORT  # The port where your Python service listens
-        )
-        stub.RegisterService(registration_info)
-        print("Service registered with the Node.js gateway")
-
-def deregister_service(RECORDS_SERVICE_PORT):
-    with grpc.insecure_channel(SERVICE_DISCOVERY_URL) as channel:
-        stub = RegistrationServiceStub(channel)
-        deregistration_request = DeregisterServiceRequest(
-            name=SERVICE_NAME,
-            host=SERVICE_HOSTNAME,
-            port=RECORDS_SERVICE_PORT  # The port where your Python service listens
-        )
-    stub.DeregisterService(deregistration_request)
-
-    return empty_pb2.Empty()
-
-def update_service_status(RECORDS_SERVICE_PORT):
-    global load_counter
-    with grpc.insecure_channel(SERVICE_DISCOVERY_URL) as channel:
-        stub = RegistrationServiceStub(channel)
-        status_request = SendServiceStatusRequest(
-            service_name=SERVICE_NAME,
-            port=RECORDS_SERVICE_PORT,
-            load=load_counter
-        )
-        stub.UpdateServiceStatus(status_request)
-        # print(f"Service status updated {load_counter}")
-
-def update_service_heartbeat(RECORDS_SERVICE_PORT):
-    with grpc.insecure_channel(SERVICE_DISCOVERY_URL) as channel:
-        stub = RegistrationServiceStub(channel)
-        heartbeat = Heartbeat(
-            service_name=SERVICE_NAME,
-            port=RECORDS_SERVICE_PORT
-        )
-        stub.UpdateServiceHeartbeat(heartbeat)
-        # print("Service heartbeat updated")
-        
-def update_service_status_and_heartbeat_periodically(RECORDS_SERVICE_PORT):
-    while True:
+
+def create_history_entries(connection):
+    # AppendMedicalHistory adds entries here instead of rewriting medical_history.
+    # The full history is medical_history (the snapshot) followed by the entries
+    # not yet compacted into it; compacted entries are kept, with the version
+    # each one produced.
+    execute_statements(connection, '''
+        CREATE TABLE IF NOT EXISTS record_history_entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            record_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            entry TEXT NOT NULL,
+            compacted INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS record_history_entries_record_id
+            ON record_history_entries (record_id, compacted, id);
+        -- Only what the compactor scans for candidates
+        CREATE INDEX IF NOT EXISTS record_history_entries_pending
+            ON record_history_entries (record_id) WHERE compacted = 0;
+        CREATE TRIGGER IF NOT EXISTS records_delete_history AFTER DELETE ON records
+        BEGIN
+            DELETE FROM record_history_entries WHERE record_id = OLD.id;
+        END;
+    ''')
+
+def backfill_search(pool, cursor):
+    return pool.write(lambda connection: backfill_search_index(connection, cursor or 0, history_codec.decode))
+
+# Append only; versions 1-4 are the schema as it was before migrations and
+# leave databases created back then unchanged
+MIGRATIONS = [
+    Migration(1, "create records", create_records),
+    Migration(2, "add records.version", lambda connection: add_column(
+        connection, "records", "version", "INTEGER NOT NULL DEFAULT 1")),
+    Migration(3, "create record_history_entries", create_history_entries),
+    Migration(4, "create history_dictionaries", create_dictionary_table),
+    Migration(5, "create records_search", create_search_index),
+    Migration(6, "index existing records for search", backfill_search, online=True),
+    # Milliseconds since the epoch of the last create or change, 0 for
+    # records last written before there was this column
+    Migration(7, "add records.updated_at", lambda connection: add_column(
+        connection, "records", "updated_at", "INTEGER NOT NULL DEFAULT 0")),
+    # The indexes ListRecords' filters search, see list_records_query(). Index
+    # builds hold the write lock throughout, see migrations.py
+    Migration(8, "index records.name", lambda connection: connection.execute(
+        "CREATE INDEX IF NOT EXISTS records_name ON records (name COLLATE NOCASE)")),
+    Migration(9, "index records.updated_at", lambda connection: connection.execute(
+        "CREATE INDEX IF NOT EXISTS records_updated_at ON records (updated_at)")),
+    # Sharded storage, see shards.py; reshard.py finds the records of a slot by the index
+    Migration(10, "create shard tables", create_shard_tables),
+    Migration(11, "index records by slot", lambda connection: connection.execute(
+        f"CREATE INDEX IF NOT EXISTS records_slot ON records (id & {SLOTS - 1})")),
+    Migration(12, "create replication_state", create_replication_state),
+]
+
+if RECORDS_PRIMARY and RECORDS_SHARDS:
+    raise ValueError("Sharded records cannot be replicated, set RECORDS_PRIMARY or RECORDS_SHARDS")
+
+DATABASES = RECORDS_SHARDS or [DATABASE]
+connections = [sqlite3.connect(database, timeout=30) for database in DATABASES]
+for connection in connections:
+    migrate(connection, MIGRATIONS)
+    create_change_log(connection, "records", "record_changes", "record_id", CHANGE_LOG_RETENTION)
+    connection.commit()
+# Shard 0 holds the history dictionaries and the slot map
+history_dictionaries = load_dictionaries(connections[0])
+slot_owners = initialize_shards(connections) if RECORDS_SHARDS else None
+for connection in connections:
+    connection.close()
+
+# ListRecords pages and StreamRecords chunks are keyset queries on id
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500
+MAX_BATCH_SIZE = 10000
+# ImportRecords commits every IMPORT_CHUNK_SIZE rows, bounding server memory
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 1000))
+
+IMPORTED_RECORDS = Counter("records_imported_total", "Records committed by ImportRecords")
+IMPORT_FAILURES = Counter("records_import_failed_total", "Records ImportRecords failed to store")
+IMPORT_ROWS_PER_SECOND = Gauge("records_import_rows_per_second", "Throughput of the most recent ImportRecords call", multiprocess_mode="max")
+
+# One connection per gRPC worker thread (change stream threads included),
+# reused across requests. Sharded, as many again for the threads that read
+# every shard at once.
+pools = [ConnectionPool(database, max_size=(MAX_WORKERS + MAX_WATCHERS) * (2 if RECORDS_SHARDS else 1),
+                        mode=DATABASE_MODE, max_batch=WRITE_BATCH_SIZE) for database in DATABASES]
+shards = ShardSet(pools, bool(RECORDS_SHARDS), slot_owners, MAX_WORKERS)
+# The database, shard 0 when sharded
+pool = pools[0]
+
+def load_history_dictionary(dictionary_id):
+    # Dictionaries trained after startup
+    with pool.connection() as connection:
+        return load_dictionaries(connection).get(dictionary_id)
+
+history_codec = HistoryCodec(HISTORY_CODEC, history_dictionaries, HISTORY_COMPRESS_MIN,
+                             load_dictionary=load_history_dictionary)
+
+# Records by id, invalidated after every write that changes or removes one
+record_cache = ReadCache("records", READ_CACHE_SIZE, READ_CACHE_BYTES, READ_CACHE_TTL)
+
+# Fed by LoadTrackingInterceptor, reported to discovery
+load_tracker = LoadTracker()
+watcher_slots = WatcherSlots(MAX_WATCHERS)
+# Per-worker loads shared with the parent in pre-fork mode
+worker_loads = None
+
+def replica_staleness():
+    # Seconds, None before the replica first caught up
+    with pool.connection() as connection:
+        return replication.staleness(connection)
+
+def reported_staleness():
+    # replica_staleness() for the discovery reporter thread, without a pool slot
+    with pool.background():
+        return replica_staleness()
+
+def current_load():
+    if worker_loads is not None:
+        return read_loads(worker_loads)
+    return load_tracker.snapshot()
+
+def parse_page_token(page_token):
+    # Page tokens are the id of the last record already returned
+    if not page_token:
+        return 0
+    try:
+        return int(page_token)
+    except ValueError:
+        return None
+
+def now_ms():
+    return int(time.time() * 1000)
+
+def list_records_query(request, columns, limit):
+    # The SELECT for a ListRecords page and its parameters, None if a filter
+    # or the page_token is invalid. Rows are the page's sort key (NULL when
+    # it is the id) followed by the record's columns.
+    #
+    # A filtered page is read in the order of the index its filter searches,
+    # so it never walks rows the filter skips (ordered by id, SQLite prefers
+    # walking the primary key to sorting the matches). Page tokens are the
+    # last id, followed by ":" and its sort key when that is not the id.
+    where, parameters = [], []
+    if request.name_prefix:
+        key, order = "name", "name COLLATE NOCASE"
+        where.append("name LIKE ? ESCAPE '\\'")
+        parameters.append(like_prefix(request.name_prefix))
+    elif request.HasField("updated_since"):
+        key = order = "updated_at"
+    else:
+        key = order = "id"
+    if request.HasField("updated_since"):
+        where.append("updated_at >= ?")
+        parameters.append(request.updated_since.ToMilliseconds())
+    for bound, operator in ((request.min_id, ">="), (request.max_id, "<=")):
+        if bound:
+            bound_id = parse_record_id(bound)
+            if bound_id is None:
+                return None
+            where.append(f"id {operator} ?")
+            parameters.append(bound_id)
+
+    if request.page_token:
+        after_id, separator, after_key = request.page_token.partition(":")
+        after_id = parse_record_id(after_id)
+        # A token of another order is not one of this listing's
+        if after_id is None or bool(separator) != (key != "id"):
+            return None
+        if key == "id":
+            where.append("id > ?")
+            parameters.append(after_id)
+        else:
+            if key == "updated_at":
+                after_key = parse_record_id(after_key)
+                if after_key is None:
+                    return None
+            where.append(f"({order}, id) > (?, ?)")
+            parameters.extend((after_key, after_id))
+
+    sql = f"SELECT {key if key != 'id' else 'NULL'}, {select_list(columns)} FROM records"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {order}, id LIMIT ?" if key != "id" else " ORDER BY id LIMIT ?"
+    return sql, parameters + [limit]
+
+def parse_search_token(page_token):
+    # Search page tokens are "rank:id:floor": the last result already
+    # returned and the rank_floor of the first page, so pages do not shift
+    # as records are created. Sharded, floor is every shard's, comma separated.
+    if not page_token:
+        return ()
+    try:
+        rank, record_id, floors = page_token.split(":")
+        return float(rank), int(record_id), tuple(int(floor) for floor in floors.split(","))
+    except ValueError:
+        return None
+
+# SQLite's NOCASE folds ASCII letters only
+NOCASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+def list_records_order(row):
+    # The order of list_records_query's rows, to merge those of several shards
+    key, record_id = row[0], row[1]
+    if key is None:
+        return 0, record_id
+    return key.translate(NOCASE) if isinstance(key, str) else key, record_id
+
+def parse_record_id(record_id):
+    try:
+        return int(record_id)
+    except ValueError:
+        return None
+
+def record_id_or_abort(context, record_id):
+    parsed = parse_record_id(record_id)
+    if parsed is None:
+        context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Invalid record ID {record_id!r}.")
+    return parsed
+
+# Records the history compactor picks per query
+COMPACTION_BATCH = 100
+
+# Record fields a read_mask may name, each stored in the column of that name
+RECORD_FIELDS = ("id", "name", "medical_history", "version")
+# Appended to the columns whenever medical_history is read, see record_history_entries
+PENDING_HISTORY = '''(SELECT group_concat(entry, '') FROM (
+    SELECT entry FROM record_history_entries WHERE record_id = records.id AND compacted = 0 ORDER BY id))'''
+
+def record_columns(read_mask):
+    # Columns to SELECT for a read_mask, None if it names an unknown field.
+    # id is always read, page tokens and cache keys need it.
+    paths = set(read_mask.paths)
+    if not paths:
+        return RECORD_FIELDS
+    if not paths <= set(RECORD_FIELDS):
+        return None
+    return tuple(field for field in RECORD_FIELDS if field == "id" or field in paths)
+
+def select_list(columns):
+    if "medical_history" in columns:
+        return f"{', '.join(columns)}, {PENDING_HISTORY}"
+    return ', '.join(columns)
+
+def record_from_row(columns, row):
+    values = dict(zip(columns, row))
+    values["id"] = str(values["id"])
+    if "medical_history" in values:
+        history = history_codec.decode(values["medical_history"])
+        pending = row[len(columns)]
+        values["medical_history"] = (history or '') + pending if pending else history
+    return records_pb2.Record(**values)
+
+def insert_records(connection, rows, ids=None):
+    # rows are (name, medical_history, stored medical_history), encoded
+    # beforehand so the single writer does not spend its time compressing.
+    # ids are allocated by shards.insert() when sharded, AUTOINCREMENT picks
+    # them otherwise. Returns the ids.
+    updated_at = now_ms()
+    if ids is None:
+        connection.executemany("INSERT INTO records (name, medical_history, updated_at) VALUES (?, ?, ?)",
+                               [(name, stored, updated_at) for name, _, stored in rows])
+        # AUTOINCREMENT ids of one statement in one transaction are consecutive
+        first_id = connection.execute("SELECT last_insert_rowid()").fetchone()[0] - len(rows) + 1
+        ids = range(first_id, first_id + len(rows))
+    else:
+        connection.executemany("INSERT INTO records (id, name, medical_history, updated_at) VALUES (?, ?, ?, ?)",
+                               [(record_id, name, stored, updated_at) for record_id, (name, _, stored) in zip(ids, rows)])
+    index_records(connection, [(record_id, name, history) for record_id, (name, history, _) in zip(ids, rows)])
+    return list(ids)
+
+def compact_history(connection, record_id):
+    # Fold the record's pending entries into its medical_history snapshot.
+    # Rewrites the snapshot but keeps the version, it is not a change.
+    if not connection.in_transaction:
+        # Rollback mode: no other writer may slip in between reading and marking
+        connection.execute("BEGIN IMMEDIATE")
+    entries = connection.execute(
+        "SELECT id, entry FROM record_history_entries WHERE record_id = ? AND compacted = 0 ORDER BY id",
+        (record_id,)
+    ).fetchall()
+    row = connection.execute("SELECT medical_history FROM records WHERE id = ?", (record_id,)).fetchone()
+    if not entries or row is None:
+        return 0
+    history = (history_codec.decode(row[0]) or '') + ''.join(entry for _, entry in entries)
+    connection.execute("UPDATE records SET medical_history = ? WHERE id = ?", (history_codec.encode(history), record_id))
+    connection.execute(
+        "UPDATE record_history_entries SET compacted = 1 WHERE record_id = ? AND compacted = 0 AND id <= ?",
+        (record_id, entries[-1][0])
+    )
+    return len(entries)
+
+def compact_histories(min_entries, limit=COMPACTION_BATCH):
+    # One write per record, so writers never wait on a whole pass. Returns
+    # the most records compacted on one shard.
+    compacted = 0
+    for shard_pool in shards.pools:
+        with shard_pool.background() as connection:
+            record_ids = [row[0] for row in connection.execute(
+                "SELECT record_id FROM record_history_entries INDEXED BY record_history_entries_pending WHERE compacted = 0 "
+                "GROUP BY record_id HAVING COUNT(*) >= ? LIMIT ?",
+                (min_entries, limit)
+            )]
+            for record_id in record_ids:
+                shard_pool.write(lambda connection: compact_history(connection, record_id))
+        compacted = max(compacted, len(record_ids))
+    return compacted
+
+def start_history_compactor(interval, min_entries):
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                while compact_histories(min_entries) == COMPACTION_BATCH:
+                    pass
+            except sqlite3.Error as e:
+                log.error("History compaction failed: %s", e)
+
+    threading.Thread(target=run, name="history-compactor", daemon=True).start()
+
+def store_records(rows):
+    # Returns the new records' ids, see insert_records
+    return shards.insert(rows, insert_records)
+
+def write_record(context, record_id, write):
+    # pool.write(write) on the record's shard
+    try:
+        return shards.write([record_id], write)
+    except SlotMoving as e:
+        context.abort(grpc.StatusCode.UNAVAILABLE, f"{e}, retry.")
+
+def watch_shard_changes(request, context):
+    # Every shard has its own change log, followed by a thread each. Offsets
+    # are (the shard's offset << SHARD_BITS) | shard, which cannot resume all
+    # of them: a client that reconnects gets OUT_OF_RANGE and watches from_now.
+    if not request.from_now:
+        context.abort(grpc.StatusCode.OUT_OF_RANGE, "Sharded changes cannot be resumed from an offset.")
+    changes = queue.Queue()
+
+    def follow(shard, shard_pool):
+        for offset, op, record_id, version in watch_changes(shard_pool, "record_changes", "record_id", 0, True,
+                                                            context, WATCH_POLL_INTERVAL):
+            changes.put((offset << SHARD_BITS | shard, op, record_id, version))
+
+    for shard, shard_pool in enumerate(shards.pools):
+        threading.Thread(target=follow, args=(shard, shard_pool), name=f"watch-shard-{shard}", daemon=True).start()
+    while context.is_active():
         try:
-            update_service_status(RECORDS_SERVICE_PORT)
-            update_service_heartbeat(RECORDS_SERVICE_PORT)
-            # print("Service status and heartbeat sent")
-        except Exception as e:
-            print(f"Failed to send status and heartbeat: {e}")
+            yield changes.get(timeout=WATCH_POLL_INTERVAL)
+        except queue.Empty:
+            pass
 
-        # Adjust the sleep interval (in seconds) as needed
-        time.sleep(1)
+# What Replicate sends of a record
+REPLICATED_FIELDS = ("id", "name", "medical_history", "version", "updated_at")
 
-class RecordService(records_pb2_grpc.RecordServiceServicer):
-    def CreateRecord(self, request, context):
-        increase_load()
-        connection = sqlite3.connect(DATABASE)
-        cursor = connection.cursor()
+def replicated_records(connection, record_ids):
+    rows = []
+    for chunk in batched(record_ids):
+        rows += connection.execute(
+            f"SELECT {select_list(REPLICATED_FIELDS)} FROM records WHERE id IN ({placeholders(len(chunk))})", chunk)
+    return [replicated_record(row) for row in rows]
 
-        cursor.execute(
-            "INSERT INTO records (name, medical_history) VALUES (?, ?)",
-            (request.name, request.medical_history,)
-        )
+def replicated_record(row):
+    record_id, name, history, version, updated_at, pending = row
+    return records_pb2.ReplicatedRecord(id=str(record_id), name=name or '',
+                                        medical_history=(history_codec.decode(history) or '') + (pending or ''),
+                                        version=version, updated_at=updated_at)
+
+def replication_batches(request, context):
+    # The ReplicationBatch stream of Replicate, see replication.py
+    with pool.connection() as connection:
+        first, after_offset = log_bounds(connection, "record_changes")
+    if request.snapshot:
+        # Changes from now on follow the snapshot; those it already has are
+        # skipped by their version
+        snapshot_offset, after_id = after_offset, 0
+        while context.is_active():
+            with pool.connection() as connection:
+                rows = connection.execute(
+                    f"SELECT {select_list(REPLICATED_FIELDS)} FROM records WHERE id > ? ORDER BY id LIMIT ?",
+                    (after_id, STREAM_CHUNK_SIZE)
+                ).fetchall()
+                _, head = log_bounds(connection, "record_changes")
+            done = len(rows) < STREAM_CHUNK_SIZE
+            yield records_pb2.ReplicationBatch(offset=snapshot_offset, records=[replicated_record(row) for row in rows],
+                                               snapshot=True, snapshot_done=done, head_offset=head)
+            if done:
+                break
+            after_id = rows[-1][0]
+    elif request.after_offset < first - 1:
+        context.abort(grpc.StatusCode.OUT_OF_RANGE,
+                      f"Changes after offset {request.after_offset} are no longer retained, take a snapshot.")
+    else:
+        after_offset = request.after_offset
 
-        connection.commit()
+    while context.is_active():
+        # Records are read after their changes: one changed again meanwhile
+        # is sent at its newer version, and again with that change
+        with pool.connection() as connection:
+            _, head = log_bounds(connection, "record_changes")
+            changes = connection.execute(
+                "SELECT seq, record_id FROM record_changes WHERE seq > ? ORDER BY seq LIMIT ?",
+                (after_offset, STREAM_CHUNK_SIZE)
+            ).fetchall()
+            record_ids = list({record_id for _, record_id in changes})
+            records = replicated_records(connection, record_ids)
+        found = {int(record.id) for record in records}
+        if changes:
+            after_offset = changes[-1][0]
+        yield records_pb2.ReplicationBatch(offset=after_offset, records=records,
+                                           deleted_ids=[str(record_id) for record_id in record_ids if record_id not in found],
+                                           head_offset=max(head, after_offset))
+        if len(changes) < STREAM_CHUNK_SIZE:
+            time.sleep(WATCH_POLL_INTERVAL)
 
-        record_id = cursor.lastrowid
-        cursor.close()
-        print('creating new record')
-        print(request.medical_history)
+def abort_unless_written(context, record_id, updated, version, expected_version):
+    # version is the record's version after a conditional write, None if it does not exist
+    if version is None:
+        context.abort(grpc.StatusCode.NOT_FOUND, f"Record with ID {record_id} not found.")
+    if not updated:
+        context.abort(grpc.StatusCode.ABORTED, f"Record {record_id} is at version {version}, not {expected_version}.")
+
+class RecordService(records_pb2_grpc.RecordServiceServicer):
+    def CreateRecord(self, request, context):
+        row = (request.name, request.medical_history, history_codec.encode(request.medical_history))
+        try:
+            record_id, = store_records([row])
+        except SlotMoving as e:
+            context.abort(grpc.StatusCode.UNAVAILABLE, f"{e}, retry.")
+        rpc_log.info("CreateRecord", record_id=record_id, history_length=len(request.medical_history))
         record = records_pb2.Record(
             id=str(record_id),
             name=request.name,
-            medical_history=request.medical_history
+            medical_history=request.medical_history,
+            version=1
         )
 
-        decrease_load()
         return record
 
     def GetRecordInfo(self, request, context):
-        increase_load()
-        connection = sqlite3.connect(DATABASE)
-        cursor = connection.cursor()
-        
-        cursor.execute(
-            "SELECT id, name, medical_history FROM records WHERE id = ?",
-            (int(request.record_id),)
-        )
+        record_id = record_id_or_abort(context, request.record_id)
+        columns = record_columns(request.read_mask)
+        if columns is None:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"read_mask may only name {', '.join(RECORD_FIELDS)}.")
+        record = record_cache.get(record_id)
+        # Cached records are complete, they are cut down to the mask on the way out
+        cached = record is not None
+        if record is None and request.if_none_match:
+            # Revalidation: compare versions before reading medical_history
+            with shards.pool_for(record_id).connection() as connection:
+                result = connection.execute("SELECT version FROM records WHERE id = ?", (record_id,)).fetchone()
+            if result and result[0] == request.if_none_match:
+                return records_pb2.Record(id=request.record_id, version=result[0], not_modified=True)
+        if record is None:
+            generation = record_cache.generation
+            with shards.pool_for(record_id).connection() as connection:
+                cursor = connection.cursor()
+
+                cursor.execute(
+                    f"SELECT {select_list(columns)} FROM records WHERE id = ?",
+                    (record_id,)
+                )
 
-        result = cursor.fetchone()
-        cursor.close()
+                result = cursor.fetchone()
+                cursor.close()
 
-        print(request)
+            if result:
+                with timed("build"):
+                    record = record_from_row(columns, result)
+                if columns == RECORD_FIELDS:
+                    record_cache.put(record_id, record, generation)
 
-        if result:
-            record = records_pb2.Record(
-                id=str(result[0]),
-                name=result[1],
-                medical_history=result[2]
-            )
-            time.sleep(2)
-            decrease_load()
+        rpc_log.info("GetRecordInfo", record_id=record_id, cached=cached, found=record is not None)
+
+        if record is not None:
+            if request.if_none_match and record.version == request.if_none_match:
+                return records_pb2.Record(id=record.id, version=record.version, not_modified=True)
+            if cached and columns != RECORD_FIELDS:
+                return records_pb2.Record(**{field: getattr(record, field) for field in columns})
             return record
         else:
             context.set_code(grpc.StatusCode.NOT_FOUND)
             context.set_details(f"Record with ID {request.record_id} not found.")
 
-            time.sleep(2)
-            decrease_load()
             return records_pb2.Record()
         
     def UpdateRecordInfo(self, request, context):
-        increase_load()
-        connection = sqlite3.connect(DATABASE)
-        cursor = connection.cursor()
-        print(request.record_id)
-        cursor.execute(
-            "UPDATE records SET medical_history = ? WHERE id = ?",
-            (request.updated_medical_history, int(request.record_id))
-        )
+        record_id = record_id_or_abort(context, request.record_id)
+        expected_version = request.expected_version
+
+        def update(connection):
+            # expected_version 0 updates whatever the current version is
+            updated = connection.execute(
+                "UPDATE records SET medical_history = ?, version = version + 1, updated_at = ? "
+                "WHERE id = ? AND (? = 0 OR version = ?)",
+                (history_codec.encode(request.updated_medical_history), now_ms(), record_id, expected_version, expected_version)
+            ).rowcount
+            if updated:
+                # The new history replaces the appended entries as well
+                connection.execute(
+                    "UPDATE record_history_entries SET compacted = 1 WHERE record_id = ? AND compacted = 0",
+                    (record_id,)
+                )
+                reindex_history(connection, record_id, request.updated_medical_history)
+            result = connection.execute("SELECT version FROM records WHERE id = ?", (record_id,)).fetchone()
+            return updated, result[0] if result else None
 
-        connection.commit()
-        cursor.close()
-        print(request.updated_medical_history)
+        updated, version = write_record(context, record_id, update)
+        abort_unless_written(context, request.record_id, updated, version, expected_version)
+        record_cache.invalidate([record_id])
+        rpc_log.info("UpdateRecordInfo", record_id=record_id, version=version,
+                     history_length=len(request.updated_medical_history))
         record = records_pb2.Record(
             id=request.record_id,
             name='',  # Return an empty name as it was not updated
-            medical_history=request.updated_medical_history
+            medical_history=request.updated_medical_history,
+            version=version
         )
-        decrease_load()
         return record
 
+    def AppendMedicalHistory(self, request, context):
+        record_id = record_id_or_abort(context, request.record_id)
+        expected_version = request.expected_version
+
+        def append(connection):
+            # Only the version and update time change in the record's row, the
+            # history itself is not rewritten
+            updated = connection.execute(
+                "UPDATE records SET version = version + 1, updated_at = ? WHERE id = ? AND (? = 0 OR version = ?)",
+                (now_ms(), record_id, expected_version, expected_version)
+            ).rowcount
+            result = connection.execute("SELECT version FROM records WHERE id = ?", (record_id,)).fetchone()
+            if updated:
+                connection.execute(
+                    "INSERT INTO record_history_entries (record_id, version, entry) VALUES (?, ?, ?)",
+                    (record_id, result[0], request.entry)
+                )
+            return updated, result[0] if result else None
+
+        updated, version = write_record(context, record_id, append)
+        abort_unless_written(context, request.record_id, updated, version, expected_version)
+        record_cache.invalidate([record_id])
+        return records_pb2.Record(id=request.record_id, version=version)
+
     def DeleteRecord(self, request, context):
-        increase_load()
-        connection = sqlite3.connect(DATABASE)
-        cursor = connection.cursor()
+        record_id = record_id_or_abort(context, request.record_id)
 
-        cursor.execute(
-            "DELETE FROM records WHERE id = ?",
-            (int(request.record_id),)
-        )
+        def delete(connection):
+            refresh_schema(connection)
+            connection.execute("DELETE FROM records WHERE id = ?", (record_id,))
 
-        connection.commit()
-        cursor.close()
-        decrease_load()
+        write_record(context, record_id, delete)
+        record_cache.invalidate([record_id])
         return empty_pb2.Empty()
 
     def ListRecords(self, request, context):
-        increase_load()
-        connection = sqlite3.connect(DATABASE)
-        cursor = connection.cursor()
+        page_size = request.page_size or DEFAULT_PAGE_SIZE
+        columns = record_columns(request.read_mask)
+        # Fetch one extra row to know whether there is a next page
+        query = list_records_query(request, columns, min(page_size, MAX_PAGE_SIZE) + 1) if columns else None
+        if page_size < 0 or query is None:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details("Invalid page_size, page_token, read_mask or filter.")
+            return records_pb2.ListRecordsResponse()
+        page_size = min(page_size, MAX_PAGE_SIZE)
 
-        cursor.execute("SELECT id, name, medical_history FROM records")
+        rows = shards.select(*query, key=list_records_order, limit=page_size + 1, id_column=1)
 
-        records = [records_pb2.Record(
-            id=str(row[0]),
-            name=row[1],
-            medical_history=row[2]
-        ) for row in cursor.fetchall()]
+        next_page_token = ''
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            key, record_id = rows[-1][1][0], rows[-1][1][1]
+            next_page_token = str(record_id) if key is None else f"{record_id}:{key}"
 
-        cursor.close()
-        decrease_load()
-        return records_pb2.ListRecordsResponse(records=records)
+        with timed("build"):
+            records = [record_from_row(columns, row[1:]) for owned, row in rows if owned]
+            return records_pb2.ListRecordsResponse(records=records, next_page_token=next_page_token)
+
+    def StreamRecords(self, request, context):
+        chunk_size = request.chunk_size or STREAM_CHUNK_SIZE
+        after_id = parse_page_token(request.page_token)
+        columns = record_columns(request.read_mask)
+        if chunk_size < 0 or after_id is None or columns is None:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid chunk_size, page_token or read_mask.")
+        chunk_size = min(chunk_size, MAX_PAGE_SIZE)
+
+        # Each chunk is its own short query, so no read transaction stays
+        # open while the client drains the stream and writers are not blocked.
+        while context.is_active():
+            rows = shards.select(f"SELECT {select_list(columns)} FROM records WHERE id > ? ORDER BY id LIMIT ?",
+                                 (after_id, chunk_size), key=lambda row: row[0], limit=chunk_size)
+            with timed("build"):
+                records = [record_from_row(columns, row) for owned, row in rows if owned]
+            yield from records
+            if len(rows) < chunk_size:
+                break
+            after_id = rows[-1][1][0]
     
+    def SearchRecords(self, request, context):
+        page_size = request.page_size or DEFAULT_PAGE_SIZE
+        after = parse_search_token(request.page_token)
+        columns = record_columns(request.read_mask)
+        if not request.query.strip() or page_size < 0 or after is None or columns is None:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid query, page_size, page_token or read_mask.")
+        page_size = min(page_size, MAX_PAGE_SIZE)
+
+        if after and len(after[2]) != len(shards.pools):
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid page_token.")
+
+        def search_shard(shard, shard_pool):
+            # Every shard has its own index and rank floor. Sharded, ranks
+            # are merged as they are: each shard's bm25 weighs terms by the
+            # records on that shard, which is close enough with random slots.
+            with shard_pool.connection() as connection:
+                if after:
+                    floor = after[2][shard]
+                else:
+                    floor = rank_floor(connection, request.query, SEARCH_RANK_WINDOW) if SEARCH_RANK_WINDOW else 0
+                # Fetch one extra match to know whether there is a next page
+                matches = search(connection, request.query, page_size + 1, after[:2] or None, floor)
+            return floor, [(rank, record_id, shard) for record_id, rank in matches]
+
+        try:
+            searched = shards.map(search_shard)
+        except ValueError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Invalid query: {e}")
+        floors = [floor for floor, _ in searched]
+        matches = list(heapq.merge(*[shard_matches for _, shard_matches in searched]))[:page_size + 1]
+        next_page_token = ''
+        if len(matches) > page_size:
+            matches = matches[:page_size]
+            next_page_token = f"{matches[-1][0]!r}:{matches[-1][1]}:{','.join(map(str, floors))}"
+
+        def read_shard(shard, shard_pool):
+            found = {}
+            record_ids = [record_id for _, record_id, match_shard in matches
+                          if match_shard == shard and shards.owns(shard, record_id)]
+            rows = []
+            with shard_pool.connection() as connection:
+                for chunk in batched(record_ids):
+                    rows += connection.execute(
+                        f"SELECT {select_list(columns)} FROM records WHERE id IN ({placeholders(len(chunk))})",
+                        chunk
+                    ).fetchall()
+            with timed("build"):
+                for row in rows:
+                    found[row[0]] = record_from_row(columns, row)
+            return found
+
+        found = {}
+        for shard_found in shards.map(read_shard):
+            found.update(shard_found)
+
+        # FTS5 ranks are negative, better matches lower; the score is positive, higher is better
+        with timed("build"):
+            results = [records_pb2.SearchResult(record=found[record_id], score=-rank)
+                       for rank, record_id, _ in matches if record_id in found]
+            # A floor above 0 left older matches out of the ranking
+            return records_pb2.SearchRecordsResponse(results=results, next_page_token=next_page_token,
+                                                     truncated=any(floors))
+
+    def BatchCreateRecords(self, request, context):
+        if len(request.records) > MAX_BATCH_SIZE:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(f"At most {MAX_BATCH_SIZE} records per batch.")
+            return records_pb2.BatchRecordsResponse()
+
+        rows = [(r.name, r.medical_history, history_codec.encode(r.medical_history)) for r in request.records]
+
+        try:
+            ids = store_records(rows) if rows else []
+        except SlotMoving as e:
+            context.abort(grpc.StatusCode.UNAVAILABLE, f"{e}, retry.")
+        # Sharded, a shard that failed leaves its records out
+        results = [records_pb2.BatchRecordResult(
+            record_id=str(record_id),
+            ok=True,
+            record=records_pb2.Record(id=str(record_id), name=name, medical_history=medical_history, version=1)
+        ) if record_id is not None else records_pb2.BatchRecordResult(error="Record not stored, retry")
+            for record_id, (name, medical_history, _) in zip(ids, rows)]
+
+        return records_pb2.BatchRecordsResponse(results=results)
+
+    def BatchGetRecords(self, request, context):
+        if len(request.record_ids) > MAX_BATCH_SIZE:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(f"At most {MAX_BATCH_SIZE} records per batch.")
+            return records_pb2.BatchRecordsResponse()
+
+        ids = shards.group({parse_record_id(record_id) for record_id in request.record_ids} - {None})
+        rows = []
+        for shard, shard_ids in ids.items():
+            with shards.pools[shard].connection() as connection:
+                for chunk in batched(shard_ids):
+                    rows += connection.execute(
+                        f"SELECT {select_list(RECORD_FIELDS)} FROM records WHERE id IN ({placeholders(len(chunk))})",
+                        chunk
+                    ).fetchall()
+
+        with timed("build"):
+            found = {row[0]: record_from_row(RECORD_FIELDS, row) for row in rows}
+            results = []
+            for record_id in request.record_ids:
+                record = found.get(parse_record_id(record_id))
+                if record:
+                    results.append(records_pb2.BatchRecordResult(record_id=record_id, ok=True, record=record))
+                else:
+                    results.append(records_pb2.BatchRecordResult(record_id=record_id, error="Record not found"))
+            return records_pb2.BatchRecordsResponse(results=results)
+
+    def BatchDeleteRecords(self, request, context):
+        if len(request.record_ids) > MAX_BATCH_SIZE:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(f"At most {MAX_BATCH_SIZE} records per batch.")
+            return records_pb2.BatchRecordsResponse()
+
+        ids = shards.group({parse_record_id(record_id) for record_id in request.record_ids} - {None})
+
+        def delete(shard_ids):
+            def write(connection):
+                deleted = set()
+                for chunk in batched(shard_ids):
+                    in_clause = placeholders(len(chunk))
+                    deleted.update(row[0] for row in connection.execute(
+                        f"SELECT id FROM records WHERE id IN ({in_clause})", chunk))
+                    connection.execute(f"DELETE FROM records WHERE id IN ({in_clause})", chunk)
+                return deleted
+            return write
+
+        deleted, moving = set(), set()
+        for shard_ids in ids.values():
+            try:
+                deleted |= shards.write(shard_ids, delete(shard_ids))
+            except SlotMoving:
+                moving.update(shard_ids)
+        record_cache.invalidate(deleted)
+        results = []
+        for record_id in request.record_ids:
+            if parse_record_id(record_id) in deleted:
+                results.append(records_pb2.BatchRecordResult(record_id=record_id, ok=True))
+            elif parse_record_id(record_id) in moving:
+                results.append(records_pb2.BatchRecordResult(record_id=record_id, error="Record is moving to another shard, retry"))
+            else:
+                results.append(records_pb2.BatchRecordResult(record_id=record_id, error="Record not found"))
+
+        return records_pb2.BatchRecordsResponse(results=results)
+
+    def ImportRecords(self, request_iterator, context):
+        start = time.perf_counter()
+        imported = 0
+        failed = 0
+        chunk = []
+
+        def commit(rows):
+            try:
+                ids = store_records(rows)
+            except (sqlite3.Error, SlotMoving):
+                ids = [None] * len(rows)
+            # Retry row by row so one bad row does not drop the whole chunk
+            # (sharded, only the rows of the shard it is on)
+            stored = len(rows) - ids.count(None)
+            for row, record_id in zip(rows, ids):
+                if record_id is not None:
+                    continue
+                try:
+                    store_records([row])
+                    stored += 1
+                except (sqlite3.Error, SlotMoving):
+                    pass
+            IMPORTED_RECORDS.inc(stored)
+            IMPORT_FAILURES.inc(len(rows) - stored)
+            return stored, len(rows) - stored
+
+        try:
+            for request in request_iterator:
+                chunk.append((request.name, request.medical_history, history_codec.encode(request.medical_history)))
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    stored, lost = commit(chunk)
+                    imported, failed = imported + stored, failed + lost
+                    chunk = []
+            if chunk:
+                stored, lost = commit(chunk)
+                imported, failed = imported + stored, failed + lost
+        finally:
+            elapsed = time.perf_counter() - start
+            rows_per_second = imported / elapsed if elapsed else 0.0
+            IMPORT_ROWS_PER_SECOND.set(rows_per_second)
+
+        return records_pb2.ImportSummary(imported=imported, failed=failed, rows_per_second=rows_per_second)
+
+    def WatchChanges(self, request, context):
+        with watcher_slots.hold(context):
+            if shards.sharded:
+                changes = watch_shard_changes(request, context)
+            else:
+                changes = watch_changes(pool, "record_changes", "record_id", request.after_offset, request.from_now,
+                                        context, WATCH_POLL_INTERVAL)
+            for offset, op, record_id, version in changes:
+                yield records_pb2.Change(offset=offset, op=op, record_id=str(record_id), version=version)
+
+    def Replicate(self, request, context):
+        if shards.sharded:
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION, "Sharded records cannot be replicated.")
+        with watcher_slots.hold(context):
+            yield from replication_batches(request, context)
+
     def GetServiceStatus(self, request, context):
-        # increase_load()
         return records_pb2.ServiceStatus(is_healthy=True)
 
 
-def serve(RECORDS_SERVICE_PORT):
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), interceptors=(PromServerInterceptor(),))
+def create_server(RECORDS_SERVICE_PORT):
+    interceptors = [LoadTrackingInterceptor(load_tracker), PromServerInterceptor()]
+    tracing = tracing_from_env()
+    if tracing:
+        # Outermost, so the call's span covers the other interceptors
+        interceptors.insert(0, tracing)
+    stage_metrics = stage_metrics_from_env()
+    if stage_metrics:
+        interceptors.append(stage_metrics)
+    fault_injector = fault_injection_from_env()
+    if fault_injector:
+        interceptors.append(fault_injector)
+    response_compression = response_compression_from_env()
+    if response_compression:
+        interceptors.append(response_compression)
+    if RECORDS_PRIMARY:
+        interceptors.append(ReplicaInterceptor(replica_staleness, MAX_REPLICA_STALENESS))
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=MAX_WORKERS + MAX_WATCHERS),
+        interceptors=interceptors,
+        options=[("grpc.so_reuseport", 1)]
+    )
     records_pb2_grpc.add_RecordServiceServicer_to_server(RecordService(), server)
     server.add_insecure_port(f'[::]:{RECORDS_SERVICE_PORT}')
+    return server
+
+def stop_on_sigterm(server, on_shutdown=None):
+    # Leave discovery first so the gateway stops routing here, then let
+    # in-flight calls finish
+    def stop(signum, frame):
+        if on_shutdown:
+            on_shutdown()
+        server.stop(SHUTDOWN_GRACE)
+
+    signal.signal(signal.SIGTERM, stop)
+
+def serve(RECORDS_SERVICE_PORT, on_shutdown=None):
+    server = create_server(RECORDS_SERVICE_PORT)
     server.start()
-    print(f"Server started on port {RECORDS_SERVICE_PORT}")
+    stop_on_sigterm(server, on_shutdown)
+    log.info("Server started on port %s", RECORDS_SERVICE_PORT)
     start_http_server(PROMETHEUS_PORT, SERVICE_HOSTNAME)
-    print(f"Prometheus started on port {PROMETHEUS_PORT}, hostname {SERVICE_HOSTNAME}")
-    server.wait_for_termination()
+    log.info("Prometheus started on port %s, hostname %s", PROMETHEUS_PORT, SERVICE_HOSTNAME)
+    try:
+        server.wait_for_termination()
+    finally:
+        shards.close()
+
+def serve_worker(RECORDS_SERVICE_PORT, shared_worker_loads, index):
+    # Runs in a spawned worker process: no registration, heartbeat or /metrics
+    # server of its own, the parent does those for all workers.
+    publish_load(shared_worker_loads, index, load_tracker.snapshot)
+    server = create_server(RECORDS_SERVICE_PORT)
+    server.start()
+    stop_on_sigterm(server)
+    log.info("Worker %s (pid %s) serving on port %s", index, os.getpid(), RECORDS_SERVICE_PORT)
+    try:
+        server.wait_for_termination()
+    finally:
+        shards.close()
+
+def serve_prefork(RECORDS_SERVICE_PORT, processes, on_shutdown=None):
+    global worker_loads
+    prepare_multiprocess_metrics()
+    worker_loads = shared_loads(processes)
+    start_multiprocess_metrics_server(PROMETHEUS_PORT, SERVICE_HOSTNAME)
+    log.info("Prometheus started on port %s, hostname %s", PROMETHEUS_PORT, SERVICE_HOSTNAME)
+    run_workers(serve_worker, processes, RECORDS_SERVICE_PORT, worker_loads, on_shutdown)
+
+async def serve_aio(RECORDS_SERVICE_PORT, on_shutdown=None, discovery=None):
+    # discovery: a DiscoveryClient to report status from this event loop
+    executor = futures.ThreadPoolExecutor(max_workers=MAX_WORKERS + MAX_WATCHERS)
+    interceptors = [PromAioServerInterceptor()]
+    fault_injector = fault_injection_from_env(aio=True)
+    if fault_injector:
+        interceptors.append(fault_injector)
+    server = grpc.aio.server(interceptors=interceptors)
+    sync_interceptors = [LoadTrackingInterceptor(load_tracker)]
+    tracing = tracing_from_env()
+    if tracing:
+        sync_interceptors.insert(0, tracing)
+    stage_metrics = stage_metrics_from_env()
+    if stage_metrics:
+        sync_interceptors.append(stage_metrics)
+    response_compression = response_compression_from_env()
+    if response_compression:
+        sync_interceptors.append(response_compression)
+    if RECORDS_PRIMARY:
+        sync_interceptors.append(ReplicaInterceptor(replica_staleness, MAX_REPLICA_STALENESS))
+    server.add_generic_rpc_handlers((AsyncServicerAdapter(records_pb2_grpc.add_RecordServiceServicer_to_server, RecordService(), executor, sync_interceptors),))
+    server.add_insecure_port(f'[::]:{RECORDS_SERVICE_PORT}')
+    await server.start()
+    log.info("Server (aio) started on port %s", RECORDS_SERVICE_PORT)
+    start_http_server(PROMETHEUS_PORT, SERVICE_HOSTNAME)
+    log.info("Prometheus started on port %s, hostname %s", PROMETHEUS_PORT, SERVICE_HOSTNAME)
+
+    loop = asyncio.get_running_loop()
+    reporting = asyncio.ensure_future(discovery.run_async(current_load)) if discovery else None
+
+    async def stop():
+        if reporting:
+            # A late status report would mark us alive again
+            reporting.cancel()
+        if on_shutdown:
+            await loop.run_in_executor(None, on_shutdown)
+        await server.stop(SHUTDOWN_GRACE)
+
+    loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(stop()))
+    try:
+        await server.wait_for_termination()
+    finally:
+        if reporting:
+            reporting.cancel()
+        executor.shutdown()
+        shards.close()
 
 if __name__ == '__main__':
     # RECORDS_SERVICE_PORT = int(sys.argv[1])
     # RECORDS_SERVICE_PORT = 50051
-    register_service(RECORDS_SERVICE_PORT)
-    status_heartbeat_thread = threading.Thread(target=update_service_status_and_heartbeat_periodically, args=(RECORDS_SERVICE_PORT,))
-    status_heartbeat_thread.daemon = True
-    status_heartbeat_thread.start()
-    
-    serve(RECORDS_SERVICE_PORT)
-    
\ No newline at end of file
+    if sys.argv[1:] == ["migrate"]:
+        # Pre-deploy: importing applied the plain migrations, finish the online ones
+        for shard_pool in shards.pools:
+            run_online_migrations(shard_pool, MIGRATIONS)
+        sys.exit()
+    discovery = DiscoveryClient(SERVICE_DISCOVERY_URL, SERVICE_NAME, SERVICE_HOSTNAME, RECORDS_SERVICE_PORT,
+                                read_only=bool(RECORDS_PRIMARY), staleness=reported_staleness if RECORDS_PRIMARY else None)
+    discovery.register()
+    if SERVER_MODE != "aio" or SERVER_PROCESSES > 1:
+        # serve_aio reports from its event loop
+        discovery.start(current_load)
+    if RECORDS_PRIMARY:
+        Replica(pool, RECORDS_PRIMARY, history_codec.encode, record_cache.invalidate).start()
+        log.info("Read replica of %s", RECORDS_PRIMARY)
+    for shard_pool in shards.pools:
+        start_online_migrations(shard_pool, MIGRATIONS, MIGRATION_PAUSE)
+    if shards.sharded:
+        shards.start_refresher(SHARD_MAP_REFRESH)
+    if HISTORY_COMPACT_INTERVAL > 0:
+        start_history_compactor(HISTORY_COMPACT_INTERVAL, HISTORY_COMPACT_ENTRIES)
+    try:
+        if SERVER_PROCESSES > 1:
+            serve_prefork(RECORDS_SERVICE_PORT, SERVER_PROCESSES, discovery.deregister)
+        elif SERVER_MODE == "aio":
+            asyncio.run(serve_aio(RECORDS_SERVICE_PORT, discovery.deregister, discovery))
+        else:
+            serve(RECORDS_SERVICE_PORT, discovery.deregister)
+    finally:
+        discovery.deregister()
+        discovery.close()
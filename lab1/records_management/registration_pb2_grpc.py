@@ -40,6 +40,11 @@ class RegistrationServiceStub(object):
                 request_serializer=google_dot_protobuf_dot_empty__pb2.Empty.SerializeToString,
                 response_deserializer=registration__pb2.ServicesList.FromString,
                 )
+        self.GetServiceDiscoveryStatus = channel.unary_unary(
+                '/registration.RegistrationService/GetServiceDiscoveryStatus',
+                request_serializer=google_dot_protobuf_dot_empty__pb2.Empty.SerializeToString,
+                response_deserializer=registration__pb2.ServiceDiscoveryStatus.FromString,
+                )
 
 
 class RegistrationServiceServicer(object):
@@ -75,6 +80,12 @@ class RegistrationServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def GetServiceDiscoveryStatus(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_RegistrationServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -103,6 +114,11 @@ def add_RegistrationServiceServicer_to_server(servicer, server):
                     request_deserializer=google_dot_protobuf_dot_empty__pb2.Empty.FromString,
                     response_serializer=registration__pb2.ServicesList.SerializeToString,
             ),
+            'GetServiceDiscoveryStatus': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetServiceDiscoveryStatus,
+                    request_deserializer=google_dot_protobuf_dot_empty__pb2.Empty.FromString,
+                    response_serializer=registration__pb2.ServiceDiscoveryStatus.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'registration.RegistrationService', rpc_method_handlers)
@@ -197,3 +213,20 @@ class RegistrationService(object):
             registration__pb2.ServicesList.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def GetServiceDiscoveryStatus(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/registration.RegistrationService/GetServiceDiscoveryStatus',
+            google_dot_protobuf_dot_empty__pb2.Empty.SerializeToString,
+            registration__pb2.ServiceDiscoveryStatus.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
@@ -0,0 +1,214 @@
+import logging
+import sqlite3
+import threading
+import time
+
+import grpc
+import records_pb2
+import records_pb2_grpc
+
+from db_pool import batched, placeholders
+from search_index import index_records, refresh_schema
+
+# Read replicas of the records service. A replica (RECORDS_PRIMARY set) has a
+# database of its own, kept up to date by following the primary's change log
+# with the Replicate RPC:
+#
+#   - a new replica, or one whose offset the primary no longer retains, first
+#     gets a snapshot of every record, then the changes since it started
+#   - a batch of changes holds the changed records as they are when the
+#     primary reads it, and the deleted ids. Replicas apply it in one
+#     transaction with the offset it brings them to, upserting only records
+#     newer than their copy, so a batch can be applied twice.
+#   - between changes the primary sends empty batches as heartbeats
+#
+# Applied changes go through the replica's own change log, so WatchChanges on
+# a replica tells when it has caught up with a write.
+#
+# Replicas reject writes and refuse reads (UNAVAILABLE) once their data may
+# be more than MAX_REPLICA_STALENESS seconds behind the primary: the time
+# since they last applied everything the primary had logged. That includes
+# the primary being unreachable. They report it to discovery, and the gateway
+# sends reads only to replicas within its own bound.
+
+log = logging.getLogger(__name__)
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS replication_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        primary_offset INTEGER,
+        caught_up_at REAL
+    )
+'''
+
+WRITE_METHODS = {"CreateRecord", "UpdateRecordInfo", "AppendMedicalHistory", "DeleteRecord", "BatchCreateRecords",
+                 "BatchDeleteRecords", "ImportRecords"}
+READ_METHODS = {"GetRecordInfo", "ListRecords", "StreamRecords", "SearchRecords", "BatchGetRecords"}
+
+
+def create_replication_state(connection):
+    connection.execute(SCHEMA)
+
+
+def load_state(connection):
+    """The primary's offset applied, None until a snapshot completes, and the time the replica last caught up."""
+    row = connection.execute("SELECT primary_offset, caught_up_at FROM replication_state").fetchone()
+    return row if row else (None, None)
+
+
+def staleness(connection):
+    """Seconds the replica's data may be behind the primary, None before it first caught up."""
+    _, caught_up_at = load_state(connection)
+    return max(0.0, time.time() - caught_up_at) if caught_up_at else None
+
+
+def apply_batch(connection, batch, encode, snapshot_after=0, received_at=None):
+    """Apply a ReplicationBatch in the caller's write, returns the id the next snapshot batch starts after.
+
+    encode turns a history into its stored form (HistoryCodec.encode).
+    """
+    if not connection.in_transaction:
+        # Rollback mode: nothing may change between reading versions and writing
+        connection.execute("BEGIN IMMEDIATE")
+    records = {int(record.id): record for record in batch.records}
+    versions = {}
+    for chunk in batched(list(records)):
+        versions.update(connection.execute(
+            f"SELECT id, version FROM records WHERE id IN ({placeholders(len(chunk))})", chunk))
+    created = [record for record_id, record in records.items() if record_id not in versions]
+    # A snapshot replaces whatever the replica had
+    changed = [record for record_id, record in records.items() if record_id in versions and (
+        record.version > versions[record_id] or batch.snapshot and record.version != versions[record_id])]
+
+    connection.executemany(
+        "INSERT INTO records (id, name, medical_history, version, updated_at) VALUES (?, ?, ?, ?, ?)",
+        [(int(r.id), r.name, encode(r.medical_history), r.version, r.updated_at) for r in created])
+    connection.executemany(
+        "UPDATE records SET name = ?, medical_history = ?, version = ?, updated_at = ? WHERE id = ?",
+        [(r.name, encode(r.medical_history), r.version, r.updated_at, int(r.id)) for r in changed])
+    index_records(connection, [(int(r.id), r.name, r.medical_history) for r in created])
+    connection.executemany("UPDATE records_search SET name = ?, medical_history = ? WHERE rowid = ?",
+                           [(r.name, r.medical_history, int(r.id)) for r in changed])
+
+    deleted = [int(record_id) for record_id in batch.deleted_ids]
+    last_id = max(records, default=snapshot_after)
+    refresh_schema(connection)
+    for chunk in batched(deleted):
+        connection.execute(f"DELETE FROM records WHERE id IN ({placeholders(len(chunk))})", chunk)
+    if batch.snapshot:
+        # Records the primary no longer has
+        upper = "" if batch.snapshot_done else " AND id <= ?"
+        connection.execute(
+            f"DELETE FROM records WHERE id > ?{upper} AND id NOT IN (SELECT value FROM json_each(?))",
+            (snapshot_after,) + (() if batch.snapshot_done else (last_id,)) + (f"[{','.join(map(str, records))}]",))
+
+    if not batch.snapshot or batch.snapshot_done:
+        caught_up = batch.offset >= batch.head_offset
+        connection.execute(
+            "INSERT INTO replication_state (id, primary_offset, caught_up_at) VALUES (1, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET primary_offset = excluded.primary_offset, "
+            "caught_up_at = coalesce(excluded.caught_up_at, caught_up_at)",
+            (batch.offset, (received_at or time.time()) if caught_up else None))
+    return last_id
+
+
+class Replica:
+    """Follows the primary at `primary_url` from a daemon thread, applying its changes to `pool`.
+
+    on_applied(ids) is called with the ids of the records each batch changed
+    or deleted, after it commits.
+    """
+
+    def __init__(self, pool, primary_url, encode, on_applied=None, retry_interval=1.0):
+        self.pool = pool
+        self.primary_url = primary_url
+        self.encode = encode
+        self.on_applied = on_applied
+        self.retry_interval = retry_interval
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def follow(self, stub):
+        """Apply the primary's batches until the stream ends, one Replicate call."""
+        with self.pool.connection() as connection:
+            offset, _ = load_state(connection)
+        snapshot_after = 0
+        try:
+            for batch in stub.Replicate(records_pb2.ReplicateRequest(after_offset=offset or 0,
+                                                                     snapshot=offset is None)):
+                received_at = time.time()
+                snapshot_after = self.pool.write(
+                    lambda connection: apply_batch(connection, batch, self.encode, snapshot_after, received_at))
+                if self.on_applied and (batch.records or batch.deleted_ids):
+                    self.on_applied([int(r.id) for r in batch.records] + [int(i) for i in batch.deleted_ids])
+                if self._stopping.is_set():
+                    return
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.OUT_OF_RANGE:
+                raise
+            log.warning("Changes since the replica's offset are gone from the primary, taking a snapshot")
+            self.pool.write(lambda connection: connection.execute(
+                "UPDATE replication_state SET primary_offset = NULL"))
+
+    def start(self):
+        def run():
+            with grpc.insecure_channel(self.primary_url) as channel:
+                stub = records_pb2_grpc.RecordServiceStub(channel)
+                while not self._stopping.is_set():
+                    try:
+                        with self.pool.background():
+                            self.follow(stub)
+                    except grpc.RpcError as e:
+                        log.warning("Replication from %s stopped: %s", self.primary_url, e.code())
+                    except sqlite3.Error as e:
+                        log.error("Replication from %s failed: %s", self.primary_url, e)
+                    self._stopping.wait(self.retry_interval)
+
+        self._thread = threading.Thread(target=run, name="replica", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+
+class ReplicaInterceptor(grpc.ServerInterceptor):
+    """Rejects writes, and reads while staleness() is above max_staleness seconds (or None).
+
+    staleness() is checked at most every `refresh` seconds.
+    """
+
+    def __init__(self, staleness, max_staleness, refresh=0.1):
+        self.staleness = staleness
+        self.max_staleness = max_staleness
+        self.refresh = refresh
+        self._checked_at = 0.0
+        self._staleness = None
+
+    def _check(self, method, context):
+        if method in WRITE_METHODS:
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION, "This is a read replica, write to the primary.")
+        now = time.monotonic()
+        if now - self._checked_at > self.refresh:
+            self._staleness, self._checked_at = self.staleness(), now
+        if self._staleness is None or self._staleness > self.max_staleness:
+            behind = "not caught up yet" if self._staleness is None else f"{self._staleness:.1f}s behind"
+            context.abort(grpc.StatusCode.UNAVAILABLE, f"Read replica {behind} the primary, retry elsewhere.")
+
+    def _wrap(self, method, behavior):
+        def checked(request_or_iterator, context):
+            self._check(method, context)
+            return behavior(request_or_iterator, context)
+        return checked
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        # handler_call_details.method looks like "/records.RecordService/GetRecordInfo"
+        method = handler_call_details.method.rsplit("/", 1)[-1]
+        if handler is None or method not in WRITE_METHODS | READ_METHODS:
+            return handler
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=self._wrap(method, handler.unary_unary))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=self._wrap(method, handler.unary_stream))
+        return handler._replace(stream_unary=self._wrap(method, handler.stream_unary))
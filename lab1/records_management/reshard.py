@@ -0,0 +1,218 @@
+"""Move records between the shards of the records service, online.
+
+Records live on the shard their slot is assigned to, see shards.py. Moving
+slots to another shard while the services keep serving them:
+
+  1. their records are copied to the new shard in batches, without locking
+  2. they are frozen on the old shard: writes to them fail with UNAVAILABLE
+     and are retried by the clients
+  3. the records written since step 1 are copied again
+  4. the slot map assigns them to the new shard, the services pick that up
+     within SHARD_MAP_REFRESH seconds and read and write them there
+  5. --settle seconds later the old shard's copies are deleted, the slots
+     stay frozen there
+
+Writes wait only for steps 2-4, which copy what was written meanwhile.
+
+    python reshard.py status
+    python reshard.py move --slots 0-127 --to 2
+    python reshard.py rebalance
+
+rebalance moves every slot to its shard on the consistent hash ring of all
+the RECORDS_SHARDS: after a shard was appended to the list (and the services
+restarted with it), or to spread a database that predates sharding. It
+moves --group slots at a time.
+"""
+import argparse
+import collections
+import os
+import sqlite3
+import time
+
+from db_pool import batched, placeholders
+from history_codec import HistoryCodec, load_dictionaries
+from search_index import index_records, refresh_schema
+from shards import SLOTS, load_frozen, load_owners, ring_owners
+
+SLOT = f"id & {SLOTS - 1}"
+
+
+def write(connection, statements):
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        for sql, parameters in statements:
+            connection.execute(sql, parameters)
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+
+
+def slot_ids(connection, slot, batch_size):
+    """Yield the ids of a slot's records in batches, read without a lock."""
+    after_id = -1
+    while True:
+        rows = connection.execute(
+            f"SELECT id FROM records WHERE {SLOT} = ? AND id > ? ORDER BY id LIMIT ?", (slot, after_id, batch_size)
+        ).fetchall()
+        if not rows:
+            return
+        yield [row[0] for row in rows]
+        after_id = rows[-1][0]
+
+
+def copy_records(source, target, record_ids, decode):
+    """Replace the target's copies of the records with the source's, or delete them where the source has none."""
+    in_clause = placeholders(len(record_ids))
+    # One read transaction, so the entries go with the records
+    source.execute("BEGIN")
+    try:
+        rows = source.execute(
+            f"SELECT id, name, medical_history, version, updated_at FROM records WHERE id IN ({in_clause})", record_ids
+        ).fetchall()
+        entries = source.execute(
+            f"SELECT record_id, version, entry, compacted FROM record_history_entries WHERE record_id IN ({in_clause}) "
+            "ORDER BY id", record_ids
+        ).fetchall()
+    finally:
+        source.commit()
+    pending = collections.defaultdict(str)
+    for record_id, _, entry, compacted in entries:
+        if not compacted:
+            pending[record_id] += entry
+
+    target.execute("BEGIN IMMEDIATE")
+    try:
+        refresh_schema(target)
+        # The delete triggers take the history entries and search rows along
+        target.execute(f"DELETE FROM records WHERE id IN ({in_clause})", record_ids)
+        target.executemany(
+            "INSERT INTO records (id, name, medical_history, version, updated_at) VALUES (?, ?, ?, ?, ?)", rows)
+        target.executemany(
+            "INSERT INTO record_history_entries (record_id, version, entry, compacted) VALUES (?, ?, ?, ?)", entries)
+        index_records(target, [
+            (record_id, name, (decode(history) or '') + pending[record_id] if record_id in pending else decode(history))
+            for record_id, name, history, _, _ in rows
+        ])
+        target.commit()
+    except BaseException:
+        target.rollback()
+        raise
+    return len(rows)
+
+
+def changed_ids(source, target, slot):
+    # Records of the slot the target has at another version or not at all,
+    # and the target's copies of records deleted since
+    versions = dict(source.execute(f"SELECT id, version FROM records WHERE {SLOT} = ?", (slot,)))
+    copies = dict(target.execute(f"SELECT id, version FROM records WHERE {SLOT} = ?", (slot,)))
+    return [record_id for record_id, version in versions.items() if copies.get(record_id) != version] + \
+        [record_id for record_id in copies if record_id not in versions]
+
+
+def move_slots(connections, slots, target, decode, batch_size=500, settle=5.0):
+    """Move slots to the target shard, see the module docstring. Returns the records moved."""
+    owners = load_owners(connections[0])
+    by_source = collections.defaultdict(list)
+    for slot in slots:
+        if owners[slot] != target:
+            by_source[owners[slot]].append(slot)
+    moved = 0
+    for source, source_slots in by_source.items():
+        source_db, target_db = connections[source], connections[target]
+        for slot in source_slots:
+            for record_ids in slot_ids(source_db, slot, batch_size):
+                copy_records(source_db, target_db, record_ids, decode)
+
+        write(source_db, [("INSERT OR IGNORE INTO frozen_slots (slot) VALUES (?)", (slot,)) for slot in source_slots])
+        try:
+            for slot in source_slots:
+                for record_ids in batched(changed_ids(source_db, target_db, slot), batch_size):
+                    copy_records(source_db, target_db, record_ids, decode)
+            write(target_db, [("DELETE FROM frozen_slots WHERE slot = ?", (slot,)) for slot in source_slots])
+            write(connections[0], [("UPDATE shard_slots SET shard = ? WHERE slot = ?", (target, slot))
+                                   for slot in source_slots])
+        except BaseException:
+            # The slots stay where they were
+            write(source_db, [("DELETE FROM frozen_slots WHERE slot = ?", (slot,)) for slot in source_slots])
+            raise
+
+        # Services still on the old slot map read the old copies meanwhile
+        time.sleep(settle)
+        for slot in source_slots:
+            for record_ids in slot_ids(source_db, slot, batch_size):
+                refresh_schema(source_db)
+                write(source_db, [(f"DELETE FROM records WHERE id IN ({placeholders(len(record_ids))})", record_ids)])
+                moved += len(record_ids)
+    return moved
+
+
+def parse_slots(text):
+    slots = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        slots.extend(range(int(first), int(last or first) + 1))
+    if not all(0 <= slot < SLOTS for slot in slots):
+        raise argparse.ArgumentTypeError(f"Slots are 0-{SLOTS - 1}")
+    return slots
+
+
+def status(connections):
+    owners = load_owners(connections[0])
+    for shard, connection in enumerate(connections):
+        owned = sum(1 for owner in owners if owner == shard)
+        moving = sum(1 for slot in load_frozen(connection) if owners[slot] == shard)
+        records = connection.execute("SELECT count(*) FROM records").fetchone()[0]
+        print(f"shard {shard}: {owned} slots, {records} records" + (f", {moving} slots moving" if moving else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", default=os.getenv("RECORDS_SHARDS", ""),
+                        help="the shard databases in shard order, comma separated")
+    parser.add_argument("--batch-size", type=int, default=500, help="records copied per transaction")
+    parser.add_argument("--settle", type=float, default=5.0,
+                        help="seconds between changing the slot map and deleting the old copies, "
+                             "more than the services' SHARD_MAP_REFRESH")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status")
+    move = commands.add_parser("move")
+    move.add_argument("--slots", type=parse_slots, required=True, help="slots to move, such as 0-127,512")
+    move.add_argument("--to", type=int, required=True, help="shard to move them to")
+    rebalance = commands.add_parser("rebalance")
+    rebalance.add_argument("--group", type=int, default=16, help="slots moved at a time")
+    args = parser.parse_args()
+
+    databases = [path.strip() for path in args.shards.split(",") if path.strip()]
+    if not databases:
+        parser.error("no shards, set RECORDS_SHARDS or --shards")
+    connections = [sqlite3.connect(database, timeout=30) for database in databases]
+    if load_owners(connections[0]) is None:
+        parser.error("no slot map yet, start the service with RECORDS_SHARDS first")
+    codec = HistoryCodec(dictionaries=load_dictionaries(connections[0]),
+                         load_dictionary=lambda dictionary_id: load_dictionaries(connections[0]).get(dictionary_id))
+
+    if args.command == "move":
+        if not 0 <= args.to < len(connections):
+            parser.error(f"--to must be a shard from 0 to {len(connections) - 1}")
+        start = time.perf_counter()
+        moved = move_slots(connections, args.slots, args.to, codec.decode, args.batch_size, args.settle)
+        print(f"Moved {moved} records to shard {args.to} in {time.perf_counter() - start:.1f}s")
+    elif args.command == "rebalance":
+        owners, ring = load_owners(connections[0]), ring_owners(len(connections))
+        moves = collections.defaultdict(list)
+        for slot in range(SLOTS):
+            if owners[slot] != ring[slot]:
+                moves[ring[slot]].append(slot)
+        for target, slots in sorted(moves.items()):
+            for first in range(0, len(slots), args.group):
+                group = slots[first:first + args.group]
+                moved = move_slots(connections, group, target, codec.decode, args.batch_size, args.settle)
+                print(f"Moved {len(group)} slots ({moved} records) to shard {target}")
+    status(connections)
+    for connection in connections:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
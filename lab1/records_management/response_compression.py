@@ -0,0 +1,63 @@
+import os
+
+import grpc
+
+# gRPC message compression for responses, off unless GRPC_COMPRESSION is set:
+#
+#   GRPC_COMPRESSION=gzip              (or deflate)
+#   GRPC_COMPRESSION_THRESHOLD=1024
+#
+# Only messages of at least GRPC_COMPRESSION_THRESHOLD serialized bytes are
+# compressed, below that the CPU is not worth the few bytes saved. Clients
+# compress their own requests per channel or call, e.g.
+# grpc.insecure_channel(..., compression=grpc.Compression.Gzip).
+
+ALGORITHMS = {"gzip": grpc.Compression.Gzip, "deflate": grpc.Compression.Deflate}
+
+
+class ResponseCompressionInterceptor(grpc.ServerInterceptor):
+    """Compresses the responses of at least `threshold` bytes with `algorithm`."""
+
+    def __init__(self, algorithm=grpc.Compression.Gzip, threshold=1024):
+        self.algorithm = algorithm
+        self.threshold = threshold
+
+    def _wrap(self, behavior):
+        def compressed(request_or_iterator, context):
+            response = behavior(request_or_iterator, context)
+            if response is not None and response.ByteSize() >= self.threshold:
+                context.set_compression(self.algorithm)
+            return response
+        return compressed
+
+    def _wrap_stream(self, behavior):
+        def compressed(request_or_iterator, context):
+            # The algorithm is chosen once per call, small messages opt out one by one
+            context.set_compression(self.algorithm)
+            for response in behavior(request_or_iterator, context):
+                if response.ByteSize() < self.threshold:
+                    context.disable_next_message_compression()
+                yield response
+        return compressed
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=self._wrap(handler.unary_unary))
+        if handler.stream_unary:
+            return handler._replace(stream_unary=self._wrap(handler.stream_unary))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=self._wrap_stream(handler.unary_stream))
+        return handler._replace(stream_stream=self._wrap_stream(handler.stream_stream))
+
+
+def response_compression_from_env():
+    algorithm = os.getenv("GRPC_COMPRESSION", "").lower()
+    if not algorithm or algorithm == "none":
+        return None
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"GRPC_COMPRESSION must be one of none, {', '.join(ALGORITHMS)}")
+    return ResponseCompressionInterceptor(ALGORITHMS[algorithm], int(os.getenv("GRPC_COMPRESSION_THRESHOLD", 1024)))
@@ -0,0 +1,130 @@
+import sqlite3
+
+from migrations import execute_statements
+
+# FTS5 index over records.name and the full medical_history, for
+# SearchRecords. Every record has one row (rowid = record id) with its name
+# and history, written by the service in the same transaction as the record
+# since the stored history may be compressed. Appended history entries are
+# added to the row by a trigger, so a query matches terms across the snapshot
+# and the entries and compaction has nothing to reindex. Deletes are a
+# trigger as well. Records that predate the index are added in the
+# background by an online migration, searches miss them until it finishes.
+
+SCHEMA = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS records_search USING fts5(
+        name, medical_history,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    );
+    CREATE TRIGGER IF NOT EXISTS records_search_delete AFTER DELETE ON records
+    BEGIN
+        DELETE FROM records_search WHERE rowid = OLD.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS record_history_entries_search_insert AFTER INSERT ON record_history_entries
+    WHEN NEW.compacted = 0
+    BEGIN
+        UPDATE records_search SET medical_history = coalesce(medical_history, '') || NEW.entry
+        WHERE rowid = NEW.record_id;
+    END;
+'''
+
+BACKFILL_BATCH_SIZE = 500
+
+
+def create_search_index(connection):
+    """Create the index and its triggers, empty: existing records are added by backfill_search_index()."""
+    execute_statements(connection, SCHEMA)
+
+
+def backfill_search_index(connection, after_id, decode, batch_size=BACKFILL_BATCH_SIZE):
+    """Index the records after `after_id`, returns the last id indexed or None past the last record.
+
+    Safe to run while the service writes: a record created meanwhile indexes
+    itself and is replaced with the same row here, one changed or deleted
+    before its batch is read as it is now. `decode` turns a stored
+    medical_history into text (HistoryCodec.decode).
+    """
+    if not connection.in_transaction:
+        # Rollback mode: the batch must not change between reading and indexing it
+        connection.execute("BEGIN IMMEDIATE")
+    rows = connection.execute(
+        "SELECT id, name, medical_history FROM records WHERE id > ? ORDER BY id LIMIT ?",
+        (after_id, batch_size)
+    ).fetchall()
+    if not rows:
+        return None
+    pending = dict(connection.execute(
+        "SELECT record_id, group_concat(entry, '') FROM (SELECT record_id, entry FROM record_history_entries "
+        "WHERE record_id BETWEEN ? AND ? AND compacted = 0 ORDER BY id) GROUP BY record_id",
+        (rows[0][0], rows[-1][0])
+    ))
+    connection.executemany(
+        "INSERT OR REPLACE INTO records_search (rowid, name, medical_history) VALUES (?, ?, ?)",
+        ((record_id, name, (decode(history) or '') + pending[record_id] if record_id in pending else decode(history))
+         for record_id, name, history in rows)
+    )
+    return rows[-1][0]
+
+
+def index_records(connection, records):
+    """Index new records given as (id, name, medical_history) with the history as text."""
+    connection.executemany(
+        "INSERT INTO records_search (rowid, name, medical_history) VALUES (?, ?, ?)", records
+    )
+
+
+def reindex_history(connection, record_id, history):
+    """Replace the indexed medical_history of a record."""
+    connection.execute("UPDATE records_search SET medical_history = ? WHERE rowid = ?", (history, record_id))
+
+
+def refresh_schema(connection):
+    """Reload the schema if another connection changed it, before a DELETE FROM records.
+
+    Prepared on a connection that has not read since another one changed the
+    schema (such as an online migration creating an index), a DELETE FROM
+    records fails with "no such table: records" on account of the
+    records_search_delete trigger, where other statements are re-prepared.
+    Any read notices the change.
+    """
+    connection.execute("SELECT count(*) FROM sqlite_master").fetchone()
+
+
+def rank_floor(connection, query, window):
+    """The lowest record id among the newest `window` matches, 0 if there are no more matches than that.
+
+    bm25 costs the same for every match, so a term in most records would be
+    ranked across all of them. Searches rank only the records from this id on:
+    finding it walks the term's doclist without scoring. Raises ValueError
+    like search().
+    """
+    rows = _execute(connection,
+                    "SELECT rowid FROM records_search WHERE records_search MATCH ? ORDER BY rowid DESC LIMIT 2 OFFSET ?",
+                    [query, window - 1]).fetchall()
+    return rows[0][0] if len(rows) > 1 else 0
+
+
+def search(connection, query, limit, after=None, min_id=0):
+    """Return up to `limit` (record id, rank) best match first, lower ranks are better.
+
+    `after` is the (rank, record id) of the last result of the previous page.
+    Only records from `min_id` on are matched, see rank_floor().
+    Raises ValueError for a query FTS5 cannot parse.
+    """
+    sql = "SELECT rowid, rank FROM records_search WHERE records_search MATCH ? AND rowid >= ?"
+    parameters = [query, min_id]
+    if after is not None:
+        sql += " AND (rank, rowid) > (?, ?)"
+        parameters.extend(after)
+    sql += " ORDER BY rank, rowid LIMIT ?"
+    parameters.append(limit)
+    return _execute(connection, sql, parameters).fetchall()
+
+
+def _execute(connection, sql, parameters):
+    try:
+        return connection.execute(sql, parameters)
+    except sqlite3.OperationalError as e:
+        if "locked" in str(e):
+            raise
+        raise ValueError(str(e)) from e
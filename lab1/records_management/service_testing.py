@@ -0,0 +1,854 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import sqlite3
+import tempfile
+import time
+import unittest
+import uuid
+
+# records_server reads its settings on import: without them, the tests get a
+# throwaway database rather than the shipped one
+os.environ.setdefault("RECORDS_DATABASE", os.path.join(tempfile.mkdtemp(), "records.db"))
+os.environ.setdefault("RECORDS_SERVICE_PORT", "0")
+os.environ.setdefault("PROMETHEUS_PORT", "0")
+
+import grpc
+import records_pb2
+import records_pb2_grpc
+import records_server
+from records_server import MIGRATIONS, RecordService, compact_histories, list_records_query, pool, record_cache, RECORD_FIELDS
+from migrations import migrate, run_online_migrations
+from change_log import create_change_log
+from db_pool import ConnectionPool
+from shards import MAX_SHARDS, SLOTS, ShardSet, initialize_shards, slot_of
+from reshard import move_slots
+from replication import Replica, ReplicaInterceptor, load_state
+from concurrent import futures
+from google.protobuf import empty_pb2, field_mask_pb2, timestamp_pb2
+from aio_server import AsyncServicerAdapter, PromAioServerInterceptor
+from load_tracking import LoadTracker, LoadTrackingInterceptor
+from history_codec import HistoryCodec, ZLIB, train_dictionary
+from response_compression import ResponseCompressionInterceptor
+from service_logging import LOG_RECORDS_DROPPED, DroppingQueueHandler, JsonFormatter, REDACTED, SampledLogger
+from stage_metrics import StageMetricsInterceptor
+import tracing
+from tracing import TracingInterceptor, configure_tracing, stop_tracing
+from load_harness import compare, parse_mix, summarize
+from prometheus_client import REGISTRY, CollectorRegistry
+
+class TestRecordService(unittest.TestCase):
+    def setUp(self):
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+        records_pb2_grpc.add_RecordServiceServicer_to_server(
+            RecordService(), self.server)
+        port = self.server.add_insecure_port('localhost:0')
+        self.server.start()
+        self.channel = grpc.insecure_channel(f'localhost:{port}')
+        self.stub = records_pb2_grpc.RecordServiceStub(self.channel)
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(0)
+
+    def create_records(self, count):
+        return [
+            self.stub.CreateRecord(records_pb2.CreateRecordRequest(name=f"Patient {i}", medical_history="history"))
+            for i in range(count)
+        ]
+
+    def test_CreateAndGetRecord(self):
+        created = self.stub.CreateRecord(
+            records_pb2.CreateRecordRequest(name="Patient", medical_history="flu"))
+
+        response = self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id=created.id))
+
+        self.assertEqual(response.name, "Patient")
+        self.assertEqual(response.medical_history, "flu")
+
+    def test_UpdateAndBatchDeleteInvalidateCachedRecord(self):
+        created = self.create_records(1)[0]
+        get = records_pb2.GetRecordInfoRequest(record_id=created.id)
+        self.stub.GetRecordInfo(get)
+
+        self.stub.UpdateRecordInfo(records_pb2.UpdateRecordInfoRequest(
+            record_id=created.id, updated_medical_history="updated"))
+        updated = self.stub.GetRecordInfo(get)
+        self.stub.BatchDeleteRecords(records_pb2.BatchDeleteRecordsRequest(record_ids=[created.id]))
+
+        with self.assertRaises(grpc.RpcError) as error:
+            self.stub.GetRecordInfo(get)
+        self.assertEqual(updated.medical_history, "updated")
+        self.assertEqual(error.exception.code(), grpc.StatusCode.NOT_FOUND)
+
+    def test_ConditionalGetAndUpdate(self):
+        created = self.create_records(1)[0]
+
+        unchanged = self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(
+            record_id=created.id, if_none_match=created.version))
+        updated = self.stub.UpdateRecordInfo(records_pb2.UpdateRecordInfoRequest(
+            record_id=created.id, updated_medical_history="updated", expected_version=created.version))
+        with self.assertRaises(grpc.RpcError) as error:
+            self.stub.UpdateRecordInfo(records_pb2.UpdateRecordInfoRequest(
+                record_id=created.id, updated_medical_history="stale", expected_version=created.version))
+        changed = self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(
+            record_id=created.id, if_none_match=created.version))
+
+        self.assertTrue(unchanged.not_modified)
+        self.assertEqual(unchanged.medical_history, "")
+        self.assertEqual(updated.version, created.version + 1)
+        self.assertEqual(error.exception.code(), grpc.StatusCode.ABORTED)
+        self.assertFalse(changed.not_modified)
+        self.assertEqual((changed.medical_history, changed.version), ("updated", updated.version))
+
+    def test_AppendMedicalHistoryAndCompaction(self):
+        created = self.stub.CreateRecord(records_pb2.CreateRecordRequest(name="Patient", medical_history="flu."))
+        get = records_pb2.GetRecordInfoRequest(record_id=created.id)
+        for entry in (" cough.", " fever."):
+            appended = self.stub.AppendMedicalHistory(records_pb2.AppendMedicalHistoryRequest(
+                record_id=created.id, entry=entry))
+        with self.assertRaises(grpc.RpcError) as error:
+            self.stub.AppendMedicalHistory(records_pb2.AppendMedicalHistoryRequest(
+                record_id=created.id, entry=" stale.", expected_version=created.version))
+
+        before = self.stub.GetRecordInfo(get)
+        compact_histories(min_entries=2)
+        record_cache.clear()
+        after = self.stub.GetRecordInfo(get)
+        self.stub.UpdateRecordInfo(records_pb2.UpdateRecordInfoRequest(record_id=created.id, updated_medical_history="new."))
+        self.stub.AppendMedicalHistory(records_pb2.AppendMedicalHistoryRequest(record_id=created.id, entry=" rash."))
+
+        self.assertEqual(appended.version, 3)
+        self.assertEqual(error.exception.code(), grpc.StatusCode.ABORTED)
+        self.assertEqual(before.medical_history, "flu. cough. fever.")
+        self.assertEqual((after.medical_history, after.version), (before.medical_history, before.version))
+        self.assertEqual(self.stub.GetRecordInfo(get).medical_history, "new. rash.")
+
+    def test_SearchRecordsRanksPagesAndFollowsWrites(self):
+        # A term no other run of the suite has written
+        term = "t" + uuid.uuid4().hex
+        often = self.stub.CreateRecord(records_pb2.CreateRecordRequest(
+            name="Patient", medical_history=f"{term} {term} {term} asthma."))
+        once = self.stub.CreateRecord(records_pb2.CreateRecordRequest(
+            name="Patient", medical_history=f"{term} and a much longer history of many unrelated visits."))
+        named = self.stub.CreateRecord(records_pb2.CreateRecordRequest(name=f"Patient {term}", medical_history="flu."))
+        search = lambda **kwargs: self.stub.SearchRecords(records_pb2.SearchRecordsRequest(query=term, **kwargs))
+
+        first = search(page_size=2)
+        second = search(page_size=2, page_token=first.next_page_token)
+        self.stub.UpdateRecordInfo(records_pb2.UpdateRecordInfoRequest(record_id=often.id, updated_medical_history="asthma."))
+        self.stub.AppendMedicalHistory(records_pb2.AppendMedicalHistoryRequest(record_id=named.id, entry=" rash."))
+        self.stub.BatchDeleteRecords(records_pb2.BatchDeleteRecordsRequest(record_ids=[once.id]))
+        after_writes = search()
+        appended = self.stub.SearchRecords(records_pb2.SearchRecordsRequest(query=f"{term} AND rash"))
+        with self.assertRaises(grpc.RpcError) as error:
+            self.stub.SearchRecords(records_pb2.SearchRecordsRequest(query='"unbalanced'))
+
+        self.assertEqual([r.record.id for r in first.results], [often.id, named.id])
+        self.assertGreater(first.results[0].score, first.results[1].score)
+        self.assertEqual([r.record.id for r in second.results], [once.id])
+        self.assertEqual(second.next_page_token, '')
+        self.assertEqual([r.record.id for r in after_writes.results], [named.id])
+        self.assertEqual([r.record.medical_history for r in appended.results], ["flu. rash."])
+        self.assertEqual(error.exception.code(), grpc.StatusCode.INVALID_ARGUMENT)
+
+
+    def test_SearchRankWindowTruncates(self):
+        term = "t" + uuid.uuid4().hex
+        ids = [record.id for record in self.create_records(3)]
+        for record_id in ids:
+            self.stub.AppendMedicalHistory(records_pb2.AppendMedicalHistoryRequest(record_id=record_id, entry=f" {term}"))
+        request = records_pb2.SearchRecordsRequest(query=term)
+
+        every_match = self.stub.SearchRecords(request)
+        window, records_server.SEARCH_RANK_WINDOW = records_server.SEARCH_RANK_WINDOW, 2
+        try:
+            newest = self.stub.SearchRecords(request)
+            records_server.SEARCH_RANK_WINDOW = 3
+            whole_window = self.stub.SearchRecords(request)
+        finally:
+            records_server.SEARCH_RANK_WINDOW = window
+
+        self.assertEqual(sorted(r.record.id for r in every_match.results), sorted(ids))
+        self.assertFalse(every_match.truncated)
+        self.assertEqual(sorted(r.record.id for r in newest.results), sorted(ids[1:]))
+        self.assertTrue(newest.truncated)
+        self.assertEqual(len(whole_window.results), 3)
+        self.assertFalse(whole_window.truncated)
+    def test_ListRecordsPagesByKeyset(self):
+        created = self.create_records(3)
+        start_token = str(int(created[0].id) - 1)
+
+        first = self.stub.ListRecords(records_pb2.ListRecordsRequest(page_size=2, page_token=start_token))
+        second = self.stub.ListRecords(records_pb2.ListRecordsRequest(page_size=2, page_token=first.next_page_token))
+
+        self.assertEqual([r.id for r in first.records], [created[0].id, created[1].id])
+        self.assertEqual(second.records[0].id, created[2].id)
+
+    def test_ReadMaskSkipsUnrequestedFields(self):
+        created = self.create_records(2)
+        mask = field_mask_pb2.FieldMask(paths=["name"])
+
+        record = self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id=created[0].id, read_mask=mask))
+        full = self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id=created[0].id))
+        cached = self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id=created[0].id, read_mask=mask))
+        page = self.stub.ListRecords(records_pb2.ListRecordsRequest(
+            page_size=1, page_token=str(int(created[0].id) - 1), read_mask=mask))
+        with self.assertRaises(grpc.RpcError) as error:
+            self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(
+                record_id=created[0].id, read_mask=field_mask_pb2.FieldMask(paths=["address"])))
+
+        self.assertEqual(record, records_pb2.Record(id=created[0].id, name="Patient 0"))
+        self.assertEqual(full.medical_history, "history")
+        self.assertEqual(cached, record)
+        self.assertEqual(list(page.records), [record])
+        self.assertEqual(page.next_page_token, created[0].id)
+        self.assertEqual(error.exception.code(), grpc.StatusCode.INVALID_ARGUMENT)
+
+    def test_ListRecordsFilters(self):
+        # A name no other run of the suite has written
+        name = "p" + uuid.uuid4().hex
+        created = [self.stub.CreateRecord(records_pb2.CreateRecordRequest(name=n, medical_history="history"))
+                   for n in (f"{name} b", f"{name.upper()} A", f"{name} c", "other")]
+        # updated_since has millisecond precision
+        time.sleep(0.002)
+        since = timestamp_pb2.Timestamp()
+        since.GetCurrentTime()
+        time.sleep(0.002)
+        self.stub.AppendMedicalHistory(records_pb2.AppendMedicalHistoryRequest(record_id=created[2].id, entry=" more."))
+        time.sleep(0.002)
+        self.stub.UpdateRecordInfo(records_pb2.UpdateRecordInfoRequest(record_id=created[0].id, updated_medical_history="new."))
+        list_records = lambda **kwargs: self.stub.ListRecords(records_pb2.ListRecordsRequest(**kwargs))
+
+        first = list_records(name_prefix=name, page_size=2)
+        second = list_records(name_prefix=name, page_size=2, page_token=first.next_page_token)
+        in_range = list_records(min_id=created[1].id, max_id=created[2].id)
+        updated = list_records(updated_since=since, page_size=1)
+        updated_next = list_records(updated_since=since, page_size=1, page_token=updated.next_page_token)
+        combined = list_records(name_prefix=name, min_id=created[1].id, updated_since=since)
+        with self.assertRaises(grpc.RpcError) as error:
+            list_records(name_prefix=name, page_token=f"{created[0].id}")
+
+        self.assertEqual([r.id for r in first.records] + [r.id for r in second.records],
+                         [created[1].id, created[0].id, created[2].id])
+        self.assertEqual([r.id for r in in_range.records], [created[1].id, created[2].id])
+        self.assertEqual([r.id for r in updated.records] + [r.id for r in updated_next.records],
+                         [created[2].id, created[0].id])
+        self.assertEqual([r.id for r in combined.records], [created[2].id])
+        self.assertEqual(error.exception.code(), grpc.StatusCode.INVALID_ARGUMENT)
+
+    def test_FilteredListsSearchAnIndex(self):
+        run_online_migrations(pool, MIGRATIONS)
+        since = timestamp_pb2.Timestamp(seconds=1700000000)
+        requests = {
+            "records_name": [
+                records_pb2.ListRecordsRequest(name_prefix="Smi", page_token="7:Smith"),
+                records_pb2.ListRecordsRequest(name_prefix="Smi", updated_since=since, min_id="3", max_id="9"),
+            ],
+            "records_updated_at": [
+                records_pb2.ListRecordsRequest(updated_since=since, page_token="7:1700000000123"),
+                records_pb2.ListRecordsRequest(updated_since=since, min_id="3"),
+            ],
+            "INTEGER PRIMARY KEY": [
+                records_pb2.ListRecordsRequest(min_id="3", max_id="9", page_token="5"),
+            ],
+        }
+        for index, filtered in requests.items():
+            for request in filtered:
+                sql, parameters = list_records_query(request, RECORD_FIELDS, 10)
+                with self.subTest(request=request), pool.connection() as connection:
+                    # EXPLAIN does not notice a schema changed by another connection, a query does
+                    connection.execute("SELECT count(*) FROM sqlite_master").fetchone()
+                    plan = [row[3] for row in connection.execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+                    self.assertFalse([step for step in plan if step.startswith(("SCAN records", "SCAN record_history_entries"))], plan)
+                    self.assertIn("SEARCH records USING", plan[0])
+                    self.assertIn(index, plan[0])
+                    self.assertNotIn("TEMP B-TREE", " ".join(plan))
+
+    def test_ListRecordsRejectsBadToken(self):
+        with self.assertRaises(grpc.RpcError) as error:
+            self.stub.ListRecords(records_pb2.ListRecordsRequest(page_token="not-an-id"))
+
+        self.assertEqual(error.exception.code(), grpc.StatusCode.INVALID_ARGUMENT)
+
+    def test_NonNumericRecordIdIsInvalid(self):
+        calls = [
+            (self.stub.GetRecordInfo, records_pb2.GetRecordInfoRequest(record_id="abc")),
+            (self.stub.UpdateRecordInfo, records_pb2.UpdateRecordInfoRequest(record_id="abc", updated_medical_history="h")),
+            (self.stub.AppendMedicalHistory, records_pb2.AppendMedicalHistoryRequest(record_id="abc", entry="h")),
+            (self.stub.DeleteRecord, records_pb2.DeleteRecordRequest(record_id="")),
+        ]
+        for call, request in calls:
+            with self.subTest(request=type(request).__name__):
+                with self.assertRaises(grpc.RpcError) as error:
+                    call(request)
+                self.assertEqual(error.exception.code(), grpc.StatusCode.INVALID_ARGUMENT)
+
+    def test_StreamRecordsYieldsEveryRowAcrossChunks(self):
+        created = self.create_records(5)
+        start_token = str(int(created[0].id) - 1)
+
+        streamed = list(self.stub.StreamRecords(
+            records_pb2.StreamRecordsRequest(page_token=start_token, chunk_size=2)))
+
+        self.assertEqual([r.id for r in streamed][:5], [r.id for r in created])
+
+    def test_BatchCreateGetDelete(self):
+        created = self.stub.BatchCreateRecords(records_pb2.BatchCreateRecordsRequest(records=[
+            records_pb2.CreateRecordRequest(name="A", medical_history="a"),
+            records_pb2.CreateRecordRequest(name="B", medical_history="b"),
+        ]))
+        ids = [result.record_id for result in created.results]
+
+        fetched = self.stub.BatchGetRecords(records_pb2.BatchGetRecordsRequest(record_ids=ids + ["0"]))
+        deleted = self.stub.BatchDeleteRecords(records_pb2.BatchDeleteRecordsRequest(record_ids=ids + ["x"]))
+
+        self.assertEqual([r.record.name for r in fetched.results[:2]], ["A", "B"])
+        self.assertEqual([r.ok for r in fetched.results], [True, True, False])
+        self.assertEqual([r.ok for r in deleted.results], [True, True, False])
+
+    def test_WatchChangesReplaysAndResumes(self):
+        created = self.create_records(1)[0]
+        log = self.stub.WatchChanges(records_pb2.WatchChangesRequest(after_offset=0), timeout=10)
+        first = next(c for c in log if c.record_id == created.id)
+        log.cancel()
+
+        self.stub.UpdateRecordInfo(records_pb2.UpdateRecordInfoRequest(
+            record_id=created.id, updated_medical_history="updated"))
+        self.stub.DeleteRecord(records_pb2.DeleteRecordRequest(record_id=created.id))
+        resumed = self.stub.WatchChanges(records_pb2.WatchChangesRequest(after_offset=first.offset), timeout=10)
+        changes = [next(resumed) for _ in range(2)]
+        resumed.cancel()
+
+        self.assertEqual(first.op, records_pb2.CREATED)
+        self.assertEqual([(c.op, c.record_id, c.version) for c in changes],
+                         [(records_pb2.UPDATED, created.id, 2), (records_pb2.DELETED, created.id, 3)])
+        self.assertLess(first.offset, changes[0].offset)
+
+    def test_ImportRecordsCommitsInChunks(self):
+        requests = (records_pb2.CreateRecordRequest(name=f"Imported {i}", medical_history="h") for i in range(2500))
+
+        summary = self.stub.ImportRecords(requests)
+
+        self.assertEqual(summary.imported, 2500)
+        self.assertEqual(summary.failed, 0)
+
+
+class TestShardedRecords(unittest.TestCase):
+    SHARDS = 3
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        databases = [os.path.join(self.directory.name, f"records-{i}.db") for i in range(self.SHARDS)]
+        self.connections = [sqlite3.connect(database, timeout=30) for database in databases]
+        for connection in self.connections:
+            migrate(connection, MIGRATIONS)
+            create_change_log(connection, "records", "record_changes", "record_id", 1000)
+            connection.commit()
+        owners = initialize_shards(self.connections)
+        self.shards = ShardSet([ConnectionPool(database) for database in databases], True, owners)
+        for shard_pool in self.shards.pools:
+            run_online_migrations(shard_pool, MIGRATIONS)
+        # The servicer reads the module's shards on every call
+        self.unsharded, records_server.shards = records_server.shards, self.shards
+        record_cache.clear()
+
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+        records_pb2_grpc.add_RecordServiceServicer_to_server(RecordService(), self.server)
+        port = self.server.add_insecure_port('localhost:0')
+        self.server.start()
+        self.channel = grpc.insecure_channel(f'localhost:{port}')
+        self.stub = records_pb2_grpc.RecordServiceStub(self.channel)
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(0)
+        records_server.shards = self.unsharded
+        record_cache.clear()
+        self.shards.close()
+        for connection in self.connections:
+            connection.close()
+        self.directory.cleanup()
+
+    def create_records(self, names, history="history"):
+        created = self.stub.BatchCreateRecords(records_pb2.BatchCreateRecordsRequest(records=[
+            records_pb2.CreateRecordRequest(name=name, medical_history=history) for name in names
+        ]))
+        return [result.record_id for result in created.results]
+
+    def stored_ids(self, shard):
+        return {row[0] for row in self.connections[shard].execute("SELECT id FROM records")}
+
+    def list_all(self, **filters):
+        ids, token = [], ''
+        while True:
+            page = self.stub.ListRecords(records_pb2.ListRecordsRequest(page_size=7, page_token=token, **filters))
+            ids += [record.id for record in page.records]
+            token = page.next_page_token
+            if not token:
+                return ids
+
+    def test_RecordsAreSpreadAndMergedAcrossShards(self):
+        term = uuid.uuid4().hex
+        names = [f"{'Smith' if i % 2 else 'smith'} {i:02d}" for i in range(40)]
+        ids = self.create_records(names, f"history {term}")
+        ids.append(self.stub.CreateRecord(records_pb2.CreateRecordRequest(name="Jones", medical_history="flu")).id)
+
+        stored = [self.stored_ids(shard) for shard in range(self.SHARDS)]
+        by_name = sorted(zip(names, ids), key=lambda named: (named[0].lower(), int(named[1])))
+        searched, token = [], ''
+        while True:
+            page = self.stub.SearchRecords(records_pb2.SearchRecordsRequest(query=term, page_size=6, page_token=token))
+            searched += [result.record.id for result in page.results]
+            token = page.next_page_token
+            if not token:
+                break
+        streamed = [record.id for record in self.stub.StreamRecords(records_pb2.StreamRecordsRequest(chunk_size=4))]
+        fetched = self.stub.BatchGetRecords(records_pb2.BatchGetRecordsRequest(record_ids=ids))
+
+        self.assertEqual(len(set(ids)), 41)
+        for record_id in ids:
+            self.assertIn(int(record_id), stored[self.shards.shard_of(int(record_id))])
+        self.assertGreater(sum(1 for shard_ids in stored if shard_ids), 1)
+        self.assertEqual(self.list_all(), sorted(ids, key=int))
+        self.assertEqual(streamed, sorted(ids, key=int))
+        self.assertEqual(self.list_all(name_prefix="smith"), [record_id for _, record_id in by_name])
+        self.assertEqual(sorted(searched, key=int), sorted(ids[:40], key=int))
+        self.assertTrue(all(result.ok for result in fetched.results))
+
+    def test_WritesGoToTheRecordsShard(self):
+        record_id = self.create_records(["Patient"])[0]
+
+        self.stub.UpdateRecordInfo(records_pb2.UpdateRecordInfoRequest(
+            record_id=record_id, updated_medical_history="updated"))
+        self.stub.AppendMedicalHistory(records_pb2.AppendMedicalHistoryRequest(record_id=record_id, entry=" more"))
+        record = self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id=record_id))
+        self.stub.DeleteRecord(records_pb2.DeleteRecordRequest(record_id=record_id))
+
+        self.assertEqual((record.medical_history, record.version), ("updated more", 3))
+        self.assertFalse(any(int(record_id) in self.stored_ids(shard) for shard in range(self.SHARDS)))
+
+    def test_MovedSlotsKeepTheirRecords(self):
+        ids = [int(record_id) for record_id in self.create_records([f"Patient {i}" for i in range(60)])]
+        appended = ids[0]
+        self.stub.AppendMedicalHistory(records_pb2.AppendMedicalHistoryRequest(record_id=str(appended), entry=" more"))
+        source = self.shards.shard_of(appended)
+        target = (source + 1) % self.SHARDS
+        slots = sorted({slot_of(record_id) for record_id in ids if self.shards.shard_of(record_id) == source})
+
+        moved = move_slots(self.connections, slots, target, records_server.history_codec.decode, batch_size=2, settle=0)
+        self.shards.refresh()
+        record = self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id=str(appended)))
+        found = self.stub.SearchRecords(records_pb2.SearchRecordsRequest(query="more"))
+
+        self.assertEqual(moved, len([record_id for record_id in ids if slot_of(record_id) in slots]))
+        self.assertEqual(self.shards.shard_of(appended), target)
+        self.assertIn(appended, self.stored_ids(target))
+        self.assertNotIn(appended, self.stored_ids(source))
+        self.assertEqual((record.medical_history, record.version), ("history more", 2))
+        self.assertEqual([result.record.id for result in found.results], [str(appended)])
+        self.assertEqual(self.list_all(), [str(record_id) for record_id in sorted(ids)])
+
+    def test_WatchChangesFollowsEveryShard(self):
+        log = self.stub.WatchChanges(records_pb2.WatchChangesRequest(from_now=True), timeout=10)
+        time.sleep(0.5)
+        ids = self.create_records([f"Patient {i}" for i in range(12)])
+        changes = [next(log) for _ in ids]
+        log.cancel()
+        with self.assertRaises(grpc.RpcError) as error:
+            next(iter(self.stub.WatchChanges(records_pb2.WatchChangesRequest(after_offset=changes[0].offset), timeout=10)))
+
+        self.assertEqual(sorted(change.record_id for change in changes), sorted(ids))
+        self.assertEqual({change.offset % MAX_SHARDS for change in changes},
+                         {self.shards.shard_of(int(record_id)) for record_id in ids})
+        self.assertEqual(error.exception.code(), grpc.StatusCode.OUT_OF_RANGE)
+
+    def test_WritesToAFrozenSlotAreRetried(self):
+        record_id = int(self.create_records(["Patient"])[0])
+        shard = self.shards.shard_of(record_id)
+        self.connections[shard].execute("INSERT INTO frozen_slots (slot) VALUES (?)", (slot_of(record_id),))
+        self.connections[shard].commit()
+        self.shards.refresh()
+
+        with self.assertRaises(grpc.RpcError) as error:
+            self.stub.UpdateRecordInfo(records_pb2.UpdateRecordInfoRequest(
+                record_id=str(record_id), updated_medical_history="updated"))
+        created = [int(created_id) for created_id in self.create_records(["Patient"] * 50)]
+
+        self.assertEqual(error.exception.code(), grpc.StatusCode.UNAVAILABLE)
+        self.assertNotIn(slot_of(record_id), {slot_of(created_id) for created_id in created})
+        self.assertEqual(len(self.shards.frozen), 1)
+        self.assertLess(max(map(slot_of, created)), SLOTS)
+
+
+class TestReplication(unittest.TestCase):
+    def setUp(self):
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+        records_pb2_grpc.add_RecordServiceServicer_to_server(RecordService(), self.server)
+        self.port = self.server.add_insecure_port('localhost:0')
+        self.server.start()
+        self.channel = grpc.insecure_channel(f'localhost:{self.port}')
+        self.stub = records_pb2_grpc.RecordServiceStub(self.channel)
+
+        self.directory = tempfile.TemporaryDirectory()
+        database = os.path.join(self.directory.name, "replica.db")
+        self.connection = sqlite3.connect(database, timeout=30)
+        migrate(self.connection, MIGRATIONS)
+        create_change_log(self.connection, "records", "record_changes", "record_id", 1000)
+        self.connection.commit()
+        self.replica_pool = ConnectionPool(database)
+        self.replica = None
+
+    def tearDown(self):
+        if self.replica:
+            self.replica.stop()
+        self.channel.close()
+        self.server.stop(0)
+        self.replica_pool.close()
+        self.connection.close()
+        self.directory.cleanup()
+
+    def start_replica(self):
+        self.replica = Replica(self.replica_pool, f'localhost:{self.port}', records_server.history_codec.encode,
+                               retry_interval=0.1)
+        self.replica.start()
+
+    def primary_records(self):
+        with pool.connection() as connection:
+            return {row[0]: row[1] for row in connection.execute("SELECT id, version FROM records")}
+
+    def replica_records(self):
+        return {row[0]: row[1] for row in self.connection.execute("SELECT id, version FROM records")}
+
+    def wait_for_replica(self):
+        deadline = time.monotonic() + 10
+        while self.replica_records() != self.primary_records():
+            self.assertLess(time.monotonic(), deadline, "The replica did not catch up")
+            time.sleep(0.05)
+
+    def replica_history(self, record_id):
+        stored, = self.connection.execute("SELECT medical_history FROM records WHERE id = ?", (int(record_id),)).fetchone()
+        return records_server.history_codec.decode(stored)
+
+    def test_ReplicaFollowsSnapshotAndChanges(self):
+        kept, updated, deleted = [
+            self.stub.CreateRecord(records_pb2.CreateRecordRequest(name=f"Replicated {i}", medical_history="flu. "))
+            for i in range(3)]
+
+        self.start_replica()
+        self.wait_for_replica()
+        self.stub.AppendMedicalHistory(records_pb2.AppendMedicalHistoryRequest(record_id=kept.id, entry="rash."))
+        self.stub.UpdateRecordInfo(records_pb2.UpdateRecordInfoRequest(
+            record_id=updated.id, updated_medical_history="mesothelioma"))
+        self.stub.DeleteRecord(records_pb2.DeleteRecordRequest(record_id=deleted.id))
+        self.wait_for_replica()
+
+        self.assertEqual(self.replica_history(kept.id), "flu. rash.")
+        self.assertEqual(self.replica_history(updated.id), "mesothelioma")
+        self.assertEqual([row[0] for row in self.connection.execute(
+            "SELECT rowid FROM records_search WHERE records_search MATCH 'mesothelioma'")], [int(updated.id)])
+        # Its own change log has the applied changes, for watchers of the replica
+        self.assertIn(int(deleted.id), {row[0] for row in self.connection.execute(
+            "SELECT record_id FROM record_changes WHERE op = 3")})
+        with pool.connection() as connection:
+            head = connection.execute("SELECT seq FROM sqlite_sequence WHERE name = 'record_changes'").fetchone()[0]
+        self.assertEqual(load_state(self.connection)[0], head)
+
+    def test_ReplicaTakesASnapshotWhenItsOffsetIsGone(self):
+        self.stub.CreateRecord(records_pb2.CreateRecordRequest(name="Patient", medical_history="flu"))
+        # Left over from an earlier primary, and an offset it never retained
+        self.connection.execute("INSERT INTO records (id, name, version) VALUES (?, 'Stray', 1)",
+                                (max(self.primary_records()) + 1000,))
+        self.connection.execute("INSERT INTO replication_state (id, primary_offset) VALUES (1, -5)")
+        self.connection.commit()
+
+        self.start_replica()
+
+        self.wait_for_replica()
+
+    def test_ReplicaRejectsWritesAndStaleReads(self):
+        staleness = [None]
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=2),
+                             interceptors=[ReplicaInterceptor(lambda: staleness[0], 5, refresh=0)])
+        records_pb2_grpc.add_RecordServiceServicer_to_server(RecordService(), server)
+        port = server.add_insecure_port('localhost:0')
+        server.start()
+        created = self.stub.CreateRecord(records_pb2.CreateRecordRequest(name="Patient", medical_history="flu"))
+        try:
+            with grpc.insecure_channel(f'localhost:{port}') as channel:
+                replica = records_pb2_grpc.RecordServiceStub(channel)
+                get = records_pb2.GetRecordInfoRequest(record_id=created.id)
+                with self.assertRaises(grpc.RpcError) as error:
+                    replica.CreateRecord(records_pb2.CreateRecordRequest(name="Patient"))
+                self.assertEqual(error.exception.code(), grpc.StatusCode.FAILED_PRECONDITION)
+
+                for staleness[0] in (None, 10.0):
+                    with self.assertRaises(grpc.RpcError) as error:
+                        replica.GetRecordInfo(get)
+                    self.assertEqual(error.exception.code(), grpc.StatusCode.UNAVAILABLE)
+                    with self.assertRaises(grpc.RpcError) as error:
+                        list(replica.StreamRecords(records_pb2.StreamRecordsRequest()))
+                    self.assertEqual(error.exception.code(), grpc.StatusCode.UNAVAILABLE)
+
+                staleness[0] = 1.0
+                self.assertEqual(replica.GetRecordInfo(get).name, "Patient")
+                self.assertTrue(replica.GetServiceStatus(empty_pb2.Empty()).is_healthy)
+        finally:
+            server.stop(0)
+
+
+class TestServiceLogging(unittest.TestCase):
+    def setUp(self):
+        self.records = []
+        self.logger = logging.getLogger(f"test.{uuid.uuid4()}")
+        self.logger.propagate = False
+        handler = logging.Handler()
+        handler.emit = self.records.append
+        self.logger.addHandler(handler)
+
+    def test_JsonRecordsRedactPatientData(self):
+        request = records_pb2.CreateRecordRequest(name="Jane Doe", medical_history="HIV positive")
+        self.logger.info("CreateRecord %s", 7, extra={"medical_history": "HIV positive", "request": request,
+                                                       "record_id": 7})
+
+        entry = json.loads(JsonFormatter("records-service").format(self.records[0]))
+
+        self.assertEqual(entry["message"], "CreateRecord 7")
+        self.assertEqual(entry["service"], "records-service")
+        self.assertEqual(entry["record_id"], 7)
+        self.assertEqual(entry["medical_history"], REDACTED)
+        self.assertEqual(entry["request"], {"name": REDACTED, "medical_history": REDACTED})
+        self.assertNotIn("Jane", json.dumps(entry))
+
+    def test_SampledLoggerKeepsItsShare(self):
+        for rate in (0, 0.5, 1):
+            self.records.clear()
+            sampled = SampledLogger(self.logger, rate)
+            for _ in range(1000):
+                sampled.info("GetRecordInfo", record_id=1)
+            self.assertAlmostEqual(len(self.records), 1000 * rate, delta=100)
+
+    def test_FullQueueDropsRecords(self):
+        handler = DroppingQueueHandler(queue.Queue(2))
+        dropped = LOG_RECORDS_DROPPED._value.get()
+
+        for i in range(5):
+            handler.handle(self.logger.makeRecord(self.logger.name, logging.INFO, "", 0, "record %s", (i,), None))
+
+        self.assertEqual(handler.queue.get_nowait().msg, "record 0")
+        self.assertEqual(LOG_RECORDS_DROPPED._value.get() - dropped, 3)
+
+
+class TestStageMetrics(unittest.TestCase):
+    def setUp(self):
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=10),
+                                  interceptors=[StageMetricsInterceptor()])
+        records_pb2_grpc.add_RecordServiceServicer_to_server(RecordService(), self.server)
+        port = self.server.add_insecure_port('localhost:0')
+        self.server.start()
+        self.channel = grpc.insecure_channel(f'localhost:{port}')
+        self.stub = records_pb2_grpc.RecordServiceStub(self.channel)
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(0)
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_CallsReportTheirStages(self):
+        stages = ("acquire", "execute", "fetch", "build")
+        before = {stage: self.sample("rpc_stage_seconds_count", method="GetRecordInfo", stage=stage)
+                  for stage in stages}
+        commits = self.sample("rpc_stage_seconds_count", method="CreateRecord", stage="commit")
+        rows = self.sample("rpc_sqlite_rows_count", method="GetRecordInfo")
+        response_bytes = self.sample("rpc_response_bytes_sum", method="GetRecordInfo")
+
+        created = self.stub.CreateRecord(records_pb2.CreateRecordRequest(name="Patient", medical_history="flu"))
+        record_cache.invalidate([int(created.id)])
+        self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id=created.id))
+
+        for stage in stages:
+            self.assertGreater(self.sample("rpc_stage_seconds_count", method="GetRecordInfo", stage=stage),
+                               before[stage], stage)
+        self.assertGreater(self.sample("rpc_stage_seconds_count", method="CreateRecord", stage="commit"), commits)
+        self.assertEqual(self.sample("rpc_sqlite_rows_count", method="GetRecordInfo"), rows + 1)
+        self.assertGreater(self.sample("rpc_response_bytes_sum", method="GetRecordInfo"), response_bytes)
+
+
+@unittest.skipIf(tracing.trace is None, "opentelemetry-sdk is not installed")
+class TestTracing(unittest.TestCase):
+    TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+    PARENT_ID = "00f067aa0ba902b7"
+
+    def setUp(self):
+        from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+        from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+        self.spans = InMemorySpanExporter()
+        configure_tracing("records-service", self.spans, sample_rate=0, processor=SimpleSpanProcessor)
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), interceptors=[TracingInterceptor()])
+        records_pb2_grpc.add_RecordServiceServicer_to_server(RecordService(), self.server)
+        port = self.server.add_insecure_port('localhost:0')
+        self.server.start()
+        self.channel = grpc.insecure_channel(f'localhost:{port}')
+        self.stub = records_pb2_grpc.RecordServiceStub(self.channel)
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(0)
+        stop_tracing()
+
+    def traceparent(self, flags):
+        return (("traceparent", f"00-{self.TRACE_ID}-{self.PARENT_ID}-{flags}"),)
+
+    def test_SampledCallIsTracedDownToItsStatements(self):
+        created = self.stub.CreateRecord(records_pb2.CreateRecordRequest(name="Patient", medical_history="flu"),
+                                         metadata=self.traceparent("00"))
+        record_cache.invalidate([int(created.id)])
+
+        self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id=created.id),
+                                metadata=self.traceparent("01"))
+        with self.assertRaises(grpc.RpcError):
+            self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id="999999999"),
+                                    metadata=self.traceparent("01"))
+
+        spans = self.spans.get_finished_spans()
+        calls = [span for span in spans if span.name == "records.RecordService/GetRecordInfo"]
+        self.assertEqual(len(calls), 2)
+        call = calls[0]
+        self.assertEqual(format(call.context.trace_id, "032x"), self.TRACE_ID)
+        self.assertEqual(format(call.parent.span_id, "016x"), self.PARENT_ID)
+        self.assertEqual(call.attributes["rpc.grpc.status_code"], grpc.StatusCode.OK.value[0])
+        self.assertEqual(calls[1].attributes["rpc.grpc.status_code"], grpc.StatusCode.NOT_FOUND.value[0])
+        statements = [span for span in spans if span.attributes.get("db.system") == "sqlite"]
+        self.assertEqual({span.parent.span_id for span in statements}, {call.context.span_id for call in calls})
+        self.assertTrue(any(span.attributes["db.operation"] == "SELECT" for span in statements))
+        # The unsampled CreateRecord left nothing
+        self.assertTrue(all(span.context.trace_id == call.context.trace_id for span in spans))
+
+
+class TestLoadHarness(unittest.TestCase):
+    def test_MixNeedsKnownOperations(self):
+        self.assertEqual(parse_mix("get=3, create", ("get", "create")), {"get": 3.0, "create": 1.0})
+        with self.assertRaises(ValueError):
+            parse_mix("get=3,scan=1", ("get", "create"))
+
+    def test_SummaryPercentilesAndRegressions(self):
+        # 1 to 1000 ms
+        latencies = {"get": [i / 1000 for i in range(1000, 0, -1)]}
+        results = summarize(latencies, {"get": {"UNAVAILABLE": 2}}, duration=10)
+        results["peak_rss_mb"] = 100
+
+        get = results["operations"]["get"]
+        self.assertEqual((get["calls"], get["throughput"], get["errors"]), (1000, 100, {"UNAVAILABLE": 2}))
+        self.assertEqual([get[f"{p}_ms"] for p in ("p50", "p95", "p99", "p999")], [501, 951, 991, 1000])
+        self.assertEqual(compare(results, results), [])
+
+        slower = summarize({"get": [value * 2 for value in latencies["get"][:500]]}, {}, duration=10)
+        slower["peak_rss_mb"] = 200
+        self.assertEqual(len(compare(results, slower)), 5)
+
+
+class TestHistoryCodec(unittest.TestCase):
+    HISTORIES = [f"Visit {i}: blood pressure normal, follow up in two weeks, no known allergies." * 5 for i in range(50)]
+
+    def test_DictionaryCompressesBetterAndRoundTrips(self):
+        dictionary = train_dictionary("zlib", self.HISTORIES)
+        plain = HistoryCodec("zlib", min_size=64)
+        trained = HistoryCodec("zlib", {1: (ZLIB, dictionary)}, min_size=64)
+
+        stored = trained.encode(self.HISTORIES[0])
+
+        self.assertLess(len(stored), len(plain.encode(self.HISTORIES[0])))
+        self.assertEqual(trained.decode(stored), self.HISTORIES[0])
+        self.assertEqual(HistoryCodec(load_dictionary={1: (ZLIB, dictionary)}.get).decode(stored), self.HISTORIES[0])
+
+    def test_ShortHistoriesAndOldRowsStayText(self):
+        codec = HistoryCodec("zlib", min_size=64)
+
+        self.assertEqual(codec.encode("flu"), "flu")
+        self.assertEqual(codec.decode("stored before compression"), "stored before compression")
+
+
+class TestAioServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.executor = futures.ThreadPoolExecutor(max_workers=4)
+        self.tracker = LoadTracker()
+        self.registry = CollectorRegistry()
+        self.server = grpc.aio.server(interceptors=[PromAioServerInterceptor(self.registry)])
+        self.server.add_generic_rpc_handlers((AsyncServicerAdapter(
+            records_pb2_grpc.add_RecordServiceServicer_to_server, RecordService(), self.executor,
+            [LoadTrackingInterceptor(self.tracker), ResponseCompressionInterceptor(threshold=64)]),))
+        port = self.server.add_insecure_port('localhost:0')
+        await self.server.start()
+        self.channel = grpc.aio.insecure_channel(f'localhost:{port}')
+        self.stub = records_pb2_grpc.RecordServiceStub(self.channel)
+
+    async def asyncTearDown(self):
+        await self.channel.close()
+        await self.server.stop(0)
+        self.executor.shutdown()
+
+    async def test_UnaryAndStatusCodes(self):
+        created = await self.stub.CreateRecord(records_pb2.CreateRecordRequest(name="Async", medical_history="h"))
+        fetched = await self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id=created.id))
+
+        with self.assertRaises(grpc.aio.AioRpcError) as error:
+            await self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id="0"))
+
+        self.assertEqual(fetched.name, "Async")
+        self.assertEqual(error.exception.code(), grpc.StatusCode.NOT_FOUND)
+
+    async def test_StreamingRequestsAndResponses(self):
+        summary = await self.stub.ImportRecords(
+            records_pb2.CreateRecordRequest(name=f"Streamed {i}", medical_history="h") for i in range(3))
+        listed = await self.stub.ListRecords(records_pb2.ListRecordsRequest(page_size=1))
+        streamed = [r async for r in self.stub.StreamRecords(
+            records_pb2.StreamRecordsRequest(page_token=str(int(listed.records[0].id) - 1), chunk_size=2))]
+
+        self.assertEqual(summary.imported, 3)
+        self.assertGreaterEqual(len(streamed), 3)
+        self.assertEqual(self.tracker.snapshot()[:2], (0, 0))
+
+    async def test_AbortInWorkerThread(self):
+        with self.assertRaises(grpc.aio.AioRpcError) as error:
+            async for _ in self.stub.StreamRecords(records_pb2.StreamRecordsRequest(page_token="bad")):
+                pass
+
+        self.assertEqual(error.exception.code(), grpc.StatusCode.INVALID_ARGUMENT)
+
+    async def test_CancelledStreamsFreeTheirWorkers(self):
+        # As many watchers as the executor has threads
+        watchers = [self.stub.WatchChanges(records_pb2.WatchChangesRequest(from_now=True)) for _ in range(4)]
+        await asyncio.sleep(0.3)
+        for watcher in watchers:
+            watcher.cancel()
+
+        created = await asyncio.wait_for(
+            self.stub.CreateRecord(records_pb2.CreateRecordRequest(name="After watchers", medical_history="h")), 5)
+
+        self.assertTrue(created.id)
+
+    async def test_RequestMetrics(self):
+        created = await self.stub.CreateRecord(records_pb2.CreateRecordRequest(name="Counted", medical_history="h"))
+        with self.assertRaises(grpc.aio.AioRpcError):
+            await self.stub.GetRecordInfo(records_pb2.GetRecordInfoRequest(record_id="0"))
+        streamed = [r async for r in self.stub.StreamRecords(
+            records_pb2.StreamRecordsRequest(page_token=str(int(created.id) - 1)))]
+
+        def sample(name, method, **labels):
+            return self.registry.get_sample_value(
+                name, dict(grpc_service="records.RecordService", grpc_method=method, **labels))
+
+        self.assertEqual(sample("grpc_server_handled_total", "CreateRecord", grpc_type="UNARY", grpc_code="OK"), 1)
+        self.assertEqual(sample("grpc_server_handled_total", "GetRecordInfo", grpc_type="UNARY",
+                                grpc_code="NOT_FOUND"), 1)
+        self.assertEqual(sample("grpc_server_started_total", "StreamRecords", grpc_type="SERVER_STREAMING"), 1)
+        self.assertEqual(sample("grpc_server_msg_sent_total", "StreamRecords", grpc_type="SERVER_STREAMING"),
+                         len(streamed))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,297 @@
+import bisect
+import collections
+import contextlib
+import hashlib
+import heapq
+import logging
+import random
+import threading
+import time
+from concurrent import futures
+
+import stage_metrics
+import tracing
+from migrations import execute_statements
+
+# Sharded storage for the records service: records spread over several
+# SQLite files, each a complete records database (same migrations, search
+# index, change log).
+#
+# A record id is (sequence << 16) | (shard << 10) | slot. The slot, one of
+# SLOTS, is picked at random when the record is created and decides where
+# it lives: the slot map assigns every slot to a shard. The shard bits are
+# the shard that allocated the id from its own sequence, which keeps ids
+# unique across shards without any coordination, including after a record
+# has been moved to another shard with its slot.
+#
+# The slot map is kept on shard 0 (with the history dictionaries). A new
+# deployment starts with the slots spread over the shards by a consistent
+# hash ring (ring_owners), so adding a shard moves ~1/N of the slots;
+# reshard.py moves slots between shards online. Each shard lists the slots
+# that must not be written there (frozen_slots): ones being moved away or
+# already moved. Writes check it in their own transaction, so one that reads
+# a stale slot map fails with SlotMoving instead of being lost.
+
+log = logging.getLogger(__name__)
+
+SLOT_BITS = 10
+SLOTS = 1 << SLOT_BITS
+SHARD_BITS = 6
+MAX_SHARDS = 1 << SHARD_BITS
+SEQUENCE_SHIFT = SLOT_BITS + SHARD_BITS
+# Points per shard on the hash ring
+VIRTUAL_NODES = 64
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS shard_slots (
+        slot INTEGER PRIMARY KEY,
+        shard INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS frozen_slots (
+        slot INTEGER PRIMARY KEY
+    );
+    CREATE TABLE IF NOT EXISTS id_sequences (
+        shard INTEGER PRIMARY KEY,
+        next INTEGER NOT NULL
+    );
+'''
+
+
+class SlotMoving(Exception):
+    """A write to a slot that is being moved to another shard, retry it."""
+
+
+def slot_of(record_id):
+    return record_id & (SLOTS - 1)
+
+
+def encode_id(sequence, shard, slot):
+    return sequence << SEQUENCE_SHIFT | shard << SLOT_BITS | slot
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+def ring_owners(shard_count):
+    """The shard of every slot when the slots are spread over shard_count shards by a consistent hash ring."""
+    ring = sorted((_hash(f"shard-{shard}-{node}"), shard)
+                  for shard in range(shard_count) for node in range(VIRTUAL_NODES))
+    points = [point for point, _ in ring]
+    # A slot belongs to the first point at or after its own, wrapping around
+    return [ring[bisect.bisect_left(points, _hash(f"slot-{slot}")) % len(ring)][1] for slot in range(SLOTS)]
+
+
+def create_shard_tables(connection):
+    execute_statements(connection, SCHEMA)
+
+
+def load_owners(connection):
+    """The slot map on shard 0, None before it is set up."""
+    rows = connection.execute("SELECT slot, shard FROM shard_slots ORDER BY slot").fetchall()
+    if len(rows) != SLOTS:
+        return None
+    return [shard for _, shard in rows]
+
+
+def load_frozen(connection):
+    return {row[0] for row in connection.execute("SELECT slot FROM frozen_slots")}
+
+
+def initialize_shards(connections):
+    """Set up the slot map and id sequences at startup, for databases given in shard order.
+
+    Safe to run from several processes at once. Returns the slot map.
+    """
+    if len(connections) > MAX_SHARDS:
+        raise ValueError(f"At most {MAX_SHARDS} shards")
+    # Ids allocated from now on are above every existing one, such as the
+    # AUTOINCREMENT ids of a database that predates sharding
+    highest = max(connection.execute("SELECT coalesce(max(id), 0) FROM records").fetchone()[0]
+                  for connection in connections)
+    for shard, connection in enumerate(connections):
+        connection.execute("INSERT OR IGNORE INTO id_sequences (shard, next) VALUES (?, ?)",
+                           (shard, (highest >> SEQUENCE_SHIFT) + 1))
+        connection.commit()
+
+    connection = connections[0]
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        owners = load_owners(connection)
+        if owners is None:
+            # Records already stored are all on shard 0 and stay reachable
+            # there, reshard.py rebalance spreads them
+            owners = ring_owners(len(connections)) if not highest else [0] * SLOTS
+            connection.executemany("INSERT OR REPLACE INTO shard_slots (slot, shard) VALUES (?, ?)",
+                                   enumerate(owners))
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    if max(owners) >= len(connections):
+        raise ValueError(f"The slot map names shard {max(owners)}, only {len(connections)} shards are configured")
+    return owners
+
+
+def allocate_sequences(connection, shard, count):
+    """Reserve `count` sequence numbers of a shard, returns the first. Part of the caller's write."""
+    return connection.execute(
+        "UPDATE id_sequences SET next = next + ? WHERE shard = ? RETURNING next - ?", (count, shard, count)
+    ).fetchone()[0]
+
+
+def check_writable(connection, slots):
+    """Raise SlotMoving if any of the slots is frozen on this shard, in the caller's write."""
+    if not connection.in_transaction:
+        # Rollback mode: a slot frozen after this check must wait for the write
+        connection.execute("BEGIN IMMEDIATE")
+    slots = list(slots)
+    frozen = connection.execute(
+        f"SELECT slot FROM frozen_slots WHERE slot IN ({', '.join('?' * len(slots))})", slots).fetchone()
+    if frozen:
+        raise SlotMoving(f"Slot {frozen[0]} is moving to another shard")
+
+
+class ShardSet:
+    """The ConnectionPools of the records databases and where each record lives.
+
+    Unsharded (a single database, sharded=False) every record is on the one
+    pool and ids are its AUTOINCREMENT ids, as before sharding.
+    """
+
+    def __init__(self, pools, sharded=False, owners=None, scatter_threads=10):
+        self.pools = pools
+        self.sharded = sharded
+        self.owners = owners or [0] * SLOTS
+        self.frozen = set()
+        self._random = random.Random()
+        self._executor = futures.ThreadPoolExecutor(scatter_threads, thread_name_prefix="shard-scatter") \
+            if len(pools) > 1 else None
+
+    def refresh(self):
+        """Reload the slot map and the frozen slots."""
+        with self.pools[0].connection() as connection:
+            owners = load_owners(connection)
+        owners = owners or self.owners
+        frozen = set()
+        for shard, pool in enumerate(self.pools):
+            with pool.connection() as connection:
+                # A shard keeps the slots moved away from it frozen, only
+                # those it still owns are moving
+                frozen |= {slot for slot in load_frozen(connection) if owners[slot] == shard}
+        self.owners = owners
+        self.frozen = frozen
+
+    def start_refresher(self, interval):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    with contextlib.ExitStack() as connections:
+                        for pool in self.pools:
+                            connections.enter_context(pool.background())
+                        self.refresh()
+                except Exception as e:
+                    log.error("Shard map refresh failed: %s", e)
+
+        threading.Thread(target=run, name="shard-map-refresh", daemon=True).start()
+
+    def shard_of(self, record_id):
+        return self.owners[slot_of(record_id)] if self.sharded else 0
+
+    def pool_for(self, record_id):
+        return self.pools[self.shard_of(record_id)]
+
+    def owns(self, shard, record_id):
+        # A record being moved is on two shards for a while, only one owns it
+        return not self.sharded or self.owners[slot_of(record_id)] == shard
+
+    def group(self, record_ids):
+        """The ids by the shard they live on."""
+        shards = collections.defaultdict(list)
+        for record_id in record_ids:
+            shards[self.shard_of(record_id)].append(record_id)
+        return shards
+
+    def write(self, record_ids, write):
+        """pool.write(write) on the shard of record_ids, which must all live on it."""
+        pool = self.pools[self.shard_of(record_ids[0])]
+        if not self.sharded:
+            return pool.write(write)
+
+        def checked(connection):
+            check_writable(connection, {slot_of(record_id) for record_id in record_ids})
+            return write(connection)
+
+        return pool.write(checked)
+
+    def insert(self, rows, insert):
+        """Store new rows on the shards of random slots, returns their ids in order.
+
+        insert(connection, rows, ids) writes rows with the given ids, None
+        when unsharded, where it lets AUTOINCREMENT pick them and returns
+        them. There is one write per shard, so a batch spread over several is
+        not atomic: the ids of rows whose shard failed are None, and the
+        error is raised only if no row was stored.
+        """
+        if not self.sharded:
+            return self.pools[0].write(lambda connection: insert(connection, rows, None))
+        writable = [slot for slot in range(SLOTS) if slot not in self.frozen]
+        slots = [self._random.choice(writable) for _ in rows]
+        positions = collections.defaultdict(list)
+        for position, slot in enumerate(slots):
+            positions[self.owners[slot]].append(position)
+
+        ids = [None] * len(rows)
+        error = None
+        for shard, shard_positions in positions.items():
+            shard_slots = [slots[position] for position in shard_positions]
+
+            def write(connection):
+                check_writable(connection, set(shard_slots))
+                first = allocate_sequences(connection, shard, len(shard_slots))
+                shard_ids = [encode_id(first + i, shard, slot) for i, slot in enumerate(shard_slots)]
+                insert(connection, [rows[position] for position in shard_positions], shard_ids)
+                return shard_ids
+
+            try:
+                shard_ids = self.pools[shard].write(write)
+            except Exception as e:
+                error = e
+                continue
+            for position, record_id in zip(shard_positions, shard_ids):
+                ids[position] = record_id
+        if error is not None and not any(ids):
+            raise error
+        return ids
+
+    def map(self, read):
+        """[read(shard, pool) for every shard], run on the shards concurrently."""
+        if self._executor is None:
+            return [read(0, self.pools[0])]
+        read = tracing.propagate(stage_metrics.propagate(read))
+        return list(self._executor.map(read, range(len(self.pools)), self.pools))
+
+    def select(self, sql, parameters, key, limit, id_column=0):
+        """The first `limit` rows of a query across every shard in `key` order, as (owned, row).
+
+        Every shard runs sql (ordered by key and limited to `limit` rows). A
+        record being moved is returned by two shards and owned by one: the
+        caller skips rows that are not owned, but pages by all of them, so a
+        page may come out short and never misses a record.
+        """
+        def read(shard, pool):
+            with pool.connection() as connection:
+                rows = connection.execute(sql, parameters).fetchall()
+            return [(self.owns(shard, row[id_column]), row) for row in rows]
+
+        results = self.map(read)
+        if len(results) == 1:
+            return results[0]
+        return list(heapq.merge(*results, key=lambda item: key(item[1])))[:limit]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        for pool in self.pools:
+            pool.close()
@@ -0,0 +1,290 @@
+import atexit
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import grpc
+
+try:
+    from opentelemetry import context as otel_context, trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    from opentelemetry.trace import SpanKind, Status, StatusCode
+    from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+except ImportError:
+    trace = None
+    SpanExporter = object
+
+import stage_metrics
+
+# Shared by the records and prescription services, keep both copies in sync.
+#
+# OpenTelemetry tracing, off unless TRACING is set:
+#
+#   TRACING              "file", or "otlp" (needs opentelemetry-exporter-otlp-proto-grpc,
+#                        configured by the usual OTEL_EXPORTER_OTLP_* variables)
+#   TRACING_FILE         where "file" appends the spans, one JSON object a line (default spans.jsonl)
+#   TRACING_SAMPLE_RATE  share of the traces started here that are kept, 0-1 (default 0.01)
+#
+# TracingInterceptor continues the trace of the W3C traceparent a call
+# carries (the gateway sends one with every call) and keeps or drops it as
+# the caller decided, so a sampled request is traced end to end. Within a
+# kept trace, every SQLite statement and commit of the call is a span, on
+# whichever thread runs it (see propagate()); in "wal" mode a write's span
+# also covers its wait for the group commit. Discovery calls start traces of
+# their own. Spans are exported in batches from a
+# background thread, and nothing beyond the trace context is recorded for
+# calls that are not sampled. Statements are recorded with their
+# placeholders, never their parameters.
+
+log = logging.getLogger(__name__)
+
+# Codes that are the server's fault, the others are the caller's
+SERVER_ERRORS = {grpc.StatusCode.UNKNOWN, grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.UNIMPLEMENTED,
+                 grpc.StatusCode.INTERNAL, grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DATA_LOSS}
+
+_tracer = None
+_provider = None
+
+
+class FileSpanExporter(SpanExporter):
+    """Appends spans to a file as JSON lines, one write per batch so worker processes can share it."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        lines = "".join(span.to_json(indent=None) + "\n" for span in spans)
+        try:
+            with self._lock, open(self.path, "a") as out:
+                out.write(lines)
+        except OSError as e:
+            log.warning("Could not write spans to %s: %s", self.path, e)
+            return SpanExportResult.FAILURE
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+def _exporter_from_env(exporter):
+    if exporter == "file":
+        return FileSpanExporter(os.getenv("TRACING_FILE", "spans.jsonl"))
+    if exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter()
+    raise ValueError(f"Unknown TRACING exporter {exporter!r}, use file or otlp")
+
+
+def configure_tracing(service, exporter=None, sample_rate=None, processor=None):
+    """Start tracing to exporter (a SpanExporter, or TRACING's), returns whether tracing is on.
+
+    processor wraps the exporter, BatchSpanProcessor by default.
+    """
+    global _tracer, _provider
+    exporter = exporter or os.getenv("TRACING", "")
+    if not exporter:
+        return False
+    if trace is None:
+        log.warning("TRACING is set but opentelemetry-sdk is not installed, tracing stays off")
+        return False
+    if isinstance(exporter, str):
+        exporter = _exporter_from_env(exporter)
+    sample_rate = float(os.getenv("TRACING_SAMPLE_RATE", 0.01)) if sample_rate is None else sample_rate
+
+    if _provider is not None:
+        _provider.shutdown()
+    # Its own provider rather than the global one, which can only be set once
+    _provider = TracerProvider(resource=Resource.create({"service.name": service}),
+                               sampler=ParentBased(TraceIdRatioBased(sample_rate)))
+    _provider.add_span_processor((processor or BatchSpanProcessor)(exporter))
+    _tracer = _provider.get_tracer(__name__)
+    atexit.register(stop_tracing)
+    return True
+
+
+def stop_tracing():
+    """Export the spans still buffered and stop tracing."""
+    global _tracer, _provider
+    if _provider is None:
+        return
+    _provider.shutdown()
+    _tracer = _provider = None
+
+
+def enabled():
+    return _tracer is not None
+
+
+@contextmanager
+def span(name, kind="INTERNAL", attributes=None):
+    """A span (of SpanKind `kind`) of the current trace, or a new one, while tracing is on."""
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, kind=SpanKind[kind], attributes=attributes) as current:
+        yield current
+
+
+def propagate(function):
+    """function, running in the calling thread's trace wherever it runs."""
+    if _tracer is None:
+        return function
+    current = otel_context.get_current()
+
+    def run(*args, **kwargs):
+        token = otel_context.attach(current)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            otel_context.detach(token)
+    return run
+
+
+def _statement(database_name, sql):
+    # Only within a kept trace, statements never start one
+    if _tracer is None or not trace.get_current_span().is_recording():
+        return None
+    operation = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "SQL"
+    return _tracer.start_as_current_span(
+        f"{operation} {database_name}", kind=SpanKind.CLIENT,
+        attributes={"db.system": "sqlite", "db.name": database_name, "db.operation": operation, "db.statement": sql})
+
+
+class TracedCursor(stage_metrics.TimedCursor):
+    def execute(self, sql, parameters=()):
+        traced = _statement(self.connection.database_name, sql)
+        if traced is None:
+            return super().execute(sql, parameters)
+        with traced:
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        traced = _statement(self.connection.database_name, sql)
+        if traced is None:
+            return super().executemany(sql, parameters)
+        with traced:
+            return super().executemany(sql, parameters)
+
+
+class TracedConnection(stage_metrics.TimedConnection):
+    """TimedConnection whose statements and commits are spans of the current trace, pass it as connect(factory=)."""
+
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.database_name = os.path.basename(str(database))
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def commit(self):
+        traced = _statement(self.database_name, "COMMIT")
+        if traced is None:
+            return super().commit()
+        with traced:
+            return super().commit()
+
+
+def _status_code(context, error=None):
+    code = error if isinstance(error, grpc.StatusCode) else getattr(error, "code", None)
+    if isinstance(code, grpc.StatusCode):
+        return code
+    # grpc.server's context knows the code an abort() set
+    try:
+        code = context.code()
+    except (AttributeError, NotImplementedError):
+        code = None
+    if isinstance(code, grpc.StatusCode):
+        return code
+    return grpc.StatusCode.UNKNOWN if error is not None else grpc.StatusCode.OK
+
+
+def _end(current, context, error=None):
+    code = _status_code(context, error)
+    current.set_attribute("rpc.grpc.status_code", code.value[0])
+    if code in SERVER_ERRORS:
+        current.set_status(Status(StatusCode.ERROR, code.name))
+    current.end()
+
+
+class TracingInterceptor(grpc.ServerInterceptor):
+    """Makes every call a span, continuing the trace of its traceparent metadata."""
+
+    def __init__(self):
+        self.propagator = TraceContextTextMapPropagator()
+
+    def _start(self, method, service, context):
+        parent = self.propagator.extract(dict(context.invocation_metadata() or ()))
+        return _tracer.start_span(f"{service}/{method}", context=parent, kind=SpanKind.SERVER, attributes={
+            "rpc.system": "grpc", "rpc.service": service, "rpc.method": method})
+
+    def _wrap(self, method, service, behavior):
+        def traced(request_or_iterator, context):
+            current = self._start(method, service, context)
+            token = otel_context.attach(trace.set_span_in_context(current))
+            try:
+                response = behavior(request_or_iterator, context)
+            except Exception as e:
+                _end(current, context, e)
+                raise
+            finally:
+                otel_context.detach(token)
+            _end(current, context)
+            return response
+        return traced
+
+    def _wrap_stream(self, method, service, behavior):
+        def traced(request_or_iterator, context):
+            # A stream may be pulled by a different thread for every message
+            current = self._start(method, service, context)
+            call = trace.set_span_in_context(current)
+            token = otel_context.attach(call)
+            try:
+                responses = behavior(request_or_iterator, context)
+            except Exception as e:
+                _end(current, context, e)
+                raise
+            finally:
+                otel_context.detach(token)
+            try:
+                while True:
+                    token = otel_context.attach(call)
+                    try:
+                        response = next(responses)
+                    except StopIteration:
+                        break
+                    except Exception as e:
+                        _end(current, context, e)
+                        raise
+                    finally:
+                        otel_context.detach(token)
+                    yield response
+            except GeneratorExit:
+                # The caller went away
+                _end(current, context, grpc.StatusCode.CANCELLED)
+                raise
+            _end(current, context)
+        return traced
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or _tracer is None:
+            return handler
+        # handler_call_details.method looks like "/records.RecordService/GetRecordInfo"
+        service, _, method = handler_call_details.method.lstrip("/").rpartition("/")
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=self._wrap(method, service, handler.unary_unary))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=self._wrap_stream(method, service, handler.unary_stream))
+        if handler.stream_unary:
+            return handler._replace(stream_unary=self._wrap(method, service, handler.stream_unary))
+        return handler._replace(stream_stream=self._wrap_stream(method, service, handler.stream_stream))
+
+
+def tracing_from_env():
+    return TracingInterceptor() if _tracer is not None else None
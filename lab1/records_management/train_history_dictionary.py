@@ -0,0 +1,76 @@
+"""Train a medical_history compression dictionary from the records in the database.
+
+The dictionary is stored in the history_dictionaries table, services started
+with the same HISTORY_CODEC afterwards compress new writes with it. With
+--recompress existing histories are rewritten with it too, in batches so the
+writers are never blocked for long:
+
+    python train_history_dictionary.py [--codec zlib] [--size 16384] [--samples 5000] [--recompress]
+"""
+import argparse
+import os
+import sqlite3
+
+from history_codec import HistoryCodec, create_dictionary_table, load_dictionaries, store_dictionary, train_dictionary
+
+
+def sample_histories(connection, codec, samples):
+    rows = connection.execute(
+        "SELECT medical_history FROM records WHERE medical_history IS NOT NULL ORDER BY random() LIMIT ?",
+        (samples,)
+    ).fetchall()
+    return [codec.decode(row[0]) for row in rows]
+
+
+def recompress(connection, codec, batch_size):
+    # Rewrites storage only: the version stays, so the update is neither a
+    # new ETag nor a change log entry
+    rewritten = 0
+    after_id = 0
+    while True:
+        rows = connection.execute(
+            "SELECT id, medical_history FROM records WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, batch_size)
+        ).fetchall()
+        if not rows:
+            return rewritten
+        updates = []
+        for record_id, stored in rows:
+            encoded = codec.encode(codec.decode(stored))
+            if encoded != stored:
+                updates.append((encoded, record_id))
+        connection.executemany("UPDATE records SET medical_history = ? WHERE id = ?", updates)
+        connection.commit()
+        rewritten += len(updates)
+        after_id = rows[-1][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default=os.getenv("RECORDS_DATABASE", "records.db"))
+    parser.add_argument("--codec", default=os.getenv("HISTORY_CODEC") or "zlib", choices=["zlib", "zstd"])
+    parser.add_argument("--size", type=int, default=16 * 1024, help="dictionary size in bytes")
+    parser.add_argument("--samples", type=int, default=5000, help="histories to train on")
+    parser.add_argument("--min-size", type=int, default=int(os.getenv("HISTORY_COMPRESS_MIN", 256)))
+    parser.add_argument("--recompress", action="store_true", help="rewrite existing histories with the new dictionary")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(args.database, timeout=30)
+    create_dictionary_table(connection)
+    samples = sample_histories(connection, HistoryCodec(dictionaries=load_dictionaries(connection)), args.samples)
+    if not samples:
+        parser.exit(1, "No histories to train on\n")
+    dictionary = train_dictionary(args.codec, samples, args.size)
+    dictionary_id = store_dictionary(connection, args.codec, dictionary)
+    connection.commit()
+    print(f"Stored {args.codec} dictionary {dictionary_id}: {len(dictionary)} bytes from {len(samples)} histories")
+
+    if args.recompress:
+        codec = HistoryCodec(args.codec, load_dictionaries(connection), args.min_size)
+        print(f"Recompressed {recompress(connection, codec, args.batch_size)} histories")
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()